@@ -14,8 +14,8 @@ def clientArgHandler():
 # Handles argument errors for server.py
 def serverArgHandler():
 
-    if len(sys.argv) != 3:
-        raise ValueError("\n===== Usage error: python3 TCPServer3.py SERVER_PORT NO_ALLOWED_ATTEMPTS ======\n")
+    if len(sys.argv) < 3:
+        raise ValueError("\n===== Usage error: python3 TCPServer3.py SERVER_PORT NO_ALLOWED_ATTEMPTS [--OPTION VALUE ...] ======\n")
 
     try:
         port = int(sys.argv[1])
@@ -29,3 +29,40 @@ def serverArgHandler():
     except ValueError:
 
         raise ValueError(f"Invalid number of allowed failed consecutive attempt: {attempts}")
+
+
+# Handles the optional --OPTION VALUE pairs given after the server's required arguments.
+# Each value is converted to the type of its default.
+def serverOptionHandler(defaults):
+    return optionHandler(defaults, sys.argv[3:], "server")
+
+
+# Parses --OPTION VALUE pairs over a dict of defaults, for the program named by kind
+def optionHandler(defaults, args, kind):
+
+    options = dict(defaults)
+
+    if len(args) % 2 != 0:
+        raise ValueError(f"\n===== Usage error: each {kind} option must be given as --OPTION VALUE ======\n")
+
+    for flag, value in zip(args[::2], args[1::2]):
+
+        name = flag[2:]
+
+        if not flag.startswith("--") or name not in defaults:
+            raise ValueError(f"Unknown {kind} option: {flag}")
+
+        default = defaults[name]
+
+        try:
+            if isinstance(default, bool):
+                if value.lower() not in ("1", "0", "true", "false", "on", "off", "yes", "no"):
+                    raise ValueError
+                options[name] = value.lower() in ("1", "true", "on", "yes")
+            else:
+                options[name] = type(default)(value)
+
+        except ValueError:
+            raise ValueError(f"Invalid value for {kind} option {flag}: {value}")
+
+    return options
@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+
+# Written by Vimukthi Herath
+
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import asyncio
+import tempfile
+import subprocess
+from socket import socket, AF_INET, SOCK_STREAM, create_connection
+from argHandlers import optionHandler
+from clientHandlers import AsyncMessengerClient
+
+# Load generator for the messenger server.
+#
+# Starts server.py in a scratch directory with its own credentials.txt, connects simulated clients to it
+# with AsyncMessengerClient, and runs each scenario in turn:
+#   login:     every client logs in at once
+#   chatter:   clients in pairs exchange direct messages
+#   group:     a few senders message a group every client has joined; also times delivery to each member
+#   activeuser: every client polls the active user list
+#   p2pvideo:  pairs of clients send each other a file over UDP
+# Latency is measured on the client side, from sending a request to its reply arriving.
+# The results, including the server's CPU time and memory, are printed and written to the output file as json,
+# so runs on different commits can be compared.
+#
+# Usage: python3 benchmark.py [--OPTION VALUE ...]
+
+SCENARIOS = ("login", "chatter", "group", "activeuser", "p2pvideo")
+
+benchmarkOptions = {
+    "clients": 50, # Simulated clients
+    "scenarios": ",".join(SCENARIOS), # Scenarios to run, in order; login always runs first
+    "messages": 200, # Direct messages each client sends in the chatter scenario
+    "groupSenders": 5, # Clients sending to the group in the group scenario
+    "groupMessages": 100, # Messages each group sender sends
+    "polls": 20, # Active user list requests per client in the activeuser scenario
+    "transfers": 2, # Files sent at once in the p2pvideo scenario
+    "videoSize": 8 * 1024 * 1024, # Bytes in each file sent
+    "window": 50, # Requests a client may have waiting for a reply at once
+    "mode": "threaded", # Server mode: threaded or async
+    "serverArgs": "", # Any other server options, e.g. "--fsync always --broadcastWorkers 4"
+    "output": "bench_output.txt", # Where the json results are written, besides stdout ("" to skip)
+}
+
+
+# Latency samples for every request type in a scenario
+class Recorder:
+
+    def __init__(self):
+        self.samples = {} # Stores { requestType: [seconds, ...] }
+        self.errors = {} # Stores { requestType: count }
+
+
+    def record(self, requestType, seconds, failed=False):
+        self.samples.setdefault(requestType, []).append(seconds)
+        if failed:
+            self.errors[requestType] = self.errors.get(requestType, 0) + 1
+
+
+    # Sends a request and records how long its reply takes; a reply with success false counts as an error
+    async def timed(self, requestType, request):
+
+        start = time.perf_counter()
+        failed = True
+
+        try:
+            reply = await request
+            failed = isinstance(reply, dict) and reply.get("success") is False
+            return reply
+        finally:
+            self.record(requestType, time.perf_counter() - start, failed)
+
+
+    def results(self, seconds):
+
+        results = {}
+
+        for requestType, samples in self.samples.items():
+            samples.sort()
+            results[requestType] = {
+                "count": len(samples),
+                "errors": self.errors.get(requestType, 0),
+                "throughput": len(samples) / seconds if seconds else None,
+                "meanMs": sum(samples) / len(samples) * 1000,
+                "p50Ms": percentile(samples, 0.5) * 1000,
+                "p99Ms": percentile(samples, 0.99) * 1000,
+                "p999Ms": percentile(samples, 0.999) * 1000,
+                "maxMs": samples[-1] * 1000,
+            }
+
+        return results
+
+
+
+# Nearest rank percentile of sorted samples
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, max(0, int(fraction * len(samples) + 0.5) - 1))]
+
+
+# CPU seconds and memory of a running process, from /proc; None where it isn't available
+def processUsage(pid):
+
+    usage = {"cpuSeconds": None, "rssBytes": None, "peakRssBytes": None}
+
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        usage["cpuSeconds"] = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+        with open(f"/proc/{pid}/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    usage["rssBytes"] = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    usage["peakRssBytes"] = int(line.split()[1]) * 1024
+
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return usage
+
+
+def freePort():
+
+    with socket(AF_INET, SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# Starts server.py in workDir and waits until it accepts connections
+def startServer(workDir, port, options):
+
+    serverPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    args = [sys.executable, serverPath, str(port), "6", "--mode", options["mode"], *options["serverArgs"].split()]
+
+    server = subprocess.Popen(args, cwd=workDir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited on startup: {server.stderr.read().decode().strip()}")
+
+        try:
+            create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+
+    server.kill()
+    raise RuntimeError("Server did not start listening")
+
+
+def stopServer(server):
+
+    server.send_signal(signal.SIGINT)
+
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+# Runs requests for one client, keeping at most window of them waiting for replies
+async def pipelined(requests, window):
+
+    limit = asyncio.Semaphore(window)
+
+    async def run(request):
+        async with limit:
+            await request()
+
+    await asyncio.gather(*(run(request) for request in requests))
+
+
+
+async def loginScenario(clients, recorder):
+
+    await asyncio.gather(*(recorder.timed("login", client.login(client.benchUser, client.benchPassword)) for client in clients))
+
+
+async def chatterScenario(clients, recorder, options):
+
+    # Pairs 0-1, 2-3, ...; an odd client out talks to client 0
+    def partner(i):
+        return clients[i ^ 1].benchUser if (i ^ 1) < len(clients) else clients[0].benchUser
+
+    async def chat(i, client):
+        requests = [lambda n=n: recorder.timed("sendMessage", client.sendMessage(partner(i), f"chatter {n}"))
+                    for n in range(options["messages"])]
+        await pipelined(requests, options["window"])
+
+    await asyncio.gather(*(chat(i, client) for i, client in enumerate(clients)))
+
+
+async def groupScenario(clients, recorder, options):
+
+    groupName = f"bench{os.getpid()}"
+    creator, members = clients[0], clients[1:]
+
+    await recorder.timed("createGroup", creator.createGroup(groupName, [client.benchUser for client in members]))
+    await asyncio.gather(*(recorder.timed("joinGroup", client.joinGroup(groupName)) for client in members))
+
+    # Every member but the sender gets each message; messages carry their send time, so delivery can be timed
+    senders = clients[:max(1, min(options["groupSenders"], len(clients)))]
+    expected = len(senders) * options["groupMessages"] * (len(clients) - 1)
+    delivered = asyncio.Event()
+    received = 0
+
+    def onGroupMessage(frame):
+        nonlocal received
+        if frame.get("header") == "groupMessage" and frame["groupName"] == groupName:
+            recorder.record("groupDelivery", time.perf_counter() - float(frame["message"]))
+            received += 1
+            if received == expected:
+                delivered.set()
+
+    for client in clients:
+        client.onMessage = onGroupMessage
+
+    async def send(client):
+        requests = [lambda: recorder.timed("messageGroup", client.groupMessage(groupName, repr(time.perf_counter())))
+                    for _ in range(options["groupMessages"])]
+        await pipelined(requests, options["window"])
+
+    await asyncio.gather(*(send(client) for client in senders))
+
+    try:
+        await asyncio.wait_for(delivered.wait(), 30)
+    except asyncio.TimeoutError:
+        recorder.errors["groupDelivery"] = recorder.errors.get("groupDelivery", 0) + expected - received
+
+    for client in clients:
+        client.onMessage = None
+
+
+async def activeUserScenario(clients, recorder, options):
+
+    async def poll(client):
+        for _ in range(options["polls"]):
+            await recorder.timed("activeUser", client.activeUsers())
+
+    await asyncio.gather(*(poll(client) for client in clients))
+
+
+async def p2pVideoScenario(clients, recorder, options, workDir):
+
+    path = os.path.join(workDir, "bench_video.bin")
+    with open(path, 'wb') as f:
+        f.write(os.urandom(options["videoSize"]))
+
+    # Receivers are the clients with a UDP socket, at the start of the list; senders are taken from the end
+    receivers = [client for client in clients if client.udpPort]
+    pairs = []
+    for i, receiver in enumerate(receivers):
+        sender = clients[-1 - i] if clients[-1 - i] is not receiver else clients[(i + 1) % len(clients)]
+        pairs.append((sender, receiver))
+
+    async def transfer(sender, receiver):
+        start = time.perf_counter()
+        try:
+            await sender.sendFile(receiver.benchUser, path, f"{sender.benchUser}_bench_video.bin")
+            recorder.record("p2pvideo", time.perf_counter() - start)
+        except Exception:
+            recorder.record("p2pvideo", time.perf_counter() - start, failed=True)
+
+    await asyncio.gather(*(transfer(sender, receiver) for sender, receiver in pairs))
+
+
+async def runBenchmark(port, options, workDir, serverPid):
+
+    scenarios = [name for name in options["scenarios"].split(",") if name and name != "login"]
+
+    # Only the clients that receive files need a UDP socket
+    receivers = options["transfers"] if "p2pvideo" in scenarios else 0
+
+    clients = []
+    for i in range(options["clients"]):
+        client = await AsyncMessengerClient.connect("127.0.0.1", port, udpPort=0 if i < receivers else None)
+        client.benchUser, client.benchPassword = f"bench{i}", f"password{i}"
+        clients.append(client)
+
+    results = {}
+
+    try:
+        for name in ["login", *scenarios]:
+
+            recorder = Recorder()
+            before = processUsage(serverPid)
+            start = time.perf_counter()
+
+            if name == "login":
+                await loginScenario(clients, recorder)
+            elif name == "chatter":
+                await chatterScenario(clients, recorder, options)
+            elif name == "group":
+                await groupScenario(clients, recorder, options)
+            elif name == "activeuser":
+                await activeUserScenario(clients, recorder, options)
+            elif name == "p2pvideo":
+                await p2pVideoScenario(clients, recorder, options, workDir)
+
+            seconds = time.perf_counter() - start
+            after = processUsage(serverPid)
+
+            results[name] = {
+                "seconds": seconds,
+                "serverCpuSeconds": after["cpuSeconds"] - before["cpuSeconds"] if before["cpuSeconds"] is not None else None,
+                "serverRssBytes": after["rssBytes"],
+                "requests": recorder.results(seconds),
+            }
+
+            print(f"{name}: {seconds:.3f} s", file=sys.stderr)
+
+    finally:
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+    return results
+
+
+def gitCommit():
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+
+    try:
+        options = optionHandler(benchmarkOptions, sys.argv[1:], "benchmark")
+
+        if options["clients"] < 2:
+            raise ValueError("The benchmark needs at least 2 clients")
+
+        for name in options["scenarios"].split(","):
+            if name and name not in SCENARIOS:
+                raise ValueError(f"Unknown scenario: {name}")
+
+    except ValueError as error:
+        print(f"{error}", file=sys.stderr)
+        sys.exit(1)
+
+    outputPath = os.path.abspath(options["output"]) if options["output"] else None
+    workDir = tempfile.mkdtemp(prefix="messenger-bench-")
+
+    # Plain text passwords are accepted by the server and hashed once when it loads them
+    with open(os.path.join(workDir, "credentials.txt"), 'w') as f:
+        for i in range(options["clients"]):
+            f.write(f"bench{i} password{i}\n")
+
+    port = freePort()
+    server = startServer(workDir, port, options)
+
+    # Received files are written to the working directory
+    cwd = os.getcwd()
+    os.chdir(workDir)
+
+    try:
+        scenarios = asyncio.run(runBenchmark(port, options, workDir, server.pid))
+        usage = processUsage(server.pid)
+    finally:
+        stopServer(server)
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {
+        "commit": gitCommit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "options": options,
+        "server": usage,
+        "scenarios": scenarios,
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+
+    if outputPath:
+        with open(outputPath, 'w') as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
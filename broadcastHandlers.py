@@ -0,0 +1,80 @@
+# Written by Vimukthi Herath
+
+import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait
+from frameHandlers import encodeFrame
+from logHandlers import logEvent, WARNING
+
+# Broadcasts to fewer recipients than this are queued on the calling thread
+PARALLEL_THRESHOLD = 64
+
+
+# Sends one response to many sessions.
+# The frame is serialised once and the same bytes object is queued for every recipient.
+# With a writer pool (threaded server only), large fan-outs are split across the pool's
+# threads, so a recipient applying backpressure only holds up its own slice.
+class Broadcaster:
+
+    def __init__(self, poolSize=0, parallelThreshold=PARALLEL_THRESHOLD):
+        self.pool = ThreadPoolExecutor(max_workers=poolSize, thread_name_prefix="broadcast") if poolSize else None
+        self.poolSize = poolSize
+        self.parallelThreshold = parallelThreshold
+
+        # Latency of the whole fan-out, from serialisation to the last frame being queued
+        self.lock = Lock()
+        self.count = 0
+        self.recipients = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+        self.lastLatency = 0.0
+
+
+    # Queues the response for every session
+    # Returns the broadcast's latency in seconds
+    def broadcast(self, sessions, response):
+
+        start = time.perf_counter()
+        data = encodeFrame(response)
+
+        if self.pool and len(sessions) >= self.parallelThreshold:
+            sliceSize = -(-len(sessions) // self.poolSize)
+            done, _ = wait([self.pool.submit(self.sendSlice, sessions[i:i + sliceSize], data) for i in range(0, len(sessions), sliceSize)])
+
+            # A slice that failed outright is raised here, as it would be without the pool
+            for future in done:
+                future.result()
+        else:
+            self.sendSlice(sessions, data)
+
+        latency = time.perf_counter() - start
+
+        with self.lock:
+            self.count += 1
+            self.recipients += len(sessions)
+            self.totalLatency += latency
+            self.lastLatency = latency
+            self.maxLatency = max(self.maxLatency, latency)
+
+        return latency
+
+
+    # One recipient failing doesn't stop the frame reaching the rest of the slice
+    def sendSlice(self, sessions, data):
+        for session in sessions:
+            try:
+                session.sendEncoded(data)
+            except Exception as e:
+                logEvent(WARNING, "broadcastFailed", user=session.username, error=e)
+
+
+    # Snapshot of the broadcast latency stats, in seconds
+    def stats(self):
+        with self.lock:
+            return {
+                "broadcasts": self.count,
+                "recipients": self.recipients,
+                "lastLatency": self.lastLatency,
+                "avgLatency": self.totalLatency / self.count if self.count else 0.0,
+                "maxLatency": self.maxLatency,
+            }
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+# Written by Vimukthi Herath
+
+import sys
+from argHandlers import optionHandler
+from clusterHandlers import ClusterBroker
+from logHandlers import startLogging, stopLogging
+
+# Message broker for running the server as a cluster of nodes.
+#
+# Start the broker, then any number of servers with --cluster pointing at its socket, each in its own
+# working directory (with its own credentials.txt), e.g. for two nodes sharing port 12000:
+#   python3 broker.py /tmp/messenger.sock
+#   python3 server.py 12000 3 --cluster /tmp/messenger.sock
+#   python3 server.py 12000 3 --cluster /tmp/messenger.sock
+#
+# Usage: python3 broker.py SOCKET_PATH [--OPTION VALUE ...]
+
+brokerOptions = {
+    "logLevel": "info", # Console log level: debug, info, warning or error
+    "logFormat": "text", # Console log lines as text or json
+}
+
+
+def main():
+
+    try:
+        if len(sys.argv) < 2 or sys.argv[1].startswith("--"):
+            raise ValueError("\n===== Usage error: python3 broker.py SOCKET_PATH [--OPTION VALUE ...] ======\n")
+
+        options = optionHandler(brokerOptions, sys.argv[2:], "broker")
+        logListener = startLogging(options["logLevel"], options["logFormat"])
+
+    except ValueError as error:
+        print(f"{error}", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        broker = ClusterBroker(sys.argv[1])
+    except OSError as error:
+        print(f"Cannot listen on {sys.argv[1]}: {error}", file=sys.stderr)
+        stopLogging(logListener)
+        sys.exit(1)
+
+    print(f"===== Cluster broker is running @ {sys.argv[1]} =====")
+
+    try:
+        broker.serveForever()
+    except KeyboardInterrupt:
+        print("\nExiting on keyboard interrupt...")
+    finally:
+        broker.close()
+        stopLogging(logListener)
+        print("Broker socket is now closed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,42 +4,32 @@
 
 from socket import *
 import sys
-import time
-import json
 import os
+import selectors
+from collections import deque
+from itertools import count
 from threading import Thread
-import queue
-import select
 from argHandlers import clientArgHandler 
+from frameHandlers import FrameReader, sendFrame
+from transferHandlers import TransferSender, TransferService
 
 # Global variables
 loggedIn = False
 blocked = False
 sessionEnded = False
-responseLoading = False
-inputQueue = queue.Queue() # Each element in the queue represents a response from the server awaiting processing.
+responseLoading = False # A login request is waiting for its response
+username = None # Entered at the login prompt; kept once logged in
+promptShown = False # The prompt for the next line of input is on screen
+inputLines = deque() # Lines read from stdin, waiting to be handled
 activeUserInfo = {} # Store information on active users on each active user call
+requestIds = count(1) # Correlation ids; the server echoes a request's id in its reply
 
-# Input handler which allows for server responses to be checked for while waiting for user input
-# required as stdLibs input() is blocking
-def nonBlockInput(prompt, timeout=0.1):
-    
-    # Only print prompt when there are no server responses to process
-    if inputQueue.empty():
-        print(prompt, end='', flush=True)
-    
-    # Wait for stdin at input. Intermittently check for server responses.
-    while True:
-        readable, _, _ = select.select([sys.stdin], [], [], timeout)
-        
-        # If stdin buffer is not empty, process input
-        if readable:
-            return sys.stdin.readline().rstrip()
+COMMAND_PROMPT = "\nEnter one of the following commands (/msgto, /activeuser, /creategroup, /joingroup, /groupmsg, /history, /grouphistory, /p2pvideo, /logout): "
 
-        # If the queue is not empty, process queued server responses
-        if not inputQueue.empty():
-            inputQueue.get() 
-            return
+# Sends a request to the server as a single frame, tagged with a new correlation id
+def sendRequest(clientSocket, request):
+    request["requestId"] = next(requestIds)
+    sendFrame(clientSocket, request)
 
 # Handle usage errors for all commands
 # Returns a tuple: (UsageErrorBool, errorMsg)
@@ -53,7 +43,7 @@ def commandUsageHandler(command, args):
         
     if command == '/msgto':
         if len(args) < 3:
-            raise ValueError("\nUsage error: /msgto USERNAME MESSAGE_CONTENT\n")
+            raise ValueError("\nUsage error: /msgto USERNAME[,USERNAME ...] MESSAGE_CONTENT\n")
 
     if command == '/logout':
         if len(args) != 1:
@@ -74,6 +64,11 @@ def commandUsageHandler(command, args):
          if len(args) < 3:
             raise ValueError("\nUsage error: /groupmsg GROUPNAME MESSAGE_CONTENT\n")
          
+    if command in ('/history', '/grouphistory'):
+        if not 2 <= len(args) <= 4 or not all(arg.isdigit() for arg in args[2:]):
+            name = "USERNAME" if command == '/history' else "GROUPNAME"
+            raise ValueError(f"\nUsage error: {command} {name} [COUNT] [BEFORE]\n")
+
     if command == '/p2pvideo':
         if len(args) != 3:
             raise ValueError("\nUsage error: /p2pvideo USERNAME FILENAME\n")
@@ -91,164 +86,330 @@ def sendVideoUDP(presenter_username, audience_username, filename):
         audience_host, audience_port = activeUserInfo[audience_username]
         audience_address = (audience_host, int(audience_port.strip('.').strip()))
 
-        # Send file via UDP
-        with socket(AF_INET, SOCK_DGRAM) as udp_socket, open(filename, 'rb') as f:
-            
-            # Send presenter username
-            udp_socket.sendto(presenter_username.encode(), audience_address)
-            
-            # Send filename
-            udp_socket.sendto(filename.encode(), audience_address)
-            
-            # Send file
-            while True:
-                file_content = f.read(1024)
-
-                if not file_content:
-                    # Send a packet to signify EOF as UDP is connectionless
-                    udp_socket.sendto(b"EOF", audience_address)
-                    break
-
-                udp_socket.sendto(file_content, audience_address)
+        # Send file via UDP: sequenced chunks, a sliding window and selective acks (see transferHandlers)
+        sender = TransferSender(audience_address, filename, presenter_username, os.path.basename(filename))
+        sender.send()
+
+        # An interrupted transfer of the same file picks up where it left off
+        if sender.resumedChunks:
+            print(f"\nResumed transfer of {filename}: {sender.resumedChunks} of {sender.chunks} chunks were already on the recipient's side.")
 
         print(f"\nVideo file {filename} has been sent to {audience_username}.\n")
 
     except Exception as e:
         print(f"Error in sending file via UDP: {e}")
 
-# Receive video via UDP; runs on a explicit UDP thread.
+# Receive videos via UDP on the client's bound UDP socket, for the life of the client.
+# Any number of presenters can send at once; each transfer is written to its own file.
+# The returned service is driven by the event loop in main().
 # Note the clientSocket is NOT used for file transfer, 
-# it is just used to emit a message to the recipient when file transfer is complete.
-def receiveVideoUDP(addressUDP, clientSocket):
+# it is just used to emit a message to the recipient when a file transfer is complete.
+def receiveVideoUDP(udp_socket, clientSocket):
+
+    # Send a TCP message on completion to confirm the send on the recipient side
+    def transferComplete(presenter_username, filename):
+        confirmUDP_request = {
+            "header": "confirmUDP",
+            "message": f"Received video file from {presenter_username}, saved as {filename}"
+        }
+        try:
+            sendRequest(clientSocket, confirmUDP_request)
+        except OSError as e:
+            print(f"Error confirming received file: {e}")
+
+    def transferFailed(presenter_username, error):
+        print(f"Error in receiving file via UDP from {presenter_username}: {error}")
+
+    return TransferService(udp_socket, transferComplete, transferFailed)
+
+
+# Display one server response; the header tag defines the response type
+def handleResponse(response):
+
+    global loggedIn, blocked, sessionEnded, responseLoading, promptShown, username, activeUserInfo
+
+    promptShown = False
+    key = response["header"]
+
+    if key == "login":
+        if response["success"]:
+            print("\nWelcome to Tessenger!\n")
+            loggedIn = True
+        else:
+            print(f"\n{response['errorMessage']}\n")
+            if response['blocked']:
+                blocked = True
+
+            # Ask for the username again
+            username = None
+
+        responseLoading = False
+
+    elif key == "confirmSentMessage":
+        if not response["success"]:
+            print(response["message"])
+        elif response.get("queued"):
+            print(f"\nrecipient is offline, message queued at {response['timeSent']}")
+        else:
+            print(f"\nmessage sent at {response['timeSent']}")
+
+    elif key == "confirmBatchMessage":
+        byStatus = {}
+        for user, status in response["recipients"].items():
+            byStatus.setdefault(status, []).append(user)
+
+        if "sent" in byStatus:
+            print(f"\nmessage sent at {response['timeSent']} to: {', '.join(byStatus['sent'])}")
+        if "queued" in byStatus:
+            print(f"\nqueued for offline users: {', '.join(byStatus['queued'])}")
+        if "full" in byStatus:
+            print(f"\nnot sent, too many unread messages: {', '.join(byStatus['full'])}")
+        if "unknown" in byStatus:
+            print(f"\nnot sent, no such user: {', '.join(byStatus['unknown'])}")
+
+    elif key == "message":
+        print("\n")
+        print(f"{response['timeSent']}, {response['from']}: {response['message']}\n")
+    
+    elif key == "activeUser":
+
+        if not response["userList"]:
+            print("\nNo currently active users.")
+        else:
+            for str in response["userList"]:
+                user, host_address, _, udp_port = str.strip().split('; ')
+                activeUserInfo[user] = (host_address, udp_port)
+
+                # Output information
+                print(str)
+
+    elif key == "createGroup":
+        print(response["message"])
+
+    elif key == "joinGroup":
+        print(response["message"])
+
+    elif key == "confirmGroupMessage":
+        print(response["message"])
+
+    elif key == "groupMessage":
+        print("\n")
+        print(f"{response['timeSent']}, {response['groupName']}, {response['from']}: {response['message']}\n")
+
+    elif key == "offlineMessages":
+        print(f"\nYou have {len(response['messages'])} message(s) received while you were offline:")
+        for message in response["messages"]:
+            handleResponse(message)
+
+    elif key == "history":
+        if not response["success"]:
+            print(response["message"])
+        elif not response["messages"]:
+            print("\nNo messages found.")
+        else:
+            # Sent newest first; shown oldest first, like a conversation
+            print()
+            for message in reversed(response["messages"]):
+                print(f"#{message['seq']} {message['timeSent']}, {message['from']}: {message['message']}")
+
+            if response["nextCursor"] is not None:
+                print(f"\nThere are older messages; add BEFORE {response['nextCursor']} to the command to see them.")
+
+    elif key == "confirmUDP":
+        print(f"\n{response['message']}")
+
+    elif key == "logout":
+        if response["success"]:
+            print(f"\nYou have successfully logged out. Goodbye!\n")
+            sessionEnded = True
+        else:
+            print("\nAn error occured while logging out.\n")
+
+    elif key == "unkown":
+        print(response["message"])
+
+    elif key == "invalidRequest":
+        print(response["message"])
+
+
+# Prints the prompt for the next line of input, unless it is already showing
+# or the client is waiting on the server before it can take more input
+def showPrompt():
+
+    global promptShown
+
+    if promptShown or responseLoading or sessionEnded or blocked:
+        return
+
+    if loggedIn:
+        print(COMMAND_PROMPT, end='', flush=True)
+    elif username is None:
+        print("Username: ", end='', flush=True)
+    else:
+        print("Password: ", end='', flush=True)
+
+    promptShown = True
+
+
+# Handle the lines typed so far. While a login is waiting for its response,
+# later lines stay queued until it arrives.
+def handleInput(clientSocket, udp_serverPort):
+
+    global promptShown
+
+    while inputLines and not responseLoading and not sessionEnded and not blocked:
+        promptShown = False
+
+        if loggedIn:
+            handleCommand(clientSocket, inputLines.popleft())
+        else:
+            handleLoginInput(clientSocket, inputLines.popleft(), udp_serverPort)
+
+
+# Takes the username, then the password, then sends the login request
+def handleLoginInput(clientSocket, line, udp_serverPort):
+
+    global username, responseLoading
+
+    if username is None:
+        username = line
+        return
+
+    auth_request = {
+        "header": "login",
+        "username": username,
+        "password": line,
+        "udp_port": udp_serverPort
+    }
 
-    global inputQueue
+    responseLoading = True
+    sendRequest(clientSocket, auth_request)
 
+
+# Run one command typed by a logged in user
+def handleCommand(clientSocket, userInput):
+
+    # Set of possible commands
+    possibleCommands = {'/msgto', '/activeuser', '/creategroup', '/joingroup', '/groupmsg', '/history', '/grouphistory', '/p2pvideo', '/logout'}
+
+    if not userInput:
+        return
+
+    # Get input arguments
+    inputArgs = userInput.split()
+    commandName = inputArgs[0]
+
+    # Nonsensical command
+    if commandName not in possibleCommands:
+        print("Error: Invalid command.\n")
+        return
+
+    # Catch command usage errors:
     try:
-        # run UDP socket
-        with socket(AF_INET, SOCK_DGRAM) as udp_socket:
-            udp_socket.bind(addressUDP)
-
-            # Receive the presenters username first
-            presenter_username, _ = udp_socket.recvfrom(1024)
-            presenter_username = presenter_username.decode()
-            
-            # Receive the file name
-            filename, _ = udp_socket.recvfrom(1024)
-            filename = filename.decode() 
-            name, extension = os.path.splitext(filename)
-            filename = name + '_received' + extension
-
-            with open(filename, 'wb') as f:
-                while True:
-                    data, _ = udp_socket.recvfrom(1024)
-                    if data == b'EOF':
-                        break
-                    f.write(data)
+        commandUsageHandler(commandName, inputArgs)
+    except ValueError as e:
+        print(e)
+        return
+
+    # /activeuser
+    if commandName == "/activeuser":
+
+        activerUser_request = {
+            "header": "activeUser"
+        }
+
+        sendRequest(clientSocket, activerUser_request)
+
+    # /msgto
+    elif commandName == '/msgto':
+
+        recipient, message = inputArgs[1], ' '.join(inputArgs[2:])
+
+        # Several comma separated recipients are sent in one request, with one confirmation
+        if ',' in recipient:
+            msg_request = {
+                "header": "sendBatchMessage",
+                "sender": username,
+                "recipients": [user for user in recipient.split(',') if user],
+                "message": message
+            }
+        else:
+            msg_request = {
+                "header": "sendMessage",
+                "sender": username,
+                "recipient": recipient,
+                "message": message
+            }
+        sendRequest(clientSocket, msg_request)
+
+    # /creategroup
+    elif commandName == '/creategroup':
         
+        groupName = inputArgs[1]
+        users = inputArgs[2:]
 
-        # Send a TCP message on completion to confirm the send on the recipient side
-        confirmUDP_request = {
-            "header": "confirmUDP",
-            "message": f"Received video file from {presenter_username}, saved as {filename}"
+        createGroup_request = {
+            "header": "createGroup",
+            "groupName": groupName,
+            "users": users
         }
-        clientSocket.sendall(json.dumps(confirmUDP_request).encode())
+        sendRequest(clientSocket, createGroup_request)
 
-    except Exception as e:
-        print(f"Error in receiving file via UDP: {e}")
+    # /joingroup
+    elif commandName == '/joingroup':
+        
+        groupName = inputArgs[1]
 
+        joinGroup_request = {
+            "header": "joinGroup",
+            "groupName": groupName,
+        }
+        sendRequest(clientSocket, joinGroup_request)
 
-# Receive and display server responses via TCP; runs on an explicit TCP thread.
-# Seperates client listening to server & client waiting for input.
-def serverListener(socket):
+    # /groupmsg
+    elif commandName == '/groupmsg':
 
-    global loggedIn, blocked, sessionEnded, responseLoading, activeUserInfo
+        groupName, message = inputArgs[1], ' '.join(inputArgs[2:])
+        
+        messageGroup_request = {
+            "header": "messageGroup",
+            "groupName": groupName,
+            "message": message
+        }
+        sendRequest(clientSocket, messageGroup_request)
 
+    # /history, /grouphistory
+    elif commandName in ('/history', '/grouphistory'):
 
-    while True:
+        history_request = {
+            "header": "history",
+            "peer" if commandName == '/history' else "groupName": inputArgs[1],
+            "limit": int(inputArgs[2]) if len(inputArgs) > 2 else 20,
+            "cursor": int(inputArgs[3]) if len(inputArgs) > 3 else None
+        }
+        sendRequest(clientSocket, history_request)
 
-        try:
+    # /p2pvideo
+    elif commandName == '/p2pvideo':
 
-            # Each response is a json object, for which the header tag defines the response type
-            raw_response = socket.recv(1024).decode()
-            response = json.loads(raw_response)
-            key = response["header"]
+        # The transfer runs on its own thread so messages keep being displayed while it is sent
+        audience, filename = inputArgs[1], inputArgs[2]
+        Thread(target=sendVideoUDP, args=(username, audience, filename), daemon=True).start()
 
-            if key == "login":
-                if response["success"]:
-                    print("\nWelcome to Tessenger!\n")
-                    loggedIn = True
-                else:
-                    print(f"\n{response['errorMessage']}\n")
-                    if response['blocked']:
-                        blocked = True
-
-                responseLoading = False
-            
-            elif key == "confirmSentMessage":
-                inputQueue.put(1)
-                print(f"\nmessage sent at {response['timeSent']}")
-
-            elif key == "message":
-                inputQueue.put(1)
-                print("\n")
-                print(f"{response['timeSent']}, {response['from']}: {response['message']}\n")
-                
-            elif key == "activeUser":
-
-                if not response["userList"]:
-                    inputQueue.put(1)
-                    print("\nNo currently active users.")
-                else:
-                    inputQueue.put(1)
-                    for str in response["userList"]:
-                        user, host_address, _, udp_port = str.strip().split('; ')
-                        activeUserInfo[user] = (host_address, udp_port)
-
-                        # Output information
-                        print(str)
-
-            elif key == "createGroup":
-                inputQueue.put(1)
-                print(response["message"])
-
-            elif key == "joinGroup":
-                inputQueue.put(1)
-                print(response["message"])
-
-            elif key == "confirmGroupMessage":
-                print(response["message"])
-
-            elif key == "groupMessage":
-                inputQueue.put(1)
-                print("\n")
-                print(f"{response['timeSent']}, {response['groupName']}, {response['from']}: {response['message']}\n")
-
-            elif key == "confirmUDP":
-                print("recv")
-                inputQueue.put(1)
-                print(f"\n{response['message']}")
-
-            elif key == "logout":
-                if response["success"]:
-                    print(f"\nYou have successfully logged out. Goodbye!\n")
-                    sessionEnded = True
-                    break
-                else:
-                    print("\nAn error occured while logging out.\n")
-            
-            elif key == "unkown":
-                print(response["message"])
+    # /logout
+    elif commandName == '/logout':
 
-        except Exception as e:
+        logout_request = {
+            "header": "logout"
+        }
 
-            print(f"\nError receiving data: {e}\n")
-            break
+        sendRequest(clientSocket, logout_request)
 
+    else:
+        print("\nSorry, an uncaught error has occured.\n")     
 
-def main():
 
-    # Set loading response
-    global responseLoading
+def main():
 
     # Get port and set attempt no's
     try:
@@ -262,168 +423,72 @@ def main():
     clientSocket = socket(AF_INET, SOCK_STREAM)
     clientSocket.connect(serverAddress)
 
-    # Thread for listening to server independently (TCP)
-    listeningThread = Thread(target=serverListener, args=(clientSocket,), daemon=True)
-    listeningThread.start()
+    # UDP socket for receiving videos
+    udp_socket = socket(AF_INET, SOCK_DGRAM)
+    udp_socket.bind((serverHost, udp_serverPort))
+    transferService = receiveVideoUDP(udp_socket, clientSocket)
 
-    # Thread for UDP
-    addressUDP = (serverHost, udp_serverPort)
-    receiver_thread = Thread(target=receiveVideoUDP, args=(addressUDP, clientSocket), daemon=True)
-    receiver_thread.start()
+    # A single event loop waits on stdin, the server connection and the UDP socket at once,
+    # so input, server responses and video transfers are each handled as soon as they arrive
+    selector = selectors.DefaultSelector()
+    selector.register(sys.stdin, selectors.EVENT_READ, "stdin")
+    selector.register(clientSocket, selectors.EVENT_READ, "tcp")
+    selector.register(udp_socket, selectors.EVENT_READ, "udp")
 
-    # Set of possible commands
-    possibleCommands = {'/msgto', '/activeuser', '/creategroup', '/joingroup', '/groupmsg', '/p2pvideo', '/logout'}
+    frameReader = FrameReader(clientSocket)
+    partialLine = b""
 
     try:
 
         print("\nPlease login\n")
 
-        # Loop listening to server
-        while True:
-            
-            # Exit program if user is blocked
-            if blocked:
-                clientSocket.close()
-                sys.exit(1)
-            
-            #=================== Login loop ======================#
-            
-            while not loggedIn:
-
-                if not responseLoading and not loggedIn:
-                    username = input("Username: ")
-                    password = input("Password: ")
-
-                    auth_request = {
-                        "header": "login",
-                        "username": username,
-                        "password": password,
-                        "udp_port": udp_serverPort
-                    }
-
-                    responseLoading = True
-                    clientSocket.sendall(json.dumps(auth_request).encode())
-
-
-            # Force sleep to let "Welcome" message resolve first
-            time.sleep(0.1)
-
-            #=================== Possible commands loop ======================#
-            
-            # Exit program if user logs out
-            if sessionEnded:
-                clientSocket.close()
-                break
-
-            # Process user input. If return userInput after processing is null,
-            # We're still waiting for server responses to be processed. Start loop again.
-            userInput = nonBlockInput("\nEnter one of the following commands (/msgto, /activeuser, /creategroup, /joingroup, /groupmsg, /p2pvideo, /logout): ")
-            if not userInput:
-                continue
-       
-            # Get input arguments
-            inputArgs = userInput.split()
-            commandName = inputArgs[0]
-
-            # Nonsensical command
-            if commandName not in possibleCommands:
-                print("Error: Invalid command.\n")
-                continue
-
-            # Catch command usage errors:
-            try:
-                commandUsageHandler(commandName, inputArgs)
-            except ValueError as e:
-                print(e)
-                continue           
-
-            # /activeuser
-            if commandName == "/activeuser":
-
-                activerUser_request = {
-                    "header": "activeUser"
-                }
-
-                clientSocket.sendall(json.dumps(activerUser_request).encode())
-                continue
-
-            # /msgto
-            elif commandName == '/msgto':
-
-                recipient, message = inputArgs[1], ' '.join(inputArgs[2:])
-
-                msg_request = {
-                    "header": "sendMessage",
-                    "sender": username,
-                    "recipient": recipient,
-                    "message": message
-                }
-                clientSocket.sendall(json.dumps(msg_request).encode())
-
-            # /creategroup
-            elif commandName == '/creategroup':
-                
-                groupName = inputArgs[1]
-                users = inputArgs[2:]
-
-                createGroup_request = {
-                    "header": "createGroup",
-                    "groupName": groupName,
-                    "users": users
-                }
-                clientSocket.sendall(json.dumps(createGroup_request).encode())
-
-            # /joingroup
-            elif commandName == '/joingroup':
-                
-                groupName = inputArgs[1]
-
-                joinGroup_request = {
-                    "header": "joinGroup",
-                    "groupName": groupName,
-                }
-                clientSocket.sendall(json.dumps(joinGroup_request).encode())
-
-            # /groupmsg
-            elif commandName == '/groupmsg':
-
-                groupName, message = inputArgs[1], ' '.join(inputArgs[2:])
-                
-                messageGroup_request = {
-                    "header": "messageGroup",
-                    "groupName": groupName,
-                    "message": message
-                }
-                clientSocket.sendall(json.dumps(messageGroup_request).encode())
-
-
-            # /p2pvideo
-            elif commandName == '/p2pvideo':
-
-                audience, filename = inputArgs[1], inputArgs[2]
-                sendVideoUDP(username, audience, filename)
-
-            # /logout
-            elif commandName == '/logout':
-
-                logout_request = {
-                    "header": "logout"
-                }
-
-                clientSocket.sendall(json.dumps(logout_request).encode())
-
-            else:
-                print("\nSorry, an uncaught error has occured.\n")     
+        # Exit program if user logs out, is blocked or the connection ends
+        while not sessionEnded and not blocked:
+
+            showPrompt()
+
+            # Only waits with a timeout while a video transfer needs its acks and timers serviced
+            for key, _ in selector.select(transferService.timeout()):
+
+                if key.data == "tcp":
 
+                    # A single read may hold several responses
+                    responses = frameReader.recvFrames()
+
+                    if responses is None:
+                        print("\nThe server closed the connection.\n")
+                        return
+
+                    for response in responses:
+                        handleResponse(response)
+
+                elif key.data == "udp":
+                    transferService.receive()
+
+                else:
+                    data = os.read(sys.stdin.fileno(), 4096)
+
+                    # End of input
+                    if not data:
+                        return
+
+                    *lines, partialLine = (partialLine + data).split(b"\n")
+                    inputLines.extend(line.decode(errors="replace").rstrip() for line in lines)
+
+            transferService.tickIfDue()
+            handleInput(clientSocket, udp_serverPort)
 
     except KeyboardInterrupt as error:
         print("Client socket is now closed.")
+    except (ConnectionError, ValueError) as e:
+        print(f"\nError receiving data: {e}\n")
     finally:
+        transferService.close()
+        selector.close()
+        udp_socket.close()
         clientSocket.close()
         exit(0)
 
 
-    
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,490 @@
+# Written by Vimukthi Herath
+
+import os
+import asyncio
+from itertools import count
+from concurrent.futures import Future, ThreadPoolExecutor
+from socket import socket, create_connection, AF_INET, SOCK_DGRAM, SHUT_RDWR
+from threading import Thread, Lock
+from frameHandlers import FrameReader, encodeFrame, RECV_SIZE
+from transferHandlers import TransferSender, TransferService
+from logHandlers import logException
+
+# Headless clients for programs that talk to the server directly: bots, integration services and load tests.
+#
+# Every request method returns a future for the server's reply, so requests can be pipelined.
+# Each request carries a requestId that the server echoes in its reply, which resolves the matching future.
+# Frames the server pushes unprompted (direct and group messages) carry no requestId; they go to the
+# onMessage callback, and on the asyncio client to the messages() iterator too.
+
+# Frames the asyncio client holds for messages(). A program that only uses onMessage never reads them,
+# so once this many are waiting the oldest is dropped for each new one.
+INCOMING_DEPTH = 1024
+
+
+# Request building and reply matching shared by the threaded and asyncio clients;
+# subclasses only provide how frames are sent and how futures are created and resolved.
+class MessengerClientBase:
+
+    def __init__(self, onMessage=None, onFileReceived=None, onDisconnect=None):
+        self.onMessage = onMessage # onMessage(frame) for every "message" and "groupMessage" frame
+        self.onFileReceived = onFileReceived # onFileReceived(presenter, outputName) once a /p2pvideo file has arrived
+        self.onDisconnect = onDisconnect # onDisconnect(error) when the connection ends; error is None for a clean close
+
+        self.username = None
+        self.loggedIn = False
+        self.udpPort = 0 # Advertised to other users for /p2pvideo; 0 if this client doesn't receive files
+        self.activeUserInfo = {} # Stores { username: (host, udpPort) } from the last active user list
+        self.requestIds = count(1)
+        self.pending = {} # Stores { requestId: future } for requests awaiting their reply
+        self.closed = False
+
+
+    def login(self, username, password):
+        self.username = username
+        return self.request({
+            "header": "login",
+            "username": username,
+            "password": password,
+            "udp_port": self.udpPort
+        })
+
+
+    def sendMessage(self, recipient, message):
+        return self.request({
+            "header": "sendMessage",
+            "sender": self.username,
+            "recipient": recipient,
+            "message": message
+        })
+
+
+    # Resolves to a confirmation whose "recipients" maps each user to "sent", "queued" (offline), "full" or "unknown"
+    def sendBatchMessage(self, recipients, message):
+        return self.request({
+            "header": "sendBatchMessage",
+            "sender": self.username,
+            "recipients": list(recipients),
+            "message": message
+        })
+
+
+    def createGroup(self, groupName, users):
+        return self.request({
+            "header": "createGroup",
+            "groupName": groupName,
+            "users": list(users)
+        })
+
+
+    def joinGroup(self, groupName):
+        return self.request({
+            "header": "joinGroup",
+            "groupName": groupName
+        })
+
+
+    def groupMessage(self, groupName, message):
+        return self.request({
+            "header": "messageGroup",
+            "groupName": groupName,
+            "message": message
+        })
+
+
+    # Pages back through a conversation with peer, or through a group's messages, newest first.
+    # since and until are unix times; pass the reply's nextCursor as cursor for the next page (it is None on the last one).
+    # Resolves to { "success", "messages": [{ seq, timeSent, from, message }, ...], "nextCursor" }
+    def history(self, peer=None, groupName=None, since=None, until=None, limit=50, cursor=None):
+        return self.request({
+            "header": "history",
+            "peer": peer,
+            "groupName": groupName,
+            "since": since,
+            "until": until,
+            "limit": limit,
+            "cursor": cursor
+        })
+
+
+    # Resolves to a list of { username, address, loginTime, udpPort } for the other online users
+    def activeUsers(self):
+        return self.request({"header": "activeUser"})
+
+
+    def logout(self):
+        return self.request({"header": "logout"})
+
+
+    # Resolves the request this frame replies to, or passes the frame on as an incoming message
+    def handleFrame(self, frame):
+
+        future = self.pending.pop(frame.get("requestId"), None)
+
+        if future is None:
+            if frame.get("header") in ("message", "groupMessage"):
+                self.deliver(frame)
+
+            # Messages queued while this user was offline, delivered as one frame after login
+            elif frame.get("header") == "offlineMessages":
+                for message in frame["messages"]:
+                    self.deliver(message)
+            return
+
+        header = frame["header"]
+
+        if header == "login":
+            self.loggedIn = frame["success"]
+
+        elif header == "logout" and frame["success"]:
+            self.loggedIn = False
+
+        elif header == "activeUser":
+            frame = self.parseUserList(frame["userList"])
+
+        self.resolve(future, frame)
+
+
+    # Parses the server's "user; address; active since time; port." lines, remembering each user's UDP address
+    def parseUserList(self, userList):
+
+        users = []
+
+        for line in userList:
+            username, address, since, udpPort = line.strip().split('; ')
+            udpPort = int(udpPort.strip('.'))
+
+            self.activeUserInfo[username] = (address, udpPort)
+            users.append({
+                "username": username,
+                "address": address,
+                "loginTime": since.replace("active since ", "", 1),
+                "udpPort": udpPort,
+            })
+
+        return users
+
+
+    # Sends a file to an online user over UDP; blocks until the transfer is done
+    # Returns the finished TransferSender, whose resumedChunks shows whether an earlier attempt was picked up
+    def transferFile(self, username, path, filename=None):
+
+        if username not in self.activeUserInfo:
+            raise ValueError(f"{username} is not in the active user list")
+
+        sender = TransferSender(self.activeUserInfo[username], path, self.username, filename or os.path.basename(path))
+        sender.send()
+        return sender
+
+
+    # Fails every request still waiting for a reply once the connection is gone
+    def connectionLost(self, error):
+
+        self.closed = True
+        self.loggedIn = False
+
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            self.fail(future, error or ConnectionError("Connection to the server closed"))
+
+        if self.onDisconnect:
+            self.onDisconnect(error)
+
+
+    def request(self, request):
+        raise NotImplementedError
+
+
+    def resolve(self, future, result):
+        raise NotImplementedError
+
+
+    def fail(self, future, error):
+        raise NotImplementedError
+
+
+    # An exception from the callback is logged rather than ending the reader, which every reply depends on
+    def deliver(self, frame):
+        if self.onMessage:
+            try:
+                self.onMessage(frame)
+            except Exception:
+                logException("onMessageFailed", user=self.username, header=frame.get("header"))
+
+
+
+# Client for threaded programs.
+# A reader thread resolves the concurrent.futures.Future returned by each request and runs the
+# onMessage callback, so callbacks must not block on this client's own futures.
+class MessengerClient(MessengerClientBase):
+
+    # udpPort: local UDP port for receiving /p2pvideo files (0 picks a free one), or None not to receive files
+    def __init__(self, host, port, udpPort=None, onMessage=None, onFileReceived=None, onDisconnect=None, transferWorkers=2):
+        MessengerClientBase.__init__(self, onMessage, onFileReceived, onDisconnect)
+
+        self.sock = create_connection((host, port))
+        self.frameReader = FrameReader(self.sock)
+        self.sendLock = Lock() # Held while registering a future and sending its request, so a reply never arrives before its future exists
+        self.transfers = ThreadPoolExecutor(max_workers=transferWorkers, thread_name_prefix="transfer")
+
+        self.udpSocket = None
+        self.transferService = None
+
+        if udpPort is not None:
+            self.udpSocket = socket(AF_INET, SOCK_DGRAM)
+            self.udpSocket.bind((self.sock.getsockname()[0], udpPort))
+            self.udpPort = self.udpSocket.getsockname()[1]
+            self.transferService = TransferService(self.udpSocket, self.onFileReceived)
+            Thread(target=self.transferService.serveForever, name="transfer-receiver", daemon=True).start()
+
+        self.reader = Thread(target=self.readLoop, name="client-reader", daemon=True)
+        self.reader.start()
+
+
+    def request(self, request):
+
+        future = Future()
+
+        with self.sendLock:
+
+            if self.closed:
+                future.set_exception(ConnectionError("Connection to the server closed"))
+                return future
+
+            request["requestId"] = next(self.requestIds)
+            self.pending[request["requestId"]] = future
+            self.sock.sendall(encodeFrame(request))
+
+        return future
+
+
+    # Sends a file on a transfer worker thread, looking up the user's address first if it isn't known
+    def sendFile(self, username, path, filename=None):
+
+        def transfer():
+            if username not in self.activeUserInfo:
+                self.activeUsers().result()
+            return self.transferFile(username, path, filename)
+
+        return self.transfers.submit(transfer)
+
+
+    def readLoop(self):
+
+        error = None
+
+        try:
+            while (frames := self.frameReader.recvFrames()) is not None:
+                for frame in frames:
+                    self.handleFrame(frame)
+
+        except Exception as e:
+            # Closed locally by close()
+            if not self.closed:
+                error = e
+
+        # However the loop ended, nothing is left waiting on a reply that will never come
+        finally:
+            with self.sendLock:
+                self.connectionLost(error)
+
+
+    def resolve(self, future, result):
+        future.set_result(result)
+
+
+    def fail(self, future, error):
+        future.set_exception(error)
+
+
+    def close(self):
+
+        with self.sendLock:
+            self.closed = True
+
+        # Shutting the socket down wakes the reader thread with EOF
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.reader.join()
+        self.sock.close()
+
+        if self.transferService:
+            self.transferService.close()
+            self.udpSocket.close()
+
+        self.transfers.shutdown(wait=False)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+# Client for asyncio programs; create it with `await AsyncMessengerClient.connect(...)`.
+# Request methods return asyncio futures, and many clients can share one event loop.
+# Incoming messages can be read with `async for frame in client.messages()` as well as through onMessage;
+# messages() only yields the latest INCOMING_DEPTH frames if it falls that far behind.
+class AsyncMessengerClient(MessengerClientBase):
+
+    def __init__(self, reader, writer, udpSocket=None, onMessage=None, onFileReceived=None, onDisconnect=None):
+        MessengerClientBase.__init__(self, onMessage, onFileReceived, onDisconnect)
+
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.incoming = asyncio.Queue(INCOMING_DEPTH) # Frames for messages(), then None once the connection closes
+        self.droppedMessages = 0 # Frames dropped from incoming because messages() wasn't keeping up
+
+        self.udpSocket = udpSocket
+        self.transferService = None
+        self.transferTimer = None
+
+        # The UDP socket is served by the event loop itself: datagrams as they arrive, acks and timeouts on a timer
+        if udpSocket is not None:
+            self.udpPort = udpSocket.getsockname()[1]
+            udpSocket.setblocking(False)
+            self.transferService = TransferService(udpSocket, self.onFileReceived)
+            self.loop.add_reader(udpSocket, self.serviceTransfers)
+
+        self.readTask = self.loop.create_task(self.readLoop())
+
+
+    # udpPort: local UDP port for receiving /p2pvideo files (0 picks a free one), or None not to receive files
+    @classmethod
+    async def connect(cls, host, port, udpPort=None, onMessage=None, onFileReceived=None, onDisconnect=None):
+
+        reader, writer = await asyncio.open_connection(host, port)
+
+        udpSocket = None
+        if udpPort is not None:
+            udpSocket = socket(AF_INET, SOCK_DGRAM)
+            udpSocket.bind((writer.get_extra_info("sockname")[0], udpPort))
+
+        return cls(reader, writer, udpSocket, onMessage, onFileReceived, onDisconnect)
+
+
+    def request(self, request):
+
+        future = self.loop.create_future()
+
+        if self.closed:
+            future.set_exception(ConnectionError("Connection to the server closed"))
+            return future
+
+        request["requestId"] = next(self.requestIds)
+        self.pending[request["requestId"]] = future
+        self.writer.write(encodeFrame(request))
+        return future
+
+
+    # Waits until the requests written so far have been handed to the socket
+    async def drain(self):
+        await self.writer.drain()
+
+
+    # Sends a file on the loop's default executor, looking up the user's address first if it isn't known
+    def sendFile(self, username, path, filename=None):
+
+        async def transfer():
+            if username not in self.activeUserInfo:
+                await self.activeUsers()
+            return await self.loop.run_in_executor(None, self.transferFile, username, path, filename)
+
+        return self.loop.create_task(transfer())
+
+
+    # Incoming "message" and "groupMessage" frames, until the connection closes
+    async def messages(self):
+
+        while (frame := await self.incoming.get()) is not None:
+            yield frame
+
+
+    def deliver(self, frame):
+        self.queueIncoming(frame)
+        MessengerClientBase.deliver(self, frame)
+
+
+    def queueIncoming(self, item):
+
+        if self.incoming.full():
+            self.incoming.get_nowait()
+            self.droppedMessages += 1
+
+        self.incoming.put_nowait(item)
+
+
+    async def readLoop(self):
+
+        frameReader = FrameReader()
+        error = None
+
+        try:
+            while data := await self.reader.read(RECV_SIZE):
+                for frame in frameReader.feed(data):
+                    self.handleFrame(frame)
+
+        except Exception as e:
+            error = e
+
+        # However the loop ended, nothing is left waiting on a reply that will never come
+        finally:
+            self.connectionLost(error)
+            self.queueIncoming(None)
+
+
+    def serviceTransfers(self):
+
+        self.transferService.receive()
+        self.transferService.tickIfDue()
+
+        if self.transferTimer:
+            self.transferTimer.cancel()
+
+        timeout = self.transferService.timeout()
+        self.transferTimer = self.loop.call_later(timeout, self.serviceTransfers) if timeout is not None else None
+
+
+    def resolve(self, future, result):
+        if not future.done():
+            future.set_result(result)
+
+
+    def fail(self, future, error):
+        if not future.done():
+            future.set_exception(error)
+
+
+    async def close(self):
+
+        self.closed = True
+        self.writer.close()
+
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+        await self.readTask
+
+        if self.transferService:
+            self.loop.remove_reader(self.udpSocket)
+            if self.transferTimer:
+                self.transferTimer.cancel()
+            self.transferService.close()
+            self.udpSocket.close()
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc):
+        await self.close()
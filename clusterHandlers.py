@@ -0,0 +1,429 @@
+# Written by Vimukthi Herath
+
+import os
+from queue import SimpleQueue
+from socket import socket, AF_UNIX, SOCK_STREAM, SHUT_RDWR
+from threading import Thread, Lock, current_thread
+from frameHandlers import FrameReader, encodeFrame
+from queueHandlers import OutboundQueue
+from dispatchHandlers import RequestError
+from logHandlers import logEvent, logException, DEBUG, INFO, WARNING
+
+# Cluster mode: several server processes (nodes) acting as one server.
+#
+# Each node holds its own client connections. Nodes tell each other about logins, logouts and group changes,
+# so every node knows which node each online user is connected to, and a message for a user on another node
+# is forwarded to that node over a bus instead of being sent to a local connection.
+#
+# A bus carries json events between nodes. bus.connect(nodeId, onEvent) joins a node to it and returns a
+# connection whose publish(event, to) sends an event to one node, or to every other node when to is None.
+# onEvent(fromNode, event) is called with each event for the node, in the order each sender published them;
+# events from the bus itself (e.g. nodeDown) have no fromNode.
+#   LocalBus:  nodes in one process, e.g. for tests
+#   SocketBus: nodes in separate processes, through a ClusterBroker listening on a Unix socket
+BUS_QUEUE_DEPTH = 65536 # Events that may wait to be written to one bus connection
+BUS_TIMEOUT = 30.0 # Seconds a full bus connection may hold up its sender before it is dropped
+
+
+# A node could not join the bus, e.g. because its name is taken
+class ClusterError(Exception):
+    pass
+
+
+
+# In-process bus: each connection gets its events on its own delivery thread, as it would from a socket.
+# Events are passed on as they are, not copied, so neither side may change one once it is published.
+class LocalBus:
+
+    def __init__(self):
+        self.connections = {} # Stores { nodeId: LocalBusConnection }
+        self.lock = Lock()
+
+
+    def connect(self, nodeId, onEvent):
+
+        with self.lock:
+
+            if nodeId in self.connections:
+                raise ClusterError(f"A node named {nodeId} is already on the bus")
+
+            connection = self.connections[nodeId] = LocalBusConnection(self, nodeId, onEvent)
+
+        return connection
+
+
+    def route(self, fromNode, event, to):
+
+        with self.lock:
+            if to is None:
+                targets = [connection for nodeId, connection in self.connections.items() if nodeId != fromNode]
+            else:
+                targets = [self.connections[to]] if to in self.connections else []
+
+        for connection in targets:
+            connection.inbox.put((fromNode, event))
+
+
+    def disconnect(self, nodeId):
+
+        with self.lock:
+            self.connections.pop(nodeId, None)
+
+        self.route(None, {"header": "nodeDown", "node": nodeId}, None)
+
+
+
+class LocalBusConnection:
+
+    def __init__(self, bus, nodeId, onEvent):
+        self.bus = bus
+        self.nodeId = nodeId
+        self.onEvent = onEvent
+        self.inbox = SimpleQueue() # Stores (fromNode, event), or None once the connection is closed
+
+        self.thread = Thread(target=self.deliveryLoop, name=f"bus-{nodeId}", daemon=True)
+        self.thread.start()
+
+
+    def publish(self, event, to=None):
+        self.bus.route(self.nodeId, event, to)
+
+
+    def deliveryLoop(self):
+        while (item := self.inbox.get()) is not None:
+            self.onEvent(*item)
+
+
+    def close(self):
+
+        self.bus.disconnect(self.nodeId)
+        self.inbox.put(None)
+
+        # close() may be called by an event handler, on the delivery thread itself
+        if self.thread is not current_thread():
+            self.thread.join()
+
+
+
+# Bus between processes, through the ClusterBroker listening on socketPath
+class SocketBus:
+
+    def __init__(self, socketPath):
+        self.socketPath = socketPath
+
+
+    def connect(self, nodeId, onEvent):
+        return SocketBusConnection(self.socketPath, nodeId, onEvent)
+
+
+
+# A node's connection to the broker.
+# Events are written by an outbound queue's writer thread and read on a reader thread, so publish() never
+# waits on the socket. If the broker goes away, onEvent gets a busClosed event.
+class SocketBusConnection:
+
+    def __init__(self, socketPath, nodeId, onEvent):
+        self.nodeId = nodeId
+        self.onEvent = onEvent
+        self.closing = False
+
+        self.sock = socket(AF_UNIX, SOCK_STREAM)
+        self.sock.connect(socketPath)
+        self.frameReader = FrameReader(self.sock)
+
+        # The broker answers the node's hello before relaying anything to it
+        self.sock.sendall(encodeFrame({"header": "hello", "node": nodeId}))
+
+        frames = []
+        while not frames:
+            frames = self.frameReader.recvFrames()
+            if frames is None:
+                self.sock.close()
+                raise ClusterError("The cluster broker closed the connection")
+
+        reply = frames.pop(0)["event"]
+
+        if reply["header"] != "welcome":
+            self.sock.close()
+            raise ClusterError(reply.get("message", "The cluster broker refused the node"))
+
+        self.outbound = OutboundQueue(self.sock, BUS_QUEUE_DEPTH, "backpressure", BUS_TIMEOUT)
+
+        self.thread = Thread(target=self.readerLoop, args=(frames,), name="bus-reader", daemon=True)
+        self.thread.start()
+
+
+    def publish(self, event, to=None):
+        self.outbound.put(encodeFrame({"to": to, "event": event}))
+
+
+    def readerLoop(self, frames):
+
+        try:
+            while frames is not None:
+                for envelope in frames:
+                    self.onEvent(envelope["from"], envelope["event"])
+                frames = self.frameReader.recvFrames()
+
+        except (OSError, ValueError):
+            pass
+
+        if not self.closing:
+            self.onEvent(None, {"header": "busClosed"})
+
+
+    # Sends any events still queued, then leaves the bus
+    def close(self):
+
+        self.closing = True
+        self.outbound.close()
+        self.outbound.writer.join(BUS_TIMEOUT)
+
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.thread.join()
+        self.sock.close()
+
+
+
+# Relays events between the nodes connected to its Unix socket, one thread per node.
+# Every event is stamped with the node it came from; a node's events reach each other node in the order
+# they were published. When a node disconnects, the others are sent a nodeDown event.
+class ClusterBroker:
+
+    def __init__(self, socketPath):
+        self.socketPath = socketPath
+        self.nodes = {} # Stores { nodeId: OutboundQueue }
+        self.lock = Lock()
+
+        # A socket file left by an earlier run would make the bind fail
+        try:
+            os.remove(socketPath)
+        except FileNotFoundError:
+            pass
+
+        self.listener = socket(AF_UNIX, SOCK_STREAM)
+        self.listener.bind(socketPath)
+        self.listener.listen()
+
+
+    def serveForever(self):
+
+        while True:
+            try:
+                nodeSocket, _ = self.listener.accept()
+            except OSError:
+                return
+
+            Thread(target=self.serveNode, args=(nodeSocket,), name="broker-node", daemon=True).start()
+
+
+    def serveNode(self, nodeSocket):
+
+        frameReader = FrameReader(nodeSocket)
+        outbound = None
+        nodeId = None
+
+        try:
+            frames = []
+            while not frames:
+                frames = frameReader.recvFrames()
+                if frames is None:
+                    return
+
+            hello = frames.pop(0)
+            outbound = OutboundQueue(nodeSocket, BUS_QUEUE_DEPTH, "backpressure", BUS_TIMEOUT)
+
+            if not isinstance(hello, dict) or not isinstance(hello.get("node"), str):
+                outbound.put(encodeFrame({"from": None, "event": {"header": "refused", "message": "Expected a hello"}}))
+                return
+
+            with self.lock:
+                if hello["node"] not in self.nodes:
+                    nodeId = hello["node"]
+                    self.nodes[nodeId] = outbound
+                    outbound.put(encodeFrame({"from": None, "event": {"header": "welcome", "nodes": list(self.nodes)}}))
+
+            if nodeId is None:
+                outbound.put(encodeFrame({"from": None, "event": {"header": "refused", "message": f"A node named {hello['node']} is already in the cluster"}}))
+                return
+
+            logEvent(INFO, "nodeJoined", node=nodeId, nodes=len(self.nodes))
+
+            while frames is not None:
+                for envelope in frames:
+                    self.relay(nodeId, envelope.get("to"), envelope.get("event"))
+                frames = frameReader.recvFrames()
+
+        except (OSError, ValueError) as e:
+            logEvent(WARNING, "nodeConnectionFailed", node=nodeId, error=e)
+
+        finally:
+            if nodeId is not None:
+                with self.lock:
+                    del self.nodes[nodeId]
+                self.relay(None, None, {"header": "nodeDown", "node": nodeId})
+                logEvent(INFO, "nodeLeft", node=nodeId, nodes=len(self.nodes))
+
+            # Let the writer send what is queued (e.g. a refusal), then stop
+            if outbound:
+                outbound.close()
+                outbound.writer.join(BUS_TIMEOUT)
+            nodeSocket.close()
+
+
+    # Sends an event to one node, or every node but its sender; the frame is encoded once for all of them
+    def relay(self, fromNode, to, event):
+
+        data = encodeFrame({"from": fromNode, "event": event})
+
+        with self.lock:
+            if to is None:
+                targets = [outbound for nodeId, outbound in self.nodes.items() if nodeId != fromNode]
+            else:
+                targets = [self.nodes[to]] if to in self.nodes else []
+
+        # The node may have just left; its peers drop its users when they get the nodeDown event
+        if to is not None and not targets:
+            logEvent(DEBUG, "eventDropped", node=to, event=event.get("header") if isinstance(event, dict) else None)
+
+        for outbound in targets:
+            outbound.put(data)
+
+
+    def close(self):
+
+        self.listener.close()
+
+        try:
+            os.remove(self.socketPath)
+        except FileNotFoundError:
+            pass
+
+
+
+# Where the users logged in on other nodes are connected: { username: nodeId }.
+# Users logged in on this node are not listed; the server has their sessions.
+class ClusterDirectory:
+
+    def __init__(self):
+        self.users = {}
+        self.lock = Lock()
+
+
+    def locate(self, username):
+        return self.users.get(username)
+
+
+    def userOnline(self, username, nodeId):
+        with self.lock:
+            self.users[username] = nodeId
+
+
+    # Removes a user if they are still listed on nodeId (or on any node, if nodeId is None)
+    # Returns whether they were
+    def userOffline(self, username, nodeId=None):
+
+        with self.lock:
+
+            if username not in self.users or nodeId not in (None, self.users[username]):
+                return False
+
+            del self.users[username]
+            return True
+
+
+    # Removes every user on a node, or on every node if nodeId is None
+    # Returns the users removed
+    def nodeDown(self, nodeId=None):
+
+        with self.lock:
+            removed = [username for username, node in self.users.items() if nodeId in (None, node)]
+            for username in removed:
+                del self.users[username]
+
+        return removed
+
+
+    def __len__(self):
+        return len(self.users)
+
+
+
+# This server's place in a cluster: its bus connection, the cluster directory, and the handlers for
+# events from other nodes, a Dispatcher called as handler(fromNode, *fields).
+# Events are held until start(), which takes the function handlers are run with: schedule(handle, fromNode, event).
+# By default they run on the bus's thread; an asyncio server passes its loop's call_soon_threadsafe.
+class ClusterNode:
+
+    def __init__(self, bus, nodeId, events):
+        self.nodeId = nodeId
+        self.events = events
+        self.directory = ClusterDirectory()
+
+        self.schedule = None
+        self.pending = [] # Stores (fromNode, event) received before start()
+        self.lock = Lock()
+
+        self.connection = bus.connect(nodeId, self.receive)
+
+
+    def locate(self, username):
+        return self.directory.locate(username)
+
+
+    # Runs handlers from now on, starting with any events already received, and asks the other nodes
+    # for who is logged in on them and the groups they know of
+    def start(self, schedule=None):
+
+        with self.lock:
+            self.schedule = schedule or (lambda handle, *args: handle(*args))
+
+            for fromNode, event in self.pending:
+                self.schedule(self.handle, fromNode, event)
+            self.pending = []
+
+        self.publish({"header": "syncRequest"})
+
+
+    # Called on the bus's thread
+    def receive(self, fromNode, event):
+
+        # Under the lock, so events held before start() are handled before any later ones
+        with self.lock:
+            if self.schedule is None:
+                self.pending.append((fromNode, event))
+            else:
+                self.schedule(self.handle, fromNode, event)
+
+
+    def handle(self, fromNode, event):
+
+        try:
+            self.events.dispatch(fromNode, event)
+        except RequestError as e:
+            logEvent(WARNING, "invalidClusterEvent", node=fromNode, error=e)
+        except Exception:
+            logException("clusterEventFailed", node=fromNode, event=event.get("header"))
+
+
+    def publish(self, event, to=None):
+        self.connection.publish(event, to)
+
+
+    # Sends a frame to users logged in on another node, which relays it to their sessions
+    def forward(self, nodeId, recipients, frame):
+        self.publish({"header": "deliver", "recipients": recipients, "frame": frame}, nodeId)
+
+
+    # forward() for { nodeId: [recipient, ...] }, one event per node
+    def forwardAll(self, forwards, frame):
+        for nodeId, recipients in forwards.items():
+            self.forward(nodeId, recipients, frame)
+
+
+    def close(self):
+        self.connection.close()
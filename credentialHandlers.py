@@ -0,0 +1,129 @@
+# Written by Vimukthi Herath
+
+import os
+import sys
+import hashlib
+import hmac
+import secrets
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+# Stored passwords have the form: pbkdf2_sha256$ITERATIONS$SALT$DIGEST
+HASH_SCHEME = "pbkdf2_sha256"
+HASH_ITERATIONS = 200000
+
+# Plain text passwords still found in credentials.txt are only salted and hashed once when loaded,
+# so a large legacy file doesn't make startup slow. Run this file to rewrite them at full strength.
+LEGACY_ITERATIONS = 1
+
+
+# Hashes a password with a random salt
+def hashPassword(password, iterations=HASH_ITERATIONS):
+
+    salt = secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), iterations).hex()
+
+    return f"{HASH_SCHEME}${iterations}${salt}${digest}"
+
+
+# Checks a password against a stored hash in constant time
+def checkPassword(password, storedHash):
+
+    _, iterations, salt, digest = storedHash.split("$")
+    candidate = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), int(iterations)).hex()
+
+    return hmac.compare_digest(candidate, digest)
+
+
+# Username -> password hash index of credentials.txt.
+# The file is read once, then again only when its modification time changes.
+# Password checks run on a small worker pool, away from the threads and event loop serving connections.
+class CredentialStore:
+
+    def __init__(self, path="credentials.txt", workers=2):
+        self.path = path
+        self.users = {}
+        self.mtime = None
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="credentials")
+
+        self.reload()
+
+
+    # Reloads the index if the file has changed since it was last read
+    def reload(self):
+
+        mtime = os.stat(self.path).st_mtime_ns
+
+        if mtime == self.mtime:
+            return
+
+        with self.lock:
+
+            # Another worker may have reloaded while this one waited for the lock
+            if mtime == self.mtime:
+                return
+
+            users = {}
+
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+
+                    user, pw = line.strip().split()
+
+                    if not pw.startswith(HASH_SCHEME + "$"):
+                        pw = hashPassword(pw, LEGACY_ITERATIONS)
+
+                    users[user] = pw
+
+            self.users = users
+            self.mtime = mtime
+
+
+    # Runs on a worker thread
+    # Returns a tuple: (validUser, validLogin)
+    def check(self, username, password):
+
+        self.reload()
+
+        storedHash = self.users.get(username)
+
+        if storedHash is None:
+            return False, False
+
+        return True, checkPassword(password, storedHash)
+
+
+    # Returns a concurrent.futures.Future resolving to (validUser, validLogin)
+    def verify(self, username, password):
+        return self.executor.submit(self.check, username, password)
+
+
+    # Whether a user exists, as of the last reload
+    def __contains__(self, username):
+        return username in self.users
+
+
+
+# Rewrites any plain text passwords in a credentials file as full strength hashes
+def main():
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "credentials.txt"
+
+    with open(path, 'r') as f:
+        lines = [line.strip().split() for line in f if line.strip()]
+
+    with open(path + ".tmp", 'w') as f:
+        for user, pw in lines:
+            if not pw.startswith(HASH_SCHEME + "$"):
+                pw = hashPassword(pw)
+            f.write(f"{user} {pw}\n")
+
+    os.replace(path + ".tmp", path)
+    print(f"Hashed {len(lines)} credentials in {path}")
+
+
+if __name__ == "__main__":
+    main()
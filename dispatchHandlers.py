@@ -0,0 +1,249 @@
+# Written by Vimukthi Herath
+
+import inspect
+from bisect import bisect_left
+from time import perf_counter
+from threading import Lock
+
+# Upper bounds, in seconds, of the request latency histogram buckets; the last bucket has no bound
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# A request was rejected before it reached a handler
+class RequestError(ValueError):
+    pass
+
+
+# The request's header has no handler
+class UnknownRequestError(RequestError):
+    pass
+
+
+# Schema entry for a request field that may be left out; it is passed to the handler as default
+class Optional:
+
+    def __init__(self, fieldType, default=None):
+        self.fieldType = fieldType
+        self.default = default
+
+
+# Schema entry for a field holding a list whose items are all of itemType
+class ListOf:
+
+    def __init__(self, itemType):
+        self.itemType = itemType
+
+
+# Number fields accept ints and floats
+Number = (int, float)
+
+
+# Checks a field's value against its schema entry
+def matchesType(value, fieldType):
+
+    if isinstance(fieldType, ListOf):
+        return isinstance(value, list) and all(matchesType(item, fieldType.itemType) for item in value)
+
+    # json true and false are not numbers
+    if isinstance(value, bool) and fieldType is not bool:
+        return False
+
+    return isinstance(value, fieldType)
+
+
+def typeName(fieldType):
+
+    if isinstance(fieldType, ListOf):
+        return f"a list whose items are each {typeName(fieldType.itemType)}"
+
+    if fieldType == Number:
+        return "a number"
+
+    return {str: "a string", int: "an integer", bool: "true or false"}.get(fieldType, fieldType.__name__)
+
+
+# Count, error count and latency histogram for every request header handled.
+# record() is the timing hook a Dispatcher calls after each request; it is safe to call from any thread.
+class CommandStats:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.commands = {} # Stores { header: [count, errors, totalSeconds, bucketCounts] }
+        self.lock = Lock()
+
+
+    def record(self, header, seconds, failed):
+
+        bucket = bisect_left(self.buckets, seconds)
+
+        with self.lock:
+
+            stats = self.commands.get(header)
+            if stats is None:
+                stats = self.commands[header] = [0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+
+            stats[0] += 1
+            stats[1] += failed
+            stats[2] += seconds
+            stats[3][bucket] += 1
+
+
+    # Latency a fraction of requests finished within, as the upper bound of the bucket it falls in
+    def percentile(self, bucketCounts, count, fraction):
+
+        target = fraction * count
+        seen = 0
+
+        for bound, bucketCount in zip(self.buckets, bucketCounts):
+            seen += bucketCount
+            if seen >= target:
+                return bound
+
+        return float("inf")
+
+
+    # Returns { header: { count, errors, totalSeconds, meanSeconds, p50, p99, p999, buckets } }, where
+    # the percentiles are bucket bounds in seconds and buckets lists (upper bound, cumulative count) pairs
+    def snapshot(self):
+
+        with self.lock:
+            commands = {header: (count, errors, totalSeconds, list(bucketCounts))
+                        for header, (count, errors, totalSeconds, bucketCounts) in self.commands.items()}
+
+        snapshot = {}
+
+        for header, (count, errors, totalSeconds, bucketCounts) in commands.items():
+
+            cumulative = []
+            seen = 0
+            for bound, bucketCount in zip((*self.buckets, float("inf")), bucketCounts):
+                seen += bucketCount
+                cumulative.append((bound, seen))
+
+            snapshot[header] = {
+                "count": count,
+                "errors": errors,
+                "totalSeconds": totalSeconds,
+                "meanSeconds": totalSeconds / count,
+                "p50": self.percentile(bucketCounts, count, 0.5),
+                "p99": self.percentile(bucketCounts, count, 0.99),
+                "p999": self.percentile(bucketCounts, count, 0.999),
+                "buckets": cumulative,
+            }
+
+        return snapshot
+
+
+    # One line per header, busiest first
+    def summary(self):
+
+        lines = []
+
+        for header, stats in sorted(self.snapshot().items(), key=lambda item: -item[1]["totalSeconds"]):
+            lines.append(f"{header}: {stats['count']} requests, {stats['errors']} errors, "
+                         f"mean {stats['meanSeconds'] * 1000:.3f} ms, p50 <= {stats['p50'] * 1000:g} ms, "
+                         f"p99 <= {stats['p99'] * 1000:g} ms, total {stats['totalSeconds']:.3f} s")
+
+        return lines
+
+
+
+# Table of request handlers keyed by request header.
+# Handlers are registered with the fields they take, in the order they take them, and each field's type;
+# a request is checked against its handler's schema before the handler is called, and every call is
+# timed and passed to the timing hooks as hook(header, seconds, failed).
+class Dispatcher:
+
+    def __init__(self, hooks=()):
+        self.handlers = {} # Stores { header: (handler, schema) }
+        self.hooks = list(hooks)
+
+
+    # Decorator registering a function as the handler for a header, e.g.
+    #   @requestHandlers.handler("joinGroup", groupName=str)
+    #   def joinGroup(self, groupname): ...
+    # The handler is called as handler(session, *fields); it may be a coroutine function if the
+    # dispatcher is only used with dispatchAsync.
+    def handler(self, header, **schema):
+
+        def register(function):
+            self.handlers[header] = (function, schema)
+            return function
+
+        return register
+
+
+    # A copy sharing this dispatcher's hooks, for a session type that replaces some handlers
+    def copy(self):
+
+        dispatcher = Dispatcher(self.hooks)
+        dispatcher.handlers = dict(self.handlers)
+
+        return dispatcher
+
+
+    def record(self, header, seconds, failed):
+        for hook in self.hooks:
+            hook(header, seconds, failed)
+
+
+    # Finds a request's handler and its arguments, or raises RequestError
+    def resolve(self, request):
+
+        header = request.get("header") if isinstance(request, dict) else None
+        entry = self.handlers.get(header) if isinstance(header, str) else None
+
+        if entry is None:
+            self.record("unknown", 0.0, True)
+            raise UnknownRequestError(f"Unknown request: {header}")
+
+        handler, schema = entry
+        args = []
+
+        for name, fieldType in schema.items():
+
+            value = request.get(name)
+
+            if isinstance(fieldType, Optional):
+                if value is None:
+                    args.append(fieldType.default)
+                    continue
+                fieldType = fieldType.fieldType
+
+            if not matchesType(value, fieldType):
+                self.record(header, 0.0, True)
+                raise RequestError(f"{header} requests need {name} to be {typeName(fieldType)}")
+
+            args.append(value)
+
+        return header, handler, args
+
+
+    # Runs a request's handler; raises RequestError if it has none or the request doesn't match its schema
+    def dispatch(self, session, request):
+
+        header, handler, args = self.resolve(request)
+        start = perf_counter()
+        failed = True
+
+        try:
+            handler(session, *args)
+            failed = False
+        finally:
+            self.record(header, perf_counter() - start, failed)
+
+
+    # dispatch() for the event loop; coroutine handlers are awaited, and timed until they finish
+    async def dispatchAsync(self, session, request):
+
+        header, handler, args = self.resolve(request)
+        start = perf_counter()
+        failed = True
+
+        try:
+            result = handler(session, *args)
+            if inspect.isawaitable(result):
+                await result
+            failed = False
+        finally:
+            self.record(header, perf_counter() - start, failed)
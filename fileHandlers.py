@@ -1,162 +1,414 @@
 # Written by Vimukthi Herath
 
+import os
 import time
 from datetime import datetime
+from threading import Thread, Lock, Condition
+from logHandlers import logEvent, ERROR
+from historyHandlers import indexRecord, indexPath, indexPaths, compactIndex, conversationKey, parseLogTime, escapeField
+from segmentHandlers import (allSegments, openSegment, segmentEntries, closeSegment, compressSegments,
+                             expiredSegments, deleteSegments, checkCompression)
 
-# Checks block status
-def userBlocked(username, allowedAttempts):
+FSYNC_POLICIES = ("always", "interval", "never")
 
-    currentTime = time.time()
+# Defaults for every log writer, set from the server options on startup
+logWriterOptions = {
+    "fsyncPolicy": "interval", # always: fsync every batch, interval: at most once per fsyncInterval, never: leave it to the OS
+    "fsyncInterval": 1.0,
+    "segmentBytes": 64 * 1024 * 1024, # Start a new segment once the active one is this large (0 = no size limit)
+    "segmentAge": 0, # Start a new segment once the active one's first entry is this many seconds old (0 = no age limit)
+    "compression": "none", # How closed segments are compressed: none, gzip or zstd
+    "retainSegments": 0, # Closed segments kept per log; older ones are deleted (0 = keep all)
+    "retainAge": 0, # Seconds a closed segment is kept after it was last written (0 = keep forever)
+}
 
-    arFile = "attempt_records.txt"
-    # Read file contents if exists / add user to attempts record if file doesn't exist
-    try:        
-        with open(arFile, 'r') as f:
-            lines = f.readlines()
+logWriters = {} # Stores { path: LogWriter }
+logWritersLock = Lock()
 
-        for line in lines:
-            user, attempts, lastAttemptTime = line.strip().split()
 
-            if user == username:
+# Append-only writer for a "N; timestamp; field; field..." log file.
+# The file stays open and the sequence number is kept in memory, so an entry costs O(1)
+# no matter how long the log is. Entries are queued and written in batches by a background flusher.
+# As each batch is written, the flusher appends the entries' offsets to the log's sidecar indexes
+# (see historyHandlers), which history queries binary search instead of scanning the log.
+# The file at path is only the active segment: once it is segmentBytes large or segmentAge old the
+# flusher closes it into the log's segment directory (see segmentHandlers) and starts a new one,
+# and a background thread compresses closed segments and deletes those past the retention limits.
+class LogWriter:
 
-                # > 10 seconds passed, no longer blocked
-                if currentTime - float(lastAttemptTime) > 10:
-                    return False
+    def __init__(self, path, fsyncPolicy="interval", fsyncInterval=1.0, segmentBytes=0, segmentAge=0,
+                 compression="none", retainSegments=0, retainAge=0):
 
-                # < 10 seconds + attempts exceeded
-                if int(attempts) >= allowedAttempts:
-                    return True
+        if fsyncPolicy not in FSYNC_POLICIES:
+            raise ValueError(f"Invalid fsync policy: {fsyncPolicy}")
 
-    except FileNotFoundError:
-        # Cant be blocked if file not found
-        return False
+        checkCompression(compression)
 
+        self.path = path
+        self.fsyncPolicy = fsyncPolicy
+        self.fsyncInterval = fsyncInterval
+        self.lastFsync = time.time()
+        self.unsynced = False # Whether entries have been written since the last fsync
 
+        self.segmentBytes = segmentBytes
+        self.segmentAge = segmentAge
+        self.compression = compression
+        self.retainSegments = retainSegments
+        self.retainAge = retainAge
 
-# Similar to block status, but writes updated values to file
-# Returns a tuple: (errorMessage, blockStatus)
-def handleIncorrectLogin(username, allowedAttempts):
+        self.condition = Condition()
+        self.pending = []
+        self.segmentFirstSeq = allSegments(path)[-1].firstSeq # First sequence number in the active segment
+        self.seqNumber = self.segmentFirstSeq - 1 + self.countEntries()
+        self.writtenSeqNumber = self.seqNumber
+        self.closed = False
 
-    arFile = "attempt_records.txt"
-    message = "Invalid Password. Please try again" # default error message
-    userFound = False
-    lines = []
-    currentTime = time.time()
-    blockStatus = False
+        self.file = open(path, 'ab')
+        self.offset = self.file.tell() # Where the next line will be written
+        self.segmentStarted = self.firstEntryTime() # Unix time of the active segment's first entry, None while it is empty
 
-    # Read file contents if exists / add user to attempts record if file doesn't exist
-    try:        
-        with open(arFile, 'r') as f:
-            lines = f.readlines()
-    except FileNotFoundError:
-        with open(arFile, 'w') as f:
-            # If the file was empty, we add the user with an attempt count of 1
-            f.write(f"{username} 1 {time.time()}\n")
-            return message, blockStatus
+        self.indexLock = Lock() # Held while indexes are appended to or compacted
+        self.indexFile = open(indexPath(path), 'ab')
+        self.catchUpIndex()
 
-    with open(arFile, 'w') as f:
-        for line in lines:
-            user, attempts, lastAttemptTime = line.strip().split()
-        
-            # User already has an entry in the attempts record
-            if user == username:
+        self.maintenanceLock = Lock() # Compression and retention passes run one at a time
+        self.maintenanceThreads = []
 
-                userFound = True
+        # Picks up compression or retention a previous run didn't finish, or whose settings have changed
+        if allSegments(path)[:-1]:
+            self.startMaintenance()
 
-                # If it's been more than 10 seconds, clear the last entry and set this attempt to the first attempt
-                if currentTime - float(lastAttemptTime) > 10:
-                    currentAttempt = 1
-                else:
-                    currentAttempt = int(attempts) + 1
+        self.flusher = Thread(target=self.flushLoop, name=f"log-flusher {path}", daemon=True)
+        self.flusher.start()
 
-                # Check no. of attempts
-                if currentAttempt == allowedAttempts:
-                    message = "Invalid Password. Your account has been blocked. Please try again later\n"
-                    blockStatus = True
-                # attempts exceeded < 10 seconds since last entry
-                elif currentAttempt > allowedAttempts:
-                    message = "Your account is blocked due to multiple login failures. Please try again later\n"
-                    blockStatus = True
 
-                attempts = currentAttempt
+    # Gets the number of entries in the active segment; the only time it is scanned
+    def countEntries(self):
 
-            # Write lines back to file
-            f.write(f"{username} {attempts} {time.time()}")
+        try:
+            with open(self.path, 'rb') as f:
+                return sum(1 for _ in segmentEntries(f, self.segmentFirstSeq))
+        except FileNotFoundError:
+            return 0
 
-        # If the user wasn't found in the records, add them to the records
-        if not userFound:
-            f.write(f"{username} 1 {time.time()}\n")
 
-    return message, blockStatus
+    def firstEntryTime(self):
 
+        with open(self.path, 'rb') as f:
+            line = f.readline()
 
-# Writes the active user to the userlog
-def userLogManager(username, client_address, client_udp_port):
+        try:
+            return parseLogTime(line.split(b"; ", 2)[1].decode()) if line else None
+        except (IndexError, ValueError):
+            return None
 
-    ulFile = "userlog.txt"
-    currentTime = datetime.now()
-    formattedTime = currentTime.strftime('%d %b %Y %H:%M:%S')
 
-    try:        
-        # Get the last sequence number
-        with open(ulFile, 'r') as f:
-            seqNumber = sum(1 for _ in f)
+    # Brings the whole-log index up to date with the log, for logs written before it existed
+    # or a crash between writing a batch and indexing it
+    def catchUpIndex(self):
 
-        # Append new user to userlog
-        with open(ulFile, 'a') as f:
-            f.write(f"{int(seqNumber)+1}; {formattedTime}; {username}; {client_address[0]}; {client_udp_port}\n")
+        size = self.indexFile.tell()
 
-    # Create the first entry
-    except FileNotFoundError:
-        with open(ulFile, 'w') as f:
-            # Add the user with an attempt count of 1
-            f.write(f"1; {formattedTime}; {username}; {client_address[0]}; {client_udp_port}\n")
+        # A torn record from a crash mid-write
+        if size % indexRecord.size:
+            size -= size % indexRecord.size
+            self.indexFile.truncate(size)
 
+        indexedSeq = 0
+        if size:
+            with open(indexPath(self.path), 'rb') as f:
+                f.seek(size - indexRecord.size)
+                indexedSeq = indexRecord.unpack(f.read(indexRecord.size))[0]
 
+        # An index that belongs to an older log
+        if indexedSeq > self.seqNumber:
+            indexedSeq = 0
+            self.indexFile.truncate(0)
 
-# Writes a message to the message log 
-def messageLogManager(username, message):
+        if indexedSeq == self.seqNumber:
+            return
 
-    ulFile = "messagelog.txt"
-    currentTime = datetime.now()
-    formattedTime = currentTime.strftime('%d %b %Y %H:%M:%S')
+        records = []
+        timestamp = 0.0
 
-    try:        
-        # Get the last sequence number
-        with open(ulFile, 'r') as f:
-            msgNumber = sum(1 for _ in f)
+        for segment in allSegments(self.path):
 
-        # Append new user to userlog
-        with open(ulFile, 'a') as f:
-            f.write(f"{int(msgNumber)+1}; {formattedTime}; {username}; {message}\n")
+            if segment.lastSeq is not None and segment.lastSeq <= indexedSeq:
+                continue
 
-    # Create the first entry
-    except FileNotFoundError:
-        with open(ulFile, 'w') as f:
-            # Add the user with an attempt count of 1
-            f.write(f"1; {formattedTime}; {username}; {message}\n")
+            with openSegment(segment.path) as f:
+                for seqNumber, offset, entry in segmentEntries(f, segment.firstSeq):
 
+                    # An entry without a readable time is indexed at the time of the one before it
+                    try:
+                        timestamp = parseLogTime(entry.split(b"; ", 2)[1].decode())
+                    except (IndexError, ValueError):
+                        pass
 
-# Writes a message to a groups message log 
-def groupMessageLogManager(groupname, username, message):
+                    if seqNumber > indexedSeq:
+                        records.append(indexRecord.pack(seqNumber, timestamp, offset, len(entry)))
 
-    ulFile = f"{groupname}_messagelog.txt"
+        self.indexFile.write(b"".join(records))
+        self.indexFile.flush()
+
+
+    # Queues an entry and returns its sequence number.
+    # conversations lists the conversation index files (besides the whole-log index) that should point at it.
+    def append(self, *fields, conversations=()):
+
+        currentTime = datetime.now()
+        formattedTime = currentTime.strftime('%d %b %Y %H:%M:%S')
+
+        with self.condition:
+            if self.closed:
+                raise ValueError(f"Log writer for {self.path} is closed")
+
+            self.seqNumber += 1
+            line = "; ".join([str(self.seqNumber), formattedTime, *map(escapeField, fields)]) + "\n"
+            self.pending.append((self.seqNumber, currentTime.timestamp(), line.encode(), conversations))
+            self.condition.notify_all()
+
+            return self.seqNumber
+
+
+    # Writes queued entries until the writer is closed
+    def flushLoop(self):
+
+        while True:
+
+            with self.condition:
+                while not self.pending and not self.closed:
+
+                    # Entries written since the last fsync are synced once the interval is up,
+                    # even if no more arrive, so an idle log is never behind by more than fsyncInterval
+                    if self.unsynced:
+                        remaining = self.lastFsync + self.fsyncInterval - time.time()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    else:
+                        self.condition.wait()
+
+                batch, self.pending = self.pending, []
+                batchSeqNumber = self.seqNumber
+                closing = self.closed
+
+            if batch:
+                self.file.write(b"".join(line for _, _, line, _ in batch))
+                self.file.flush()
+                self.sync(closing)
+                self.writeIndexes(batch)
+
+                if self.segmentStarted is None:
+                    self.segmentStarted = batch[0][1]
+
+                if not closing and self.segmentFull():
+                    self.rotate(batchSeqNumber)
+
+            elif self.unsynced:
+                self.sync(closing)
+
+            with self.condition:
+                self.writtenSeqNumber = batchSeqNumber
+                self.condition.notify_all()
+
+            if closing:
+                self.file.close()
+                return
+
+
+    # Appends index records for a batch that is now in the log file
+    def writeIndexes(self, batch):
+
+        records = []
+        conversationRecords = {} # Stores { conversation: [record, ...] }
+
+        for seqNumber, timestamp, line, conversations in batch:
+
+            record = indexRecord.pack(seqNumber, timestamp, self.offset, len(line))
+            records.append(record)
+
+            for conversation in conversations:
+                conversationRecords.setdefault(conversation, []).append(record)
+
+            self.offset += len(line)
+
+        with self.indexLock:
+
+            self.indexFile.write(b"".join(records))
+            self.indexFile.flush()
+
+            for conversation, records in conversationRecords.items():
+                path = indexPath(self.path, conversation)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'ab') as f:
+                    f.write(b"".join(records))
+
+
+    def segmentFull(self):
+        return ((self.segmentBytes and self.offset >= self.segmentBytes) or
+                (self.segmentAge and time.time() - self.segmentStarted >= self.segmentAge))
+
+
+    # Closes the active segment, which ends at lastSeq, and starts a new one
+    def rotate(self, lastSeq):
+
+        self.sync(True)
+        self.file.close()
+        closeSegment(self.path, self.segmentFirstSeq, lastSeq)
+
+        self.file = open(self.path, 'ab')
+        self.segmentFirstSeq = lastSeq + 1
+        self.offset = 0
+        self.segmentStarted = None
+
+        self.startMaintenance()
+
+
+    # Compression and retention run off the flusher thread, so writes carry on meanwhile
+    def startMaintenance(self):
+
+        self.maintenanceThreads = [thread for thread in self.maintenanceThreads if thread.is_alive()]
+
+        thread = Thread(target=self.maintainSegments, name=f"log-segments {self.path}", daemon=True)
+        self.maintenanceThreads.append(thread)
+        thread.start()
+
+
+    # Compresses closed segments, then deletes those the retention policy no longer keeps
+    def maintainSegments(self):
+
+        with self.maintenanceLock:
+
+            try:
+                if self.compression != "none":
+                    compressSegments(self.path, self.compression)
 
-    currentTime = datetime.now()
-    formattedTime = currentTime.strftime('%d %b %Y %H:%M:%S')
+                firstKept, expired = expiredSegments(self.path, self.retainSegments, self.retainAge)
 
-    try:
+                if not expired:
+                    return
 
-        # Get the last sequence number
-        with open(ulFile, 'r') as f:
-            msgNumber = sum(1 for _ in f)
+                # Index records go before the segments they point into, so a history query never finds a
+                # record whose segment is gone (one that mapped an index just before is retried)
+                with self.indexLock:
+                    self.indexFile.close()
+                    for path in indexPaths(self.path):
+                        compactIndex(path, firstKept)
+                    self.indexFile = open(indexPath(self.path), 'ab')
 
-        # Append new user to userlog
-        with open(ulFile, 'a') as f:
-            f.write(f"{int(msgNumber)+1}; {formattedTime}; {username}; {message}\n")
+                deleteSegments(expired)
+
+            except OSError as e:
+                logEvent(ERROR, "segmentMaintenanceFailed", log=self.path, error=e)
+
+
+    # fsyncs according to the writer's policy
+    def sync(self, force=False):
+
+        if self.fsyncPolicy == "never":
+            return
+
+        currentTime = time.time()
+
+        if force or self.fsyncPolicy == "always" or currentTime - self.lastFsync >= self.fsyncInterval:
+            os.fsync(self.file.fileno())
+            self.lastFsync = currentTime
+            self.unsynced = False
+        else:
+            self.unsynced = True
+
+
+    # Blocks until every entry queued so far is on disk
+    def flush(self):
+
+        with self.condition:
+            target = self.seqNumber
+            while self.writtenSeqNumber < target and self.flusher.is_alive():
+                self.condition.wait()
+
+
+    # Number of entries queued but not yet written
+    def lag(self):
+        with self.condition:
+            return self.seqNumber - self.writtenSeqNumber
+
+
+    # Writes anything still queued, then closes the file
+    def close(self):
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.flusher.join()
+
+        for thread in self.maintenanceThreads:
+            thread.join()
+
+        self.indexFile.close()
+
+
+
+# Returns the shared writer for a log file, opening it on first use
+def getLogWriter(path):
+
+    writer = logWriters.get(path)
+
+    if writer is None:
+        with logWritersLock:
+            writer = logWriters.get(path)
+            if writer is None:
+                writer = logWriters[path] = LogWriter(path, **logWriterOptions)
+
+    return writer
+
+
+# Waits for a log's queued entries to be written and indexed, if it is open
+def flushLogWriter(path):
+
+    writer = logWriters.get(path)
+
+    if writer is not None:
+        writer.flush()
+
+
+# Flushes and closes every open log writer; called on server shutdown
+def closeLogWriters():
+
+    with logWritersLock:
+        for writer in logWriters.values():
+            writer.close()
+        logWriters.clear()
+
+
+
+# Rewrites the userlog from a list of online users (presenceHandlers.Presence).
+# Written to a temporary file first, so readers never see a half written userlog.
+def writeUserLogSnapshot(ulFile, entries):
+
+    with open(ulFile + ".tmp", 'w') as f:
+        for seqNumber, entry in enumerate(entries, start=1):
+            f.write(f"{seqNumber}; {entry.loginTime}; {entry.username}; {entry.address}; {entry.udpPort}\n")
+
+    os.replace(ulFile + ".tmp", ulFile)
+
+
+
+# Writes a message to the message log, indexed under each recipient's conversation with the sender
+def messageLogManager(username, message, recipients=()):
+    conversations = [conversationKey(username, recipient) for recipient in recipients]
+    getLogWriter("messagelog.txt").append(username, message, conversations=conversations)
+
+
+# Writes a message to a groups message log
+def groupMessageLogManager(groupname, username, message):
+
+    ulFile = f"{groupname}_messagelog.txt"
 
     # Create the file (leave empty)
-    except FileNotFoundError:
-        with open(ulFile, 'w') as f:
-            pass
-        
+    if ulFile not in logWriters and not os.path.exists(ulFile):
+        getLogWriter(ulFile)
+        return
+
+    getLogWriter(ulFile).append(username, message)
@@ -0,0 +1,82 @@
+# Written by Vimukthi Herath
+
+import json
+import struct
+
+# Every message on the TCP connection is sent as a frame:
+# a 4 byte big-endian body length, followed by the utf-8 encoded json body
+frameHeader = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 64 * 1024
+
+
+# Encodes a json object into a length-prefixed frame
+def encodeFrame(obj):
+    body = json.dumps(obj).encode()
+    return frameHeader.pack(len(body)) + body
+
+
+# Writes a single json object to the socket as one frame.
+# sendall is used so a large frame is never cut short by a partial send.
+def sendFrame(sock, obj):
+    sock.sendall(encodeFrame(obj))
+
+
+# Per-connection receive buffer.
+# A single recv may hold part of a frame, or several frames at once;
+# bytes are kept between calls until a complete frame can be decoded.
+class FrameReader:
+
+    def __init__(self, sock=None, recvSize=RECV_SIZE):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.receivedBytes = 0
+
+        # Only readers that recv from a socket themselves need a receive chunk;
+        # readers fed by an event loop skip it to keep idle connections small
+        if sock is not None:
+            self.chunk = bytearray(recvSize)
+            self.chunkView = memoryview(self.chunk)
+
+
+    # Adds received bytes to the buffer and returns every complete frame as a decoded json object
+    def feed(self, data):
+
+        self.buffer += data
+        self.receivedBytes += len(data)
+        frames = []
+        start = 0
+
+        while len(self.buffer) - start >= frameHeader.size:
+
+            (length,) = frameHeader.unpack_from(self.buffer, start)
+
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"Frame of {length} bytes exceeds the maximum frame size")
+
+            end = start + frameHeader.size + length
+
+            # Body has not fully arrived yet
+            if len(self.buffer) < end:
+                break
+
+            frames.append(json.loads(self.buffer[start + frameHeader.size:end]))
+            start = end
+
+        # Drop consumed bytes, keeping any partial frame for the next call
+        if start:
+            del self.buffer[:start]
+
+        return frames
+
+
+    # Reads from the socket once and returns the decoded frames.
+    # Returns None when the peer has closed the connection.
+    def recvFrames(self):
+
+        received = self.sock.recv_into(self.chunk)
+
+        if not received:
+            return None
+
+        return self.feed(self.chunkView[:received])
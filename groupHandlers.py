@@ -0,0 +1,133 @@
+# Written by Vimukthi Herath
+
+from threading import Lock
+
+
+# A group chat.
+# members indexes every participant's join state, and online holds the session of each
+# member who has joined and is logged in, so /groupmsg fans out without scanning the member list.
+class Group:
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {} # Stores { username: hasJoined }, in the order users were added
+        self.online = {} # Stores { username: session } for joined members who are logged in
+
+
+    def memberNames(self):
+        return list(self.members)
+
+
+    # Returns None if the user is not a participant, otherwise whether they have joined
+    def joinState(self, username):
+        return self.members.get(username)
+
+
+    # Sessions of the joined, online members other than the sender
+    def recipients(self, sender):
+        return [session for username, session in self.online.items() if username != sender]
+
+
+    # Joined members who are offline, other than the sender
+    def offlineMembers(self, sender):
+        return [username for username, hasJoined in self.members.items() if hasJoined and username not in self.online and username != sender]
+
+
+
+# All group chats, plus a username -> group names index so logins and logouts
+# only touch the groups a user belongs to. Every change happens under one lock.
+class GroupRegistry:
+
+    def __init__(self):
+        self.groups = {} # Stores { groupname: Group }
+        self.memberships = {} # Stores { username: {groupname, ...} }
+        self.lock = Lock()
+
+
+    def __contains__(self, groupname):
+        return groupname in self.groups
+
+
+    def get(self, groupname):
+        return self.groups.get(groupname)
+
+
+    # Creates a group the creator has already joined
+    # Returns the new Group, or None if the name is taken
+    def create(self, groupname, creator, creatorSession, participants):
+
+        with self.lock:
+
+            if groupname in self.groups:
+                return None
+
+            group = self.groups[groupname] = Group(groupname)
+            group.members[creator] = True
+            group.online[creator] = creatorSession
+
+            for participant in participants:
+                group.members.setdefault(participant, False)
+
+            for username in group.members:
+                self.memberships.setdefault(username, set()).add(groupname)
+
+            return group
+
+
+    # Adds a group, or members and joins, known to another cluster node: members is { username: hasJoined }.
+    # Groups are only ever added to, so nodes that created the same group at once end up with the same members.
+    # Returns the Group
+    def merge(self, groupname, members):
+
+        with self.lock:
+
+            group = self.groups.get(groupname)
+            if group is None:
+                group = self.groups[groupname] = Group(groupname)
+
+            for username, hasJoined in members.items():
+                group.members[username] = group.members.get(username, False) or hasJoined
+                self.memberships.setdefault(username, set()).add(groupname)
+
+            return group
+
+
+    # Every group's members, as { groupname: { username: hasJoined } }
+    def snapshot(self):
+        with self.lock:
+            return {groupname: dict(group.members) for groupname, group in self.groups.items()}
+
+
+    # Marks a participant as joined; they are online since they sent the request
+    def join(self, group, username, session):
+
+        with self.lock:
+            group.members[username] = True
+            group.online[username] = session
+
+
+    # Adds a user who just logged in to the online set of every group they have joined
+    def userOnline(self, username, session):
+
+        with self.lock:
+            for groupname in self.memberships.get(username, ()):
+                group = self.groups[groupname]
+                if group.members[username]:
+                    group.online[username] = session
+
+
+    # Removes a user who logged out or disconnected from the online sets
+    def userOffline(self, username, session):
+
+        with self.lock:
+            for groupname in self.memberships.get(username, ()):
+                group = self.groups[groupname]
+                if group.online.get(username) is session:
+                    del group.online[username]
+
+
+    # Snapshot of a group message's audience, taken under the lock:
+    # the sessions of the online members, and the names of the joined members who are offline
+    def audience(self, group, sender):
+        with self.lock:
+            return group.recipients(sender), group.offlineMembers(sender)
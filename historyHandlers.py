@@ -0,0 +1,256 @@
+# Written by Vimukthi Herath
+
+import os
+import re
+import mmap
+import shutil
+import struct
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from urllib.parse import quote
+from segmentHandlers import allSegments, openSegment
+
+# Sidecar offset indexes for the message logs, so history can be read back without scanning a log.
+#
+# Every log has a whole-log index, <log>.idx, with one fixed size record per entry.
+# The direct message log also has one index per conversation, <log>.index/<userA userB>.idx,
+# pointing at the entries between two users. Records are appended in sequence order by the log's
+# writer as its entries are written, so each index is sorted by sequence number and by time,
+# and a query is two binary searches followed by reading the records it returns.
+# An index spans all of a log's segments (see segmentHandlers); a record's offset is within the
+# segment holding its sequence number.
+indexRecord = struct.Struct("!QdQI") # sequence number, unix time, byte offset of the line in its segment, line length
+
+MAX_HISTORY_LIMIT = 500
+READ_ATTEMPTS = 3
+
+# Backslash escapes in log line fields (see escapeField)
+fieldEscape = re.compile(r"\\(.)")
+fieldEscapes = {"n": "\n", "r": "\r"}
+
+
+# Raised when the records being read no longer match the log's segments,
+# because the log was rotated or compacted while they were read
+class StaleIndexError(Exception):
+    pass
+
+
+# Conversation key of the direct messages between two users
+def conversationKey(userA, userB):
+    return " ".join(sorted((userA, userB)))
+
+
+# Index file for a whole log, or for one conversation in it
+def indexPath(logPath, conversation=None):
+
+    if conversation is None:
+        return logPath + ".idx"
+
+    return os.path.join(logPath + ".index", quote(conversation, safe='') + ".idx")
+
+
+# Parses a log line's timestamp back into unix time
+def parseLogTime(formattedTime):
+    return datetime.strptime(formattedTime, '%d %b %Y %H:%M:%S').timestamp()
+
+
+# Read-only sequence view over an index file's records, for bisect
+class IndexView:
+
+    def __init__(self, data):
+        self.data = data
+
+
+    def __len__(self):
+        return len(self.data) // indexRecord.size
+
+
+    def __getitem__(self, i):
+        return indexRecord.unpack_from(self.data, i * indexRecord.size)
+
+
+
+# Escapes a log line field, so a message with line breaks in it is still one line in the log
+def escapeField(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\r", "\\r")
+
+
+# Reverses escapeField
+def unescapeField(text):
+
+    if "\\" not in text:
+        return text
+
+    return fieldEscape.sub(lambda match: fieldEscapes.get(match[1], match[1]), text)
+
+
+# Turns a "N; timestamp; username; message" log line into a history entry
+def parseEntry(line):
+
+    seqNumber, timeSent, username, message = line.decode().rstrip("\n").split("; ", 3)
+
+    return {
+        "seq": int(seqNumber),
+        "timeSent": timeSent,
+        "from": unescapeField(username),
+        "message": unescapeField(message),
+    }
+
+
+# Pages back through a log, newest entry first.
+#   conversation: only entries between two users (see conversationKey); None for the whole log
+#   since, until: unix time bounds, inclusive
+#   cursor:       only entries older than this sequence number, i.e. the previous page's nextCursor
+# Returns a tuple: (entries, nextCursor), where nextCursor is None once there is nothing older
+def readHistory(logPath, conversation=None, since=None, until=None, limit=50, cursor=None):
+
+    limit = max(0, min(limit, MAX_HISTORY_LIMIT))
+
+    for attempt in range(READ_ATTEMPTS):
+
+        # The index is mapped rather than read, so only the pages the binary searches touch are loaded
+        try:
+            with open(indexPath(logPath, conversation), 'rb') as f:
+                indexMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # No index yet, or an empty one
+            return [], None
+
+        # Listed after the index is mapped, so every segment a record can point into is listed
+        segments = allSegments(logPath)
+
+        try:
+            with indexMap:
+                return readIndexedHistory(segments, IndexView(indexMap), since, until, limit, cursor)
+        except StaleIndexError:
+            if attempt == READ_ATTEMPTS - 1:
+                raise OSError(f"{logPath} kept changing while its history was read")
+
+
+# readHistory's query, over an index that is already mapped and the log's segments
+def readIndexedHistory(segments, index, since, until, limit, cursor):
+
+    # Newest record that is both before the cursor and not after the end of the time range
+    end = len(index)
+    if cursor is not None:
+        end = bisect_left(index, cursor, hi=end, key=lambda record: record[0])
+    if until is not None:
+        end = bisect_right(index, until, hi=end, key=lambda record: record[1])
+
+    start = max(0, end - limit)
+    if since is not None:
+        start = max(start, bisect_left(index, since, lo=start, hi=end, key=lambda record: record[1]))
+
+    records = [index[i] for i in range(start, end)]
+
+    if not records:
+        return [], None
+
+    entries = []
+    firstSeqs = [segment.firstSeq for segment in segments]
+
+    # Records are in sequence order, so the ones in each segment are consecutive
+    i = 0
+    while i < len(records):
+
+        position = bisect_right(firstSeqs, records[i][0])
+
+        # Points into a segment the retention policy has deleted
+        if position == 0:
+            raise StaleIndexError
+
+        segment = segments[position - 1]
+
+        j = i + 1
+        while j < len(records) and (segment.lastSeq is None or records[j][0] <= segment.lastSeq):
+            j += 1
+
+        entries += readSegmentEntries(segment, records[i:j])
+        i = j
+
+    entries.reverse()
+
+    # There are older entries if the page didn't stop at the start of the index or the time range
+    nextCursor = records[0][0] if start > 0 and (since is None or index[start - 1][1] >= since) else None
+
+    return entries, nextCursor
+
+
+# Reads the entries a run of records points at in one segment, in file order
+def readSegmentEntries(segment, records):
+
+    entries = []
+
+    try:
+        with openSegment(segment.path) as log:
+
+            first = records[0][2]
+            last = records[-1][2] + records[-1][3]
+
+            # Read the span the records cover in one go when it is dense (a group log), otherwise seek to each line
+            if last - first <= 4 * sum(record[3] for record in records):
+                log.seek(first)
+                span = log.read(last - first)
+                lines = [span[offset - first:offset - first + length] for _, _, offset, length in records]
+            else:
+                lines = []
+                for _, _, offset, length in records:
+                    log.seek(offset)
+                    lines.append(log.read(length))
+
+            for record, line in zip(records, lines):
+                entry = parseEntry(line)
+                if entry["seq"] != record[0]:
+                    raise StaleIndexError
+                entries.append(entry)
+
+    # The segment was compressed, deleted or rotated out since it was listed
+    except (FileNotFoundError, ValueError, UnicodeDecodeError):
+        raise StaleIndexError
+
+    return entries
+
+
+# Drops the records before firstSeq from an index, once the retention policy is about to delete
+# the segments they point into. An index left with no records is removed.
+def compactIndex(path, firstSeq):
+
+    try:
+        with open(path, 'rb') as f:
+
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as indexMap:
+                    keep = bisect_left(IndexView(indexMap), firstSeq, key=lambda record: record[0])
+                    total = len(indexMap) // indexRecord.size
+            except ValueError:
+                # Empty index
+                return
+
+            if keep == 0:
+                return
+
+            if keep == total:
+                os.remove(path)
+                return
+
+            f.seek(keep * indexRecord.size)
+            with open(path + ".tmp", 'wb') as compacted:
+                shutil.copyfileobj(f, compacted)
+
+    except FileNotFoundError:
+        return
+
+    os.replace(path + ".tmp", path)
+
+
+# Every index of a log: the whole-log index and its conversation indexes
+def indexPaths(logPath):
+
+    paths = [indexPath(logPath)]
+
+    try:
+        paths += [os.path.join(logPath + ".index", name) for name in os.listdir(logPath + ".index") if name.endswith(".idx")]
+    except FileNotFoundError:
+        pass
+
+    return paths
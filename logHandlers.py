@@ -0,0 +1,135 @@
+# Written by Vimukthi Herath
+
+import sys
+import json
+import queue
+import logging
+from itertools import count
+from logging import DEBUG, INFO, WARNING, ERROR
+from logging.handlers import QueueHandler, QueueListener
+
+# Structured server logging.
+#
+# Each log line is an event name plus key=value fields, e.g.
+#   logEvent(INFO, "groupCreated", user="Yoda", group="jedi", members=3)
+# Records are put on a queue and written to the console by a background thread, so a handler never waits
+# on a slow terminal or pipe. Events below the configured level are dropped before any formatting is done,
+# and high volume events can be sampled, so only 1 in sampleRate of them is logged.
+LOG_LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LOG_FORMATS = ("text", "json")
+
+logger = logging.getLogger("messenger")
+
+
+def formatField(value):
+
+    text = str(value)
+
+    # Quote values that would otherwise run into the next field
+    if not text or any(c in text for c in ' ="\n'):
+        return json.dumps(text)
+
+    return text
+
+
+# Formats an event as "time level event key=value ...", or as one json object per line
+class StructuredFormatter(logging.Formatter):
+
+    def __init__(self, logFormat="text"):
+        logging.Formatter.__init__(self)
+        self.logFormat = logFormat
+
+
+    def format(self, record):
+
+        fields = getattr(record, "fields", {})
+
+        if self.logFormat == "json":
+            event = {"time": self.formatTime(record), "level": record.levelname.lower(), "event": record.getMessage(), **fields}
+            if record.exc_info:
+                event["exception"] = self.formatException(record.exc_info)
+            return json.dumps(event, default=str)
+
+        line = " ".join([self.formatTime(record), f"{record.levelname:<7}", record.getMessage(),
+                         *(f"{key}={formatField(value)}" for key, value in fields.items())])
+
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+
+        return line
+
+
+# Lets through 1 in every sampleRate records of each sampled event; other events all pass
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, sampleRate):
+        logging.Filter.__init__(self)
+        self.sampleRate = sampleRate
+        self.counters = {} # Stores { event: count() }
+
+
+    def filter(self, record):
+
+        if not getattr(record, "sampled", False) or self.sampleRate <= 1:
+            return True
+
+        # next() on a count is atomic, so threads logging the same event don't need a lock
+        counter = self.counters.get(record.msg) or self.counters.setdefault(record.msg, count())
+
+        if next(counter) % self.sampleRate:
+            return False
+
+        record.fields = {**record.fields, "sampled": f"1/{self.sampleRate}"}
+        return True
+
+
+# Hands records to the listener thread as they are, leaving all formatting to it
+class BackgroundHandler(QueueHandler):
+
+    def prepare(self, record):
+        return record
+
+
+
+# Logs an event with its fields; sampled events are subject to the sampling rate.
+# Nothing is done if the level is disabled, so debug events cost a single check when verbose output is off.
+def logEvent(level, event, sampled=False, **fields):
+
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields, "sampled": sampled})
+
+
+# Like logEvent at ERROR, with the traceback of the exception being handled
+def logException(event, **fields):
+    logger.exception(event, extra={"fields": fields, "sampled": False})
+
+
+# Sends server events through a queue to a background thread writing to stream.
+# Returns the QueueListener; pass it to stopLogging on shutdown.
+def startLogging(level="info", logFormat="text", sampleRate=100, stream=None):
+
+    if level not in LOG_LEVELS:
+        raise ValueError(f"Invalid log level: {level}")
+
+    if logFormat not in LOG_FORMATS:
+        raise ValueError(f"Invalid log format: {logFormat}")
+
+    consoleHandler = logging.StreamHandler(stream or sys.stdout)
+    consoleHandler.setFormatter(StructuredFormatter(logFormat))
+
+    logQueue = queue.SimpleQueue()
+    listener = QueueListener(logQueue, consoleHandler)
+
+    logger.handlers = [BackgroundHandler(logQueue)]
+    logger.filters = [SamplingFilter(sampleRate)]
+    logger.setLevel(LOG_LEVELS[level])
+    logger.propagate = False
+
+    listener.start()
+
+    return listener
+
+
+# Writes any events still queued, then stops the background thread
+def stopLogging(listener):
+    listener.stop()
@@ -0,0 +1,243 @@
+# Written by Vimukthi Herath
+
+import os
+import time
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from socketserver import TCPServer
+from socket import AF_UNIX
+from threading import Thread, Lock
+
+RATE_WINDOW = 10 # Seconds that rates are averaged over
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# Events per second over the last RATE_WINDOW seconds, counted in one second buckets
+class RateMeter:
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.buckets = deque() # Stores [second, count] for the seconds that had events, oldest first
+
+
+    # Called with the metrics lock held
+    def add(self, count, now):
+
+        second = int(now)
+
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += count
+        else:
+            self.buckets.append([second, count])
+
+        while self.buckets[0][0] <= second - self.window:
+            self.buckets.popleft()
+
+
+    def rate(self, now):
+        return sum(count for second, count in self.buckets if second > int(now) - self.window) / self.window
+
+
+
+# Server wide counters that aren't kept anywhere else; safe to update from any thread.
+# Bytes in and out are counted by each connection's frame reader and outbound queue, so the hot path
+# takes no lock for them; they are summed over the open connections when a snapshot is taken, and a
+# connection's totals are folded into the server's when it closes.
+class ServerMetrics:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+
+        self.sessions = set() # Open client connections
+        self.connectionsTotal = 0
+        self.loginFailures = 0
+        self.closedBytesIn = 0
+        self.closedBytesOut = 0
+        self.messages = {} # Stores { kind: count } for direct, batch and group messages sent
+        self.messageRate = RateMeter()
+
+
+    # session needs frameReader.receivedBytes and outbound.sentBytes
+    def connectionOpened(self, session):
+        with self.lock:
+            self.sessions.add(session)
+            self.connectionsTotal += 1
+
+
+    def connectionClosed(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+                self.closedBytesIn += session.frameReader.receivedBytes
+                self.closedBytesOut += session.outbound.sentBytes
+
+
+    def loginFailed(self):
+        with self.lock:
+            self.loginFailures += 1
+
+
+    def messageSent(self, kind):
+        with self.lock:
+            self.messages[kind] = self.messages.get(kind, 0) + 1
+            self.messageRate.add(1, time.time())
+
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptimeSeconds": time.time() - self.started,
+                "connections": len(self.sessions),
+                "connectionsTotal": self.connectionsTotal,
+                "loginFailures": self.loginFailures,
+                "bytesIn": self.closedBytesIn + sum(session.frameReader.receivedBytes for session in self.sessions),
+                "bytesOut": self.closedBytesOut + sum(session.outbound.sentBytes for session in self.sessions),
+                "messages": dict(self.messages),
+                "messagesPerSecond": self.messageRate.rate(time.time()),
+            }
+
+
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def formatValue(value):
+
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Builds a page in the Prometheus text exposition format, one metric family at a time
+class MetricsPage:
+
+    def __init__(self):
+        self.lines = []
+
+
+    # samples is a list of (labels dict, value) pairs, or a single value for a family without labels
+    def add(self, name, metricType, helpText, samples):
+
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+
+        self.lines.append(f"# HELP {name} {helpText}")
+        self.lines.append(f"# TYPE {name} {metricType}")
+
+        for labels, value in samples:
+            self.sample(name, labels, value)
+
+
+    def sample(self, name, labels, value):
+
+        if labels:
+            labelText = ",".join(f'{key}="{escapeLabel(labelValue)}"' for key, labelValue in labels.items())
+            self.lines.append(f"{name}{{{labelText}}} {formatValue(value)}")
+        else:
+            self.lines.append(f"{name} {formatValue(value)}")
+
+
+    # A histogram family from { labelValue: (cumulative buckets as (bound, count) pairs, sum, count) }
+    def addHistogram(self, name, helpText, labelName, histograms):
+
+        self.lines.append(f"# HELP {name} {helpText}")
+        self.lines.append(f"# TYPE {name} histogram")
+
+        for labelValue, (buckets, total, count) in histograms.items():
+            for bound, bucketCount in buckets:
+                self.sample(f"{name}_bucket", {labelName: labelValue, "le": formatValue(bound)}, bucketCount)
+            self.sample(f"{name}_sum", {labelName: labelValue}, total)
+            self.sample(f"{name}_count", {labelName: labelValue}, count)
+
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        try:
+            body = self.server.collect().encode()
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    # Unix socket peers have no address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "local"
+
+
+    # Scrapes aren't logged to the console
+    def log_message(self, format, *args):
+        pass
+
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+
+    address_family = AF_UNIX
+
+    def server_bind(self):
+
+        # A socket file left by an earlier run would make the bind fail
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+
+        # HTTPServer.server_bind would look the path up as a host name
+        TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+
+# Local admin listener serving collect()'s page at /metrics over HTTP, on its own thread so it
+# works the same in threaded and async mode. Give a port to listen on 127.0.0.1, or a Unix socket path.
+class MetricsServer:
+
+    def __init__(self, collect, port=None, socketPath=None):
+
+        if socketPath:
+            self.httpServer = UnixHTTPServer(socketPath, MetricsRequestHandler)
+            self.address = socketPath
+        else:
+            self.httpServer = ThreadingHTTPServer(("127.0.0.1", port), MetricsRequestHandler)
+            self.address = f"http://127.0.0.1:{self.httpServer.server_address[1]}/metrics"
+
+        self.httpServer.daemon_threads = True
+        self.httpServer.collect = collect
+        self.socketPath = socketPath
+
+        self.thread = Thread(target=self.httpServer.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+
+
+    def close(self):
+
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+        if self.socketPath:
+            try:
+                os.remove(self.socketPath)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,245 @@
+# Written by Vimukthi Herath
+
+import os
+import glob
+import json
+from itertools import count
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from urllib.parse import quote
+from frameHandlers import encodeFrame, MAX_FRAME_SIZE
+
+
+# Messages for users who are offline, delivered in one batch when they next log in.
+# The oldest memoryLimit messages for each user are held in memory; anything beyond that is
+# appended to the user's spill file in spillDir, one json frame per line, so a large backlog
+# doesn't sit in memory. A user's queue holds at most maxMessages; later messages are refused.
+# Messages taken for delivery are only gone from the store once delivered() is called; restore()
+# puts them back if they couldn't be sent.
+class OfflineStore:
+
+    def __init__(self, spillDir="offline_messages", memoryLimit=256, maxMessages=10000, workers=1):
+        self.spillDir = spillDir
+        self.memoryLimit = memoryLimit
+        self.maxMessages = maxMessages
+
+        self.queues = {} # Stores { username: deque of frames } for the in-memory part of each queue
+        self.spilled = {} # Stores { username: frames in the spill file }, counted when a user is first seen
+        self.lock = Lock()
+
+        # Spill files are read and the batch encoded here, never on a login or request path
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="offline-delivery")
+        self.drainIds = count(1) # Numbers each spill file taken for delivery, so two drains never share a file
+
+
+    def spillPath(self, username):
+        return os.path.join(self.spillDir, quote(username, safe='') + ".spill")
+
+
+    # Frames in a spill file left by an earlier run, so the bound holds across restarts
+    def countSpilled(self, username):
+
+        self.recoverDrains(username)
+
+        try:
+            with open(self.spillPath(username), 'rb') as f:
+                return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1024 * 1024), b""))
+        except FileNotFoundError:
+            return 0
+
+
+    # Puts the spill files an earlier run was still delivering when it stopped back in front of the user's
+    # spill file, oldest first, so they are delivered at the next login. Called when a user is first seen,
+    # before this run has started any drain of its own for them.
+    def recoverDrains(self, username):
+
+        spillPath = self.spillPath(username)
+        drains = glob.glob(glob.escape(spillPath) + ".draining*")
+
+        if not drains:
+            return
+
+        # ".draining" is from before drains were numbered; numbered ones are in the order they were taken
+        drains.sort(key=lambda path: int(path.rsplit(".", 1)[1]) if path[-1].isdigit() else 0)
+
+        # Only whole lines are kept; a line cut short by a crash would run into the next file's first
+        with open(spillPath + ".tmp", 'w') as target:
+            for path in drains + [spillPath]:
+                try:
+                    with open(path, 'r') as source:
+                        target.writelines(line for line in source if line.endswith("\n"))
+                except FileNotFoundError:
+                    pass
+
+            target.flush()
+            os.fsync(target.fileno())
+
+        os.replace(spillPath + ".tmp", spillPath)
+
+        for path in drains:
+            os.remove(path)
+
+
+    # Queues a frame for a user unless isOnline() says they have come online in the meantime;
+    # checked under the same lock take() marks users online with, so no frame is stranded.
+    # Returns "queued", "online" if the caller should send it directly, or "full"
+    def add(self, username, frame, isOnline):
+
+        with self.lock:
+
+            if isOnline():
+                return "online"
+
+            if username not in self.spilled:
+                self.spilled[username] = self.countSpilled(username)
+
+            queue = self.queues.setdefault(username, deque())
+
+            if len(queue) + self.spilled[username] >= self.maxMessages:
+                return "full"
+
+            # Spill once the in-memory part is full, or frames would be delivered out of order
+            if len(queue) < self.memoryLimit and not self.spilled[username]:
+                queue.append(frame)
+            else:
+                os.makedirs(self.spillDir, exist_ok=True)
+                with open(self.spillPath(username), 'a') as f:
+                    f.write(json.dumps(frame) + "\n")
+                self.spilled[username] += 1
+
+            return "queued"
+
+
+    # Marks a user online and takes their queue.
+    # markOnline() runs under the store's lock, so from then on add() reports the user as online.
+    # Returns a concurrent.futures.Future resolving to the user's Backlog. Only a spill file is read on the
+    # store's worker thread; a backlog held in memory (or none) is encoded here and the future is already done.
+    def take(self, username, markOnline):
+
+        with self.lock:
+
+            markOnline()
+
+            queue = self.queues.pop(username, None)
+
+            if username not in self.spilled:
+                self.spilled[username] = self.countSpilled(username)
+
+            # Renamed under the lock, so frames spilled from now on start a new file.
+            # Each drain has its own file, so a drain still running from an earlier login is never overwritten.
+            spillPath = None
+            if self.spilled[username]:
+                spillPath = f"{self.spillPath(username)}.draining.{next(self.drainIds)}"
+                os.replace(self.spillPath(username), spillPath)
+                self.spilled[username] = 0
+
+        backlog = Backlog(username, list(queue or ()), spillPath)
+
+        if spillPath:
+            return self.executor.submit(self.encodeBacklog, backlog)
+
+        future = Future()
+        future.set_result(self.encodeBacklog(backlog))
+        return future
+
+
+    # Builds the offlineMessages frames for a backlog, oldest message first
+    def encodeBacklog(self, backlog):
+
+        if backlog.drainPath:
+            with open(backlog.drainPath, 'r') as f:
+                backlog.messages.extend(json.loads(line) for line in f if line.strip())
+
+        if backlog.messages:
+            backlog.frames = self.encodeFrames(backlog.messages)
+
+        return backlog
+
+
+    # The backlog has been sent, so its spill file is no longer needed
+    def delivered(self, backlog):
+
+        if backlog.drainPath:
+            try:
+                os.remove(backlog.drainPath)
+            except FileNotFoundError:
+                pass
+
+
+    # Puts a backlog that couldn't be sent back in front of the user's queue, to be delivered at their next login.
+    # Restored messages are never refused, even if the queue has filled up in the meantime.
+    def restore(self, backlog):
+
+        if not backlog.messages:
+            self.delivered(backlog)
+            return
+
+        username = backlog.username
+
+        with self.lock:
+
+            queue = self.queues.setdefault(username, deque())
+            spilled = self.spilled.get(username, 0)
+
+            if not backlog.drainPath and not spilled and len(backlog.messages) + len(queue) <= self.memoryLimit:
+                queue.extendleft(reversed(backlog.messages))
+                return
+
+            # Otherwise the whole queue goes to the spill file, oldest first, so it is still delivered in order
+            spillPath = self.spillPath(username)
+            os.makedirs(self.spillDir, exist_ok=True)
+
+            with open(spillPath + ".tmp", 'w') as target:
+                target.writelines(json.dumps(frame) + "\n" for frame in backlog.messages)
+                target.writelines(json.dumps(frame) + "\n" for frame in queue)
+
+                try:
+                    with open(spillPath, 'r') as source:
+                        target.writelines(source)
+                except FileNotFoundError:
+                    pass
+
+                target.flush()
+                os.fsync(target.fileno())
+
+            os.replace(spillPath + ".tmp", spillPath)
+            self.spilled[username] = len(backlog.messages) + len(queue) + spilled
+            queue.clear()
+
+        self.delivered(backlog)
+
+
+    # Normally the whole backlog is one frame; it is only split if it would exceed the maximum frame size
+    def encodeFrames(self, frames):
+
+        data = encodeFrame({"header": "offlineMessages", "messages": frames})
+
+        if len(data) <= MAX_FRAME_SIZE or len(frames) == 1:
+            return [data]
+
+        middle = len(frames) // 2
+        return self.encodeFrames(frames[:middle]) + self.encodeFrames(frames[middle:])
+
+
+    # Number of frames waiting for each user who has any
+    def depths(self):
+        with self.lock:
+            return {username: len(self.queues.get(username, ())) + self.spilled.get(username, 0)
+                    for username in set(self.queues) | set(self.spilled)
+                    if self.queues.get(username) or self.spilled.get(username)}
+
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+
+# A user's queued messages, taken from the OfflineStore for delivery
+class Backlog:
+
+    def __init__(self, username, messages, drainPath):
+        self.username = username
+        self.messages = messages # The queued frames, oldest first; those in the spill file are added when it is read
+        self.drainPath = drainPath # The spill file taken for delivery, if any
+        self.frames = [] # The encoded offlineMessages frames, empty if nothing was queued
@@ -0,0 +1,82 @@
+# Written by Vimukthi Herath
+
+from collections import namedtuple
+from datetime import datetime
+from threading import Thread, Lock, Event
+from fileHandlers import writeUserLogSnapshot
+
+Presence = namedtuple("Presence", ["username", "address", "udpPort", "loginTime"])
+
+
+# Lock-protected registry of logged in users: { username: Presence }.
+# It is the source of truth for /activeuser; userlog.txt is rewritten from it
+# in the background whenever it has changed, at most once per snapshotInterval.
+class PresenceRegistry:
+
+    def __init__(self, snapshotPath="userlog.txt", snapshotInterval=1.0):
+        self.snapshotPath = snapshotPath
+        self.snapshotInterval = snapshotInterval
+        self.users = {} # Insertion ordered, so snapshots list users in login order
+        self.lock = Lock()
+        self.dirty = True
+        self.stopped = Event()
+
+        self.snapshotThread = Thread(target=self.snapshotLoop, name="userlog-snapshot", daemon=True)
+        self.snapshotThread.start()
+
+
+    # Adds a user when they log in; users logged in on another cluster node keep their login time from there
+    # Returns the user's Presence
+    def add(self, username, clientAddress, udpPort, loginTime=None):
+
+        presence = Presence(username, clientAddress[0], udpPort, loginTime or datetime.now().strftime('%d %b %Y %H:%M:%S'))
+
+        with self.lock:
+            # A user logging in again moves to the end of the list
+            self.users.pop(username, None)
+            self.users[username] = presence
+            self.dirty = True
+
+        return presence
+
+
+    # Removes a user when they log out or disconnect
+    def remove(self, username):
+
+        with self.lock:
+            if self.users.pop(username, None) is not None:
+                self.dirty = True
+
+
+    def get(self, username):
+        return self.users.get(username)
+
+
+    # Returns the online users in login order
+    def list(self):
+        with self.lock:
+            return list(self.users.values())
+
+
+    # Rewrites userlog.txt from the registry if anything changed
+    def writeSnapshot(self):
+
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = list(self.users.values())
+            self.dirty = False
+
+        writeUserLogSnapshot(self.snapshotPath, entries)
+
+
+    def snapshotLoop(self):
+        while not self.stopped.wait(self.snapshotInterval):
+            self.writeSnapshot()
+
+
+    # Stops the snapshot thread after writing a final snapshot
+    def close(self):
+        self.stopped.set()
+        self.snapshotThread.join()
+        self.writeSnapshot()
@@ -0,0 +1,264 @@
+# Written by Vimukthi Herath
+
+import asyncio
+from collections import deque
+from socket import SHUT_RDWR
+from threading import Thread, Condition
+
+# What happens when a frame is queued for a client whose queue is full:
+#   dropOldest:   the oldest queued frame is discarded
+#   disconnect:   the slow client is disconnected
+#   backpressure: the sender waits for space, and the client is disconnected if none frees up within backpressureTimeout
+OVERFLOW_POLICIES = ("dropOldest", "disconnect", "backpressure")
+
+# Async queues that overflowed under backpressure during the current handler.
+# The event loop is single threaded, so the session that ran the handler waits on these afterwards.
+congestedQueues = set()
+
+
+# Bounded queue of encoded frames waiting to be written to one client, plus its metrics
+class OutboundQueueBase:
+
+    def __init__(self, maxDepth=1024, overflowPolicy="backpressure", backpressureTimeout=5.0):
+
+        if overflowPolicy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {overflowPolicy}")
+
+        self.maxDepth = maxDepth
+        self.overflowPolicy = overflowPolicy
+        self.backpressureTimeout = backpressureTimeout
+        self.frames = deque()
+        self.closed = False
+
+        # Metrics
+        self.peakDepth = 0
+        self.droppedFrames = 0
+        self.sentFrames = 0
+        self.sentBytes = 0
+
+
+    def depth(self):
+        return len(self.frames)
+
+
+    # Snapshot of the queue's metrics
+    def metrics(self):
+        return {
+            "depth": len(self.frames),
+            "peakDepth": self.peakDepth,
+            "maxDepth": self.maxDepth,
+            "droppedFrames": self.droppedFrames,
+            "sentFrames": self.sentFrames,
+            "sentBytes": self.sentBytes,
+        }
+
+
+    # Adds a frame once the overflow policy has made room for it
+    def enqueue(self, data):
+
+        self.frames.append(data)
+
+        if len(self.frames) > self.peakDepth:
+            self.peakDepth = len(self.frames)
+
+
+    def recordSent(self, batch):
+        self.sentFrames += len(batch)
+        self.sentBytes += sum(len(data) for data in batch)
+
+
+
+# Outbound queue for a threaded connection, drained by its own writer thread.
+# Senders only ever append to the queue, so a recipient with a full TCP window
+# blocks its writer thread instead of the sender's thread.
+class OutboundQueue(OutboundQueueBase):
+
+    def __init__(self, sock, maxDepth=1024, overflowPolicy="backpressure", backpressureTimeout=5.0):
+        OutboundQueueBase.__init__(self, maxDepth, overflowPolicy, backpressureTimeout)
+        self.sock = sock
+        self.condition = Condition()
+
+        self.writer = Thread(target=self.writerLoop, name="outbound-writer", daemon=True)
+        self.writer.start()
+
+
+    # Queues an encoded frame
+    # Returns False if the frame was not queued because the client is being disconnected
+    def put(self, data):
+
+        with self.condition:
+
+            if self.closed:
+                return False
+
+            if len(self.frames) >= self.maxDepth:
+
+                if self.overflowPolicy == "dropOldest":
+                    self.frames.popleft()
+                    self.droppedFrames += 1
+
+                elif self.overflowPolicy == "disconnect":
+                    self.abortLocked()
+                    return False
+
+                else:
+                    hasSpace = self.condition.wait_for(lambda: self.closed or len(self.frames) < self.maxDepth, self.backpressureTimeout)
+
+                    if self.closed:
+                        return False
+
+                    if not hasSpace:
+                        self.abortLocked()
+                        return False
+
+            self.enqueue(data)
+            self.condition.notify_all()
+            return True
+
+
+    # Writes queued frames until the queue is closed and empty
+    def writerLoop(self):
+
+        while True:
+
+            with self.condition:
+                while not self.frames and not self.closed:
+                    self.condition.wait()
+
+                if not self.frames:
+                    return
+
+                # Take everything queued so far and wake any sender waiting for space
+                batch = list(self.frames)
+                self.frames.clear()
+                self.condition.notify_all()
+
+            try:
+                self.sock.sendall(batch[0] if len(batch) == 1 else b"".join(batch))
+            except OSError:
+                self.abort()
+                return
+
+            self.recordSent(batch)
+
+
+    # Disconnects the client; shutting the socket down wakes its reader thread with EOF
+    def abortLocked(self):
+
+        self.closed = True
+        self.droppedFrames += len(self.frames)
+        self.frames.clear()
+        self.condition.notify_all()
+
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+
+    def abort(self):
+        with self.condition:
+            self.abortLocked()
+
+
+    # Stops accepting frames; the writer exits once what is already queued has been sent
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+
+# Outbound queue for an asyncio connection, drained by its own writer task.
+# put() is called from handlers on the event loop and never blocks; under backpressure,
+# the queue is added to congestedQueues and the sending session awaits waitForSpace().
+class AsyncOutboundQueue(OutboundQueueBase):
+
+    def __init__(self, writer, maxDepth=1024, overflowPolicy="backpressure", backpressureTimeout=5.0):
+        OutboundQueueBase.__init__(self, maxDepth, overflowPolicy, backpressureTimeout)
+        self.writer = writer
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+
+        self.task = asyncio.get_running_loop().create_task(self.writerLoop())
+
+
+    # Queues an encoded frame
+    # Returns False if the frame was not queued because the client is being disconnected
+    def put(self, data):
+
+        if self.closed:
+            return False
+
+        if len(self.frames) >= self.maxDepth:
+
+            if self.overflowPolicy == "dropOldest":
+                self.frames.popleft()
+                self.droppedFrames += 1
+
+            elif self.overflowPolicy == "disconnect":
+                self.abort()
+                return False
+
+            else:
+                self.space.clear()
+                congestedQueues.add(self)
+
+        self.enqueue(data)
+        self.ready.set()
+        return True
+
+
+    # Waits until the writer has taken the queued frames, disconnecting the client on timeout
+    async def waitForSpace(self):
+
+        try:
+            await asyncio.wait_for(self.space.wait(), self.backpressureTimeout)
+        except asyncio.TimeoutError:
+            self.abort()
+
+
+    # Writes queued frames until the queue is closed and empty
+    async def writerLoop(self):
+
+        try:
+            while True:
+
+                await self.ready.wait()
+                self.ready.clear()
+
+                if self.frames:
+                    batch = list(self.frames)
+                    self.frames.clear()
+                    self.space.set()
+
+                    self.writer.write(batch[0] if len(batch) == 1 else b"".join(batch))
+                    await self.writer.drain()
+                    self.recordSent(batch)
+
+                if self.closed and not self.frames:
+                    return
+
+        except ConnectionError:
+            self.abort()
+
+
+    # Disconnects the client; its reader then sees the connection drop
+    def abort(self):
+
+        self.closed = True
+        self.droppedFrames += len(self.frames)
+        self.frames.clear()
+        self.space.set()
+        self.ready.set()
+        self.writer.transport.abort()
+
+
+    # Stops accepting frames and waits for what is already queued to be sent
+    async def close(self):
+
+        self.closed = True
+        self.ready.set()
+
+        await self.task
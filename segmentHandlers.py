@@ -0,0 +1,215 @@
+# Written by Vimukthi Herath
+
+import os
+import re
+import gzip
+import time
+from collections import namedtuple
+
+# zstd compression is only available when the zstandard package is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Logs are split into numbered segments, so no log file grows without bound.
+#
+# The file at the log's own path (e.g. messagelog.txt) is the active segment, which new entries are appended to.
+# Once it reaches its size or age limit it is closed: moved to <log>.segments/<first seq>-<last seq>.log,
+# compressed if the log is set up to be, and a new, empty active segment is started.
+# Sequence numbers carry on from one segment to the next, so a sequence number names an entry in the
+# whole log, and the segment holding it can be found from the segment file names alone.
+# Closed segments are never written again; the oldest are deleted by the retention policy.
+COMPRESSIONS = ("none", "gzip", "zstd")
+COMPRESSED_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+Segment = namedtuple("Segment", ["firstSeq", "lastSeq", "path"])
+
+segmentName = re.compile(r"^(\d+)-(\d+)\.log(\.gz|\.zst)?$")
+
+
+def segmentDir(logPath):
+    return logPath + ".segments"
+
+
+# Raises ValueError for an unknown compression, or zstd without the zstandard package
+def checkCompression(compression):
+
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Invalid log compression: {compression}")
+
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd log compression needs the zstandard package")
+
+
+# Lists a log's closed segments, oldest first
+def closedSegments(logPath):
+
+    try:
+        names = os.listdir(segmentDir(logPath))
+    except FileNotFoundError:
+        return []
+
+    segments = {}
+
+    for name in names:
+        match = segmentName.match(name)
+
+        # A segment is briefly there both plain and compressed while it is being compressed; either will do
+        if match and int(match[1]) not in segments:
+            segments[int(match[1])] = Segment(int(match[1]), int(match[2]), os.path.join(segmentDir(logPath), name))
+
+    return [segments[firstSeq] for firstSeq in sorted(segments)]
+
+
+# Every segment of a log, oldest first; the active segment's lastSeq is None
+def allSegments(logPath):
+
+    segments = closedSegments(logPath)
+    firstSeq = segments[-1].lastSeq + 1 if segments else 1
+
+    return segments + [Segment(firstSeq, None, logPath)]
+
+
+# Opens a segment for reading, decompressing it if needed.
+# Compressed segments can only be read forward, which is how history reads them.
+def openSegment(path):
+
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise OSError(f"Cannot read {path} without the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+    return open(path, 'rb')
+
+
+# Yields a segment's lines; works on compressed segments, whose readers can't be iterated by line
+def segmentLines(f):
+
+    partial = b""
+
+    while chunk := f.read(1024 * 1024):
+        lines = (partial + chunk).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+
+
+# Yields (sequence number, byte offset, entry) for a segment's entries, numbered from firstSeq.
+# An entry is one line, but logs written before line breaks in messages were escaped can have entries running
+# over several lines: a line that doesn't start with the next sequence number belongs to the entry before it.
+def segmentEntries(f, firstSeq):
+
+    seqNumber = firstSeq - 1
+    offset = entryOffset = 0
+    entry = b""
+
+    for line in segmentLines(f):
+
+        if line.startswith(b"%d; " % (seqNumber + 1)):
+            if entry:
+                yield seqNumber, entryOffset, entry
+            seqNumber += 1
+            entryOffset = offset
+            entry = line
+
+        # Anything before the first entry can't be read as one, and is skipped
+        elif entry:
+            entry += line
+
+        offset += len(line)
+
+    if entry:
+        yield seqNumber, entryOffset, entry
+
+
+# Moves a log's active segment, holding firstSeq..lastSeq, into its segment directory.
+# Returns the closed segment's path.
+def closeSegment(logPath, firstSeq, lastSeq):
+
+    os.makedirs(segmentDir(logPath), exist_ok=True)
+
+    path = os.path.join(segmentDir(logPath), f"{firstSeq:012d}-{lastSeq:012d}.log")
+    os.replace(logPath, path)
+
+    return path
+
+
+# Compresses a closed segment, replacing the plain file once the compressed copy is safely on disk
+def compressSegment(path, compression):
+
+    compressedPath = path + COMPRESSED_SUFFIXES[compression]
+
+    try:
+        with open(path, 'rb') as source, open(compressedPath + ".tmp", 'wb') as target:
+
+            if compression == "gzip":
+                with gzip.GzipFile(fileobj=target, mode='wb') as compressed:
+                    while chunk := source.read(1024 * 1024):
+                        compressed.write(chunk)
+            else:
+                zstandard.ZstdCompressor().copy_stream(source, target)
+
+            target.flush()
+            os.fsync(target.fileno())
+
+    # Deleted by the retention policy in the meantime
+    except FileNotFoundError:
+        return
+
+    # Keeps the time the segment was last written, which the retention policy goes by
+    os.utime(compressedPath + ".tmp", ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns))
+    os.replace(compressedPath + ".tmp", compressedPath)
+    os.remove(path)
+
+
+# Compresses any closed segments that are still plain, e.g. left by a server that stopped while compressing
+def compressSegments(logPath, compression):
+
+    for segment in closedSegments(logPath):
+        if segment.path.endswith(".log"):
+            compressSegment(segment.path, compression)
+
+
+# Picks the closed segments the retention policy no longer keeps: all but the newest maxSegments,
+# and those last written more than maxAge seconds ago (0 turns either limit off).
+# The newest closed segment is always kept: its name holds the last sequence number written before the
+# active segment, which is where numbering carries on from when the log is next opened (see allSegments).
+# Returns the first sequence number that is kept and the segments to delete.
+def expiredSegments(logPath, maxSegments=0, maxAge=0):
+
+    segments = closedSegments(logPath)
+    expired = segments[:-maxSegments] if maxSegments else []
+
+    if maxAge:
+        cutoff = time.time() - maxAge
+        for segment in segments[len(expired):-1]:
+            try:
+                if os.path.getmtime(segment.path) >= cutoff:
+                    break
+            except FileNotFoundError:
+                pass
+            expired.append(segment)
+
+    firstKept = expired[-1].lastSeq + 1 if expired else None
+
+    return firstKept, expired
+
+
+# Deletes segments, along with any copy left half way through being compressed
+def deleteSegments(segments):
+
+    for segment in segments:
+
+        plainPath = segment.path
+        for suffix in COMPRESSED_SUFFIXES.values():
+            plainPath = plainPath.removesuffix(suffix)
+
+        for path in (plainPath, *(plainPath + suffix for suffix in COMPRESSED_SUFFIXES.values())):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -3,106 +3,243 @@
 # Written by Vimukthi Herath
 
 from socket import *
-from threading import Thread
+import asyncio
+import resource
+from threading import Thread, Lock
 import sys
 import os
 import json
 import time
 from datetime import datetime
-from argHandlers import serverArgHandler
-from fileHandlers import userBlocked, handleIncorrectLogin, userLogManager, messageLogManager, groupMessageLogManager
+from argHandlers import serverArgHandler, serverOptionHandler
+from credentialHandlers import CredentialStore
+from frameHandlers import FrameReader, encodeFrame, frameHeader, RECV_SIZE
+from queueHandlers import OutboundQueue, AsyncOutboundQueue, OVERFLOW_POLICIES, congestedQueues
+from throttleHandlers import LoginThrottle
+from presenceHandlers import PresenceRegistry
+from groupHandlers import GroupRegistry
+from broadcastHandlers import Broadcaster
+from offlineHandlers import OfflineStore
+from fileHandlers import messageLogManager, groupMessageLogManager, flushLogWriter, closeLogWriters, logWriterOptions, logWriters, FSYNC_POLICIES
+from historyHandlers import readHistory, conversationKey
+from segmentHandlers import checkCompression
+from dispatchHandlers import Dispatcher, CommandStats, RequestError, UnknownRequestError, Optional, ListOf, Number
+from metricsHandlers import ServerMetrics, MetricsServer, MetricsPage
+from logHandlers import logEvent, logException, startLogging, stopLogging, DEBUG, INFO, WARNING, ERROR
+from clusterHandlers import ClusterNode, SocketBus, ClusterError
 
 ## Just for dev use
 # Clear any existing files on server restart
 if os.path.exists("userlog.txt"):
     os.remove("userlog.txt")
-if os.path.exists("attempt_records.txt"):
-    os.remove("attempt_records.txt")
+
+
+# Reasons a direct message was not sent, by routeMessage status
+MESSAGE_ERRORS = {
+    "unknown": "\n{recipient} is not a user, so the message was not sent.\n",
+    "full": "\n{recipient} has too many unread messages, so the message was not sent.\n",
+    "error": "\nThe message to {recipient} could not be sent.\n",
+}
 
 
 # Global variables
 allowedAttempts = 2 # Default val
+serverOptions = {
+    "mode": "threaded", # threaded: one thread per connection, async: every connection on a single event loop
+    "persistAttempts": False, # Append failed login snapshots to attempt_records.txt so blocks survive a restart
+    "fsync": "interval", # Message log fsync policy: always, interval or never
+    "userlogInterval": 1.0, # Seconds between userlog.txt snapshots of the online users
+    "queueDepth": 1024, # Frames that may wait to be written to one client
+    "overflowPolicy": "backpressure", # When a client's queue is full: dropOldest, disconnect or backpressure
+    "backpressureTimeout": 5.0, # Seconds a sender waits for space before the slow client is disconnected
+    "broadcastWorkers": 0, # Threads that share large group fan-outs (threaded mode only, 0 = fan out on the sender's thread)
+    "offlineMemory": 256, # Messages per offline user held in memory before the rest spill to disk
+    "offlineLimit": 10000, # Messages that may wait for one offline user; later ones are refused
+    "logSegmentSize": 64 * 1024 * 1024, # Bytes after which a message log starts a new segment (0 = no size limit)
+    "logSegmentAge": 0.0, # Seconds after which a message log starts a new segment (0 = no age limit)
+    "logCompression": "none", # How closed log segments are compressed: none, gzip or zstd
+    "logRetainSegments": 0, # Closed segments kept per message log (0 = keep all)
+    "logRetainDays": 0.0, # Days a closed log segment is kept (0 = keep forever)
+    "metricsPort": 0, # Local port serving Prometheus metrics at /metrics (0 = off)
+    "metricsSocket": "", # Unix socket path serving the same metrics, instead of a port
+    "logLevel": "info", # Console log level: debug (every request), info, warning or error
+    "logFormat": "text", # Console log lines as text or json
+    "logSample": 100, # Only 1 in this many of each high volume debug event is logged
+    "cluster": "", # Unix socket of the cluster broker (broker.py) to join as one of several nodes ("" = run alone)
+    "clusterNode": "", # This node's name in the cluster ("" = host name and process id)
+}
+queueOptions = {} # Outbound queue settings, taken from serverOptions on startup
+credentialStore = None # CredentialStore, loaded from credentials.txt on startup
+loginThrottle = None # LoginThrottle, tracks failed logins per user
+presence = None # PresenceRegistry, online users for /activeuser
+broadcaster = Broadcaster() # Group message fan-out
+offlineStore = None # OfflineStore, messages waiting for users who are offline
 active_clients = {} # Stores { username, userThreadRef }
-groups = {} # Stores {groupname1: [{participant1, onlineStatus}, {participant2, onlineStatus}], groupname2: [{..},{..},..]], ...}
+groups = GroupRegistry() # Stores { groupname: Group }, each indexing its members' join state and online members
+commandStats = CommandStats() # Request count, errors and latency per header
+serverMetrics = ServerMetrics() # Connection, traffic and message counters for the metrics listener
+metricsServer = None # MetricsServer, if the metrics listener is enabled
+cluster = None # ClusterNode, in cluster mode
+clusterEvents = Dispatcher() # Handlers for events from other cluster nodes, called as handler(fromNode, *fields)
 
 
 ## ClientThread class has been provided by: Wei Song (Tutor for COMP3331/9331) and thereby modified
-class ClientThread(Thread):
+## The request handlers live in ClientSession so the threaded and asyncio servers share them;
+## subclasses only provide how a connection is read from and written to.
+class ClientSession:
 
-    # Init thread
-    def __init__(self, clientAddress, clientSocket):
-        Thread.__init__(self)
+    # Request handlers by header, each registered below with the request fields it takes and their types.
+    # Every request is timed into commandStats.
+    requestHandlers = Dispatcher([commandStats.record])
+
+    # Init session
+    def __init__(self, clientAddress):
         self.clientAddress = clientAddress
-        self.clientSocket = clientSocket
         self.clientAlive = False
         self.loggedIn = False
         self.username = ""
+        self.requestId = None # Correlation id of the request being handled, echoed in its reply
+        self.heldFrames = None # Frames sent while the offline backlog is being read, queued after it
+        self.holdLock = Lock()
         
-        print(f"===== New connection created for: {clientAddress}")
+        logEvent(INFO, "connectionOpened", address=f"{clientAddress[0]}:{clientAddress[1]}")
         self.clientAlive = True
 
 
-    # <---- METHOD: Listen to thread while alive ------>
-    def run(self):
+    # <---- METHOD: Send a response frame to this client ------>
+    def sendResponse(self, response):
+        self.sendEncoded(encodeFrame(response))
+    #<----------------------------------------------->
 
-        global active_clients
-        
-        while self.clientAlive:
- 
-            raw_request = self.clientSocket.recv(1024).decode()
 
-            # if the request from client is empty, the client ended the connection to the server
-            if not raw_request:
-                self.clientAlive = False
-                print(f"\n===== the user disconnected - {self.clientAddress}\n")
-                break    
+    # <---- METHOD: Send an already encoded frame to this client ------>
+    def sendEncoded(self, data):
+
+        # From login until the offline backlog is queued, frames wait so they can't overtake it
+        if self.heldFrames is not None:
+            with self.holdLock:
+                if self.heldFrames is not None:
+                    self.heldFrames.append(data)
+                    return
+
+        self.queueEncoded(data)
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Queue an encoded frame on this client's connection ------>
+    # Returns False if the frame was not queued because the client is being disconnected
+    def queueEncoded(self, data):
+        raise NotImplementedError
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Check whether the client has closed its end of the connection ------>
+    def peerClosed(self):
+        raise NotImplementedError
+    #<----------------------------------------------->
 
-            # Each request is a json object, for which the header tag defines the request type
-            request = json.loads(raw_request)
-            key = request["header"]
-            
-            # Pass on request to relevant method handler
-            if key == 'login':
-                self.processLogin(request["username"], request["password"], request["udp_port"])
 
-            elif key == 'activeUser':
-                self.getActiveUsers()
+    # <---- METHOD: Queue the offline backlog, then the frames held behind it ------>
+    # backlog is None if it couldn't be read; its spill file is then left for a later run to recover
+    def releaseHeldFrames(self, backlog):
 
-            elif key == 'logout':
-                self.processLogout()
+        with self.holdLock:
 
-            elif key == 'sendMessage':
-                self.sendMessage(request['sender'], request['recipient'], request['message'])
+            if backlog:
+                # The messages only leave the store once they are queued on a connection that is still open;
+                # a client that logged in and closed straight away gets them at its next login
+                live = self.clientAlive and active_clients.get(self.username) is self and not self.peerClosed()
 
-            elif key == 'createGroup':
-                self.createGroup(self.username, request['groupName'], request['users'])
+                if live and all(self.queueEncoded(data) for data in backlog.frames):
+                    offlineStore.delivered(backlog)
+                else:
+                    offlineStore.restore(backlog)
 
-            elif key == 'joinGroup':
-                self.joinGroup(request["groupName"])
+            for data in self.heldFrames or ():
+                self.queueEncoded(data)
+            self.heldFrames = None
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Reply to the request being handled ------>
+    def reply(self, response):
+
+        # Replies echo the request's id; frames relayed from other users never carry one
+        if self.requestId is not None:
+            response["requestId"] = self.requestId
+
+        self.sendResponse(response)
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Route a request to its handler ------>
+    def handleRequest(self, request):
+
+        # Each request is a json object, for which the header tag defines the request type
+        self.requestId = request.get("requestId") if isinstance(request, dict) else None
+
+        # Pass on request to the handler registered for its header
+        try:
+            self.requestHandlers.dispatch(self, request)
+        except RequestError as e:
+            self.rejectRequest(e)
+
+    #<----------------------------------------------->
 
-            elif key == 'messageGroup':
-                self.messageGroup(request["groupName"], request["message"])  
 
-            elif key == 'confirmUDP':
-                self.confirmUDP(request["message"])  
+    # <---- METHOD: Reply to a request that has no handler or doesn't match its handler's fields ------>
+    def rejectRequest(self, error):
 
-            else:
-                print(f"Server cannot understand this request: {key}\n")
-                self.clientSocket.send(json.dumps({
-                    "header": "unknown",
-                    "message": f"\nThe server could not understand the request.\n",
-                }).encode())
+        if isinstance(error, UnknownRequestError):
+            logEvent(WARNING, "unknownRequest", user=self.username, error=error)
+            self.reply({
+                "header": "unknown",
+                "message": f"\nThe server could not understand the request.\n",
+            })
+            return
 
+        logEvent(WARNING, "invalidRequest", user=self.username, error=error)
+        self.reply({
+            "header": "invalidRequest",
+            "message": f"\nThe server rejected the request: {error}.\n",
+        })
+    #<----------------------------------------------->
+
+
+
+    # <---- METHOD: Tell the client why its connection is being closed ------>
+    def dropConnection(self, error):
+
+        # A bad frame or a socket error is the connection's doing; anything else is a bug in a handler,
+        # logged with its traceback
+        if isinstance(error, (ValueError, OSError)):
+            logEvent(WARNING, "connectionDropped", user=self.username, error=error)
+        else:
+            logException("requestFailed", user=self.username)
+
+        # The rest of the stream can't be trusted to line up with frame boundaries, so nothing more is read
+        self.sendResponse({
+            "header": "invalidRequest",
+            "message": f"\nThe server closed the connection: {error}.\n",
+        })
     #<----------------------------------------------->
 
 
 
     # <---- METHOD: Handle login ------>
+    @requestHandlers.handler("login", username=str, password=str, udp_port=int)
     def processLogin(self, username, password, udp_port):
 
-        # Defaults
-        validUser = False
-        validLogin = False
+        # Check if login details are valid; the hash check runs on the credential store's workers
+        validUser, validLogin = credentialStore.verify(username, password).result()
+
+        self.completeLogin(username, validUser, validLogin, udp_port)
+    #<----------------------------------------------->
+
+
+
+    # <---- METHOD: Respond to a login once the credentials have been checked ------>
+    def completeLogin(self, username, validUser, validLogin, udp_port):
 
         login_response = {
             "header": "login",
@@ -111,166 +248,291 @@ class ClientThread(Thread):
             "blocked": False
         }
 
-        # Check if login details are valid
-        with open('credentials.txt', 'r') as f:
-            for line in f:
-                user, pw = line.strip().split()
-                if username == user:
-                    validUser = True
-                    if password == pw:
-                        validLogin = True
-                        break
-
         # Case where user does not exist
         if not validUser:
 
             login_response['errorMessage'] = "Username does not exist\n"
-            self.clientSocket.send(json.dumps(login_response).encode())
+            serverMetrics.loginFailed()
+            self.reply(login_response)
             return
         
         # Check if currently blocked
-        blocked = userBlocked(username, allowedAttempts)
+        blocked = loginThrottle.isBlocked(username)
 
         # User exists + correct login + not blocked
         if validLogin and not blocked:
 
             login_response['success'] = True
             self.username = username
-            self.clientSocket.send(json.dumps(login_response).encode())
+            self.reply(login_response)
             
-            # generate/add to userlog
-            userLogManager(username, self.clientAddress, udp_port)
+            # add to the presence registry (userlog.txt is written from it)
+            userPresence = presence.add(username, self.clientAddress, udp_port)
+
+            def markOnline():
+                # Anything routed here from now on is held until the backlog is queued
+                self.heldFrames = []
+                active_clients[username] = self
+
+                # The user may have been logged in on another node until now
+                if cluster:
+                    cluster.directory.userOffline(username)
             
-            # store client in active client dict
-            active_clients[username] = self
+            # store client in active client dict, taking the messages queued while they were offline,
+            # and mark them online in their groups
+            backlog = offlineStore.take(username, markOnline)
+            groups.userOnline(username, self)
+
+            # The backlog is read and encoded off the login path, then sent as one frame
+            self.deliverBacklog(backlog)
+
+            # Other nodes route the user's messages here from now on, and send anything they queued for them
+            if cluster:
+                cluster.publish({"header": "userOnline", "user": username, "address": userPresence.address,
+                                 "udpPort": udp_port, "loginTime": userPresence.loginTime})
             return
 
         # User exists + wrong password
         else:
 
-            errorMsg, blocked = handleIncorrectLogin(username, allowedAttempts)
+            errorMsg, blocked = loginThrottle.recordFailure(username)
+            serverMetrics.loginFailed()
 
             if blocked:
                 login_response['blocked'] = True
 
             login_response['errorMessage'] = errorMsg
-            self.clientSocket.send(json.dumps(login_response).encode())
+            self.reply(login_response)
             return
     #<----------------------------------------------->
 
 
 
     # <---- METHOD: get list of active users ------>
+    @requestHandlers.handler("activeUser")
     def getActiveUsers(self):
 
-        ulFile = "userlog.txt"  
         activeUserStrings = []
 
-        # Server display
-        print(f"\n{self.username} issued /activeuser command.")
-        print("\nReturn active user list:")
-
         activerUser_response = {
             "header": "activeUser",
             "userList": activeUserStrings
         }
 
-        # Read userlog file
-        with open(ulFile, 'r') as f:
-            for line in f:
-                _, dateTime, user, ipAddress, udp_port_num = line.strip().split('; ')
-                if user != self.username:
-                    responseString = f"\n{user}; {ipAddress}; active since {dateTime}; {udp_port_num}.\n"
-                    print(responseString)
-                    activeUserStrings.append(responseString)
+        # Answered from the presence registry, no userlog read
+        for user in presence.list():
+            if user.username != self.username:
+                responseString = f"\n{user.username}; {user.address}; active since {user.loginTime}; {user.udpPort}.\n"
+                activeUserStrings.append(responseString)
 
+        logEvent(DEBUG, "activeUser", sampled=True, user=self.username, listed=len(activeUserStrings))
 
-        self.clientSocket.send(json.dumps(activerUser_response).encode())
+        self.reply(activerUser_response)
     #<----------------------------------------------->
 
 
 
     # <---- METHOD: process logout ------>
+    @requestHandlers.handler("logout")
     def processLogout(self):
 
-        ulFile = "userlog.txt"
-        lines = []
-        seqNum = 0
-
         logout_response = {
             "header": "logout",
             "success": False
         }
 
-        with open(ulFile, 'r') as f:
-            lines = f.readlines()
-
-        # Server display
-        print(f"\n{self.username} has logged out.\n")
-        print("Current active user list:\n")
-
-        # Remove user from the user log
-        with open(ulFile, 'w') as f:
-            for line in lines:
-
-                seqNum += 1
-
-                _, dateTime, user, ipAddress, udp_port_num = line.strip().split('; ')
-
-                # Write back all the users except current user + adjust sequence numbers
-                if user != self.username:
-                    f.write(f"{seqNum}; {dateTime}; {user}; {ipAddress}; {udp_port_num}\n")
-                    print(f"{user}; {ipAddress}; active since {dateTime}; {udp_port_num}.\n")
-
-        # Remove user from thread dict
+        # Remove user from thread dict + presence registry
         if self.username in active_clients:
-            del active_clients[self.username]
+            self.endSession()
             # At this point, logout has processed correctly
             logout_response["success"] = True
 
-        self.clientSocket.send(json.dumps(logout_response).encode())
+        logEvent(INFO, "logout", user=self.username, success=logout_response["success"], online=len(active_clients))
+
+        self.reply(logout_response)
         
         # End thread
         self.clientAlive = False
 
     #<----------------------------------------------->
+
+
+
+    # <---- METHOD: Send the messages queued while this user was offline ------>
+    def deliverBacklog(self, backlog):
+
+        def send(future):
+            backlog = None
+            try:
+                backlog = future.result()
+            except Exception:
+                logException("offlineDeliveryFailed", user=self.username)
+            finally:
+                self.releaseHeldFrames(backlog)
+
+        backlog.add_done_callback(send)
+    #<----------------------------------------------->
+
+
+
+    # <---- METHOD: Find a recipient's session, or queue the frame if they are offline ------>
+    # Returns a tuple: (status, session), where status is "sent", "queued", "full" or "unknown";
+    # the caller relays the frame to session when status is "sent".
+    # A recipient on another cluster node is forwarded the frame straight away, or added to
+    # forwards ({ nodeId: [recipient, ...] }) for the caller to forward to each node at once.
+    @staticmethod
+    def routeMessage(recipient, frame, forwards=None):
+
+        while True:
+
+            recipient_thread = active_clients.get(recipient)
+
+            if recipient_thread is not None:
+                return "sent", recipient_thread
+
+            node = cluster.locate(recipient) if cluster else None
+
+            if node is not None:
+                if forwards is None:
+                    cluster.forward(node, [recipient], frame)
+                else:
+                    forwards.setdefault(node, []).append(recipient)
+                return "sent", None
+
+            if recipient not in credentialStore:
+                return "unknown", None
+
+            # Rechecked under the store's lock; if the recipient just logged in, send it to them directly
+            status = offlineStore.add(recipient, frame, lambda: isOnline(recipient))
+
+            if status != "online":
+                return status, None
+    #<----------------------------------------------->
+
+
+
+    # <---- METHOD: Remove a logged in user from the online state ------>
+    def endSession(self):
+
+        # Only if this connection still owns the username; a newer login may have replaced it
+        if self.username and active_clients.get(self.username) is self:
+            del active_clients[self.username]
+            presence.remove(self.username)
+            groups.userOffline(self.username, self)
+
+            if cluster:
+                cluster.publish({"header": "userOffline", "user": self.username})
+    #<----------------------------------------------->
                 
     # <---- METHOD: Send message ------>
+    @requestHandlers.handler("sendMessage", sender=str, recipient=str, message=str)
     def sendMessage(self, sender, recipient, message):
 
-        recipient_thread = active_clients.get(recipient)
+        currentTime = datetime.now()
+        formattedTime = currentTime.strftime('%d %b %Y %H:%M:%S')
 
-        if recipient_thread:
-            try:
-                currentTime = datetime.now()
-                formattedTime = currentTime.strftime('%d %b %Y %H:%M:%S')
-
-                # Relay the message
-                recipient_thread.clientSocket.send(json.dumps({
-                    "header": "message",
-                    "timeSent": formattedTime,
-                    "from": sender,
-                    "message": message
-                }).encode())
-
-                # return message confirmation to sender
-                self.clientSocket.send(json.dumps({
-                    "header": "confirmSentMessage",
-                    "timeSent": formattedTime
-                }).encode())
-
-                # Add message to message log
-                messageLogManager(sender, message)
-                
-            except Exception as e:
-                print(f"Error sending message to {recipient}: {e}")
+        message_frame = {
+            "header": "message",
+            "timeSent": formattedTime,
+            "from": sender,
+            "message": message
+        }
+
+        try:
+            status, recipient_thread = self.routeMessage(recipient, message_frame)
+
+            # Relay the message; an offline recipient gets it when they next log in
+            if recipient_thread:
+                recipient_thread.sendResponse(message_frame)
+
+        except Exception:
+            logException("sendMessageFailed", user=sender, recipient=recipient)
+            status = "error"
+
+        # Every request gets a reply, so clients can match replies to the requests they have in flight
+        if status in ("sent", "queued"):
+
+            # return message confirmation to sender
+            self.reply({
+                "header": "confirmSentMessage",
+                "success": True,
+                "queued": status == "queued",
+                "timeSent": formattedTime
+            })
+
+            serverMetrics.messageSent("direct")
+
+            # Add message to message log
+            messageLogManager(sender, message, [recipient])
+
+        else:
+            self.reply({
+                "header": "confirmSentMessage",
+                "success": False,
+                "message": MESSAGE_ERRORS[status].format(recipient=recipient)
+            })
+    #<----------------------------------------------->
+
+    # <---- METHOD: Send one message to several users ------>
+    @requestHandlers.handler("sendBatchMessage", sender=str, recipients=ListOf(str), message=str)
+    def sendBatchMessage(self, sender, recipients, message):
+
+        formattedTime = datetime.now().strftime('%d %b %Y %H:%M:%S')
+
+        message_frame = {
+            "header": "message",
+            "timeSent": formattedTime,
+            "from": sender,
+            "message": message
+        }
+
+        # Delivery status per recipient, in the order they were given
+        statuses = {}
+        sessions = []
+        forwards = {}
+
+        try:
+            for recipient in recipients:
+                if recipient in statuses:
+                    continue
+
+                statuses[recipient], recipient_thread = self.routeMessage(recipient, message_frame, forwards)
+
+                if recipient_thread:
+                    sessions.append(recipient_thread)
+
+            # Relay the message in one fan-out; every recipient gets the same frame, so it is encoded once
+            if sessions:
+                broadcaster.broadcast(sessions, message_frame)
+
+            # and once per other node with recipients on it
+            if forwards:
+                cluster.forwardAll(forwards, message_frame)
+
+        except Exception:
+            logException("sendBatchMessageFailed", user=sender, recipients=",".join(recipients))
+
+        delivered = any(status in ("sent", "queued") for status in statuses.values())
+
+        # One log entry for the whole batch, indexed under each conversation it was delivered to
+        if delivered:
+            serverMetrics.messageSent("batch")
+            messageLogManager(sender, message, [recipient for recipient, status in statuses.items() if status in ("sent", "queued")])
+
+        # One confirmation listing every recipient's status
+        self.reply({
+            "header": "confirmBatchMessage",
+            "success": delivered,
+            "timeSent": formattedTime,
+            "recipients": statuses
+        })
     #<----------------------------------------------->
 
     # <---- METHOD: Create group ------>
-    def createGroup(self, creator, groupname, participants):
+    @requestHandlers.handler("createGroup", groupName=str, users=ListOf(str))
+    def createGroup(self, groupname, participants):
 
-        # Display to server
-        print(f"\n{creator} issued /creategroup command\n")
+        creator = self.username
 
         createGroup_response = {
             "header": "createGroup",
@@ -281,212 +543,858 @@ class ClientThread(Thread):
         # Group name already exists
         if groupname in groups:
             createGroup_response["message"] = f"\nA group chat (Name: {groupname}) already exists"
-            self.clientSocket.send(json.dumps(createGroup_response).encode())
-            print(f"Return message:\nGroup chat was not created. {createGroup_response['message']}")
+            self.reply(createGroup_response)
+            logEvent(DEBUG, "createGroupRejected", user=self.username, group=groupname, reason=createGroup_response["message"].strip())
             return
        
-        inactive_users = [user for user in participants if user not in active_clients]
+        inactive_users = [user for user in participants if not isOnline(user)]
 
         # A participant is not active
         if inactive_users:
             createGroup_response["message"] = f"\nCannot create group as the following participant(s) are inactive: {', '.join(inactive_users)}"
-            self.clientSocket.send(json.dumps(createGroup_response).encode())
-            print(f"Return message:\nGroup chat was not created. {createGroup_response['message']}")
+            self.reply(createGroup_response)
+            logEvent(DEBUG, "createGroupRejected", user=self.username, group=groupname, reason=createGroup_response["message"].strip())
             return            
 
-        # Add group members + groupname to group dict
-        groups[groupname] = []
-        groups[groupname].append({"username": creator, "hasJoined": True})
-
-        for participant in participants:
-            groups[groupname].append({"username": participant, "hasJoined": False})
+        # Add group members + groupname to the group registry; the creator joins straight away
+        if groups.create(groupname, creator, self, participants) is None:
+            createGroup_response["message"] = f"\nA group chat (Name: {groupname}) already exists"
+            self.reply(createGroup_response)
+            logEvent(DEBUG, "createGroupRejected", user=self.username, group=groupname, reason=createGroup_response["message"].strip())
+            return
 
         # Generate group message log
         groupMessageLogManager(groupname, creator, "")            
 
-        # Set the users join state
-        for user in groups[groupname]:
-            if user["username"] == self.username:
-                user["hasJoined"] = True
-                break
+        if cluster:
+            cluster.publish({"header": "groupCreated", "groupName": groupname, "creator": creator, "users": participants})
 
         # Send success result
         createGroup_response["success"] = True
         participants_str = ", ".join(participants)
         createGroup_response["message"] = f"\nGroup chat has been created, room name: {groupname}. Users in this room: {participants_str}."
-        self.clientSocket.send(json.dumps(createGroup_response).encode())
-       
-        # Display to server
-        print(f"Return message:\n{createGroup_response['message']}")
+        self.reply(createGroup_response)
+
+        logEvent(INFO, "groupCreated", user=creator, group=groupname, members=len(participants))
     #<----------------------------------------------->
 
 
     # <---- METHOD: Join group ------>
+    @requestHandlers.handler("joinGroup", groupName=str)
     def joinGroup(self, groupname):
 
-        # Display to server
-        print(f"\n{self.username} issued /joingroup command\n")
-
         joinGroup_response = {
             "header": "joinGroup",
             "success": False,
             "message": ""
         }
 
+        group = groups.get(groupname)
+
         # Group name doesn't exist
-        if groupname not in groups:
+        if group is None:
             joinGroup_response["message"] = f"\ngroup chat (Name: {groupname}) does not exist.\n"
-            self.clientSocket.send(json.dumps(joinGroup_response).encode())
-            print(f"Return message:\nGroup chat was not joined. {joinGroup_response['message']}")
+            self.reply(joinGroup_response)
+            logEvent(DEBUG, "joinGroupRejected", user=self.username, group=groupname, reason=joinGroup_response["message"].strip())
             return
     
-        # User is not a participant of group
-        groupParticipant = any(particpant["username"] == self.username for particpant in groups[groupname])
+        hasJoined = group.joinState(self.username)
 
-        if not groupParticipant:
+        # User is not a participant of group
+        if hasJoined is None:
             joinGroup_response["message"] = f"\nYou have not been added to the group (Name: {groupname}).\n"
-            self.clientSocket.send(json.dumps(joinGroup_response).encode())
-            print(f"Return message:\nGroup chat was not joined. {joinGroup_response['message']}")
+            self.reply(joinGroup_response)
+            logEvent(DEBUG, "joinGroupRejected", user=self.username, group=groupname, reason=joinGroup_response["message"].strip())
             return          
 
         # User has already joined the group
-        participant = next((participant for participant in groups[groupname] if participant["username"] == self.username), None)
-
-        if participant["hasJoined"]:
+        if hasJoined:
             joinGroup_response["message"] = f"\nYou have already joined group chat {groupname}.\n"
-            self.clientSocket.send(json.dumps(joinGroup_response).encode())
-            print(f"Return message:\nGroup chat was not joined. {joinGroup_response['message']}")
+            self.reply(joinGroup_response)
+            logEvent(DEBUG, "joinGroupRejected", user=self.username, group=groupname, reason=joinGroup_response["message"].strip())
             return              
 
         # get participant names
-        participants = [participant["username"] for participant in groups[groupname]]
+        participants = group.memberNames()
          
         # Set the users join state
-        for user in groups[groupname]:
-            if user["username"] == self.username:
-                user["hasJoined"] = True
-                break
+        groups.join(group, self.username, self)
+
+        if cluster:
+            cluster.publish({"header": "groupJoined", "groupName": groupname, "user": self.username})
         
         # Send success result
         joinGroup_response["success"] = True
         participants_str = ", ".join(participants)
         joinGroup_response["message"] = f"\nGroup chat has been joined, room name: {groupname}. Users in this room: {participants_str}."
-        self.clientSocket.send(json.dumps(joinGroup_response).encode())
-       
-        # Display to server
-        print(f"Return message:\n{joinGroup_response['message']}")
+        self.reply(joinGroup_response)
+
+        logEvent(INFO, "groupJoined", user=self.username, group=groupname)
     #<----------------------------------------------->
 
     # <---- METHOD: Message group ------>
+    @requestHandlers.handler("messageGroup", groupName=str, message=str)
     def messageGroup(self, groupname, message):
 
-        # Display to server
-        print(f"\n{self.username} issued /groupmsg command\n")
-
         msgGroup_response = {
             "header": "confirmGroupMessage",
             "success": False,
             "message": ""
         }
 
+        group = groups.get(groupname)
+
         # Group name doesn't exist
-        if groupname not in groups:
+        if group is None:
             msgGroup_response["message"] = f"\ngroup chat (Name: {groupname}) does not exist.\n"
-            self.clientSocket.send(json.dumps(msgGroup_response).encode())
-            print(f"Return message:\nGroup chat was not messaged. {msgGroup_response['message']}")
+            self.reply(msgGroup_response)
+            logEvent(DEBUG, "messageGroupRejected", user=self.username, group=groupname, reason=msgGroup_response["message"].strip())
             return
     
-        # User is not a participant of group
-        groupParticipant = any(particpant["username"] == self.username for particpant in groups[groupname])
+        hasJoined = group.joinState(self.username)
 
-        if not groupParticipant:
+        # User is not a participant of group
+        if hasJoined is None:
             msgGroup_response["message"] = f"\nYou have not been added to the group (Name: {groupname}).\n"
-            self.clientSocket.send(json.dumps(msgGroup_response).encode())
-            print(f"Return message:\nGroup chat was not messaged. {msgGroup_response['message']}")
+            self.reply(msgGroup_response)
+            logEvent(DEBUG, "messageGroupRejected", user=self.username, group=groupname, reason=msgGroup_response["message"].strip())
             return 
 
         # User is a participant but has not joined
-        participant = next((participant for participant in groups[groupname] if participant["username"] == self.username), None)
-
-        if not participant["hasJoined"]:
+        if not hasJoined:
             msgGroup_response["message"] = f"\nPlease join the group before sending messages, via /joingroup {groupname}.\n"
-            self.clientSocket.send(json.dumps(msgGroup_response).encode())
-            print(f"Return message:\nGroup chat was not messaged. {msgGroup_response['message']}")
+            self.reply(msgGroup_response)
+            logEvent(DEBUG, "messageGroupRejected", user=self.username, group=groupname, reason=msgGroup_response["message"].strip())
             return        
 
         # Send success result back to sender
         msgGroup_response["success"] = True
         msgGroup_response["message"] = f"\nMessage to group chat {groupname} has been sent."
-        self.clientSocket.send(json.dumps(msgGroup_response).encode())
+        self.reply(msgGroup_response)
        
-        # Send messages to participants of groupchat
-        activeParticipants = [participant["username"] for participant in groups[groupname] 
-                    if participant["hasJoined"] and participant["username"] != self.username]
+        # Send messages to participants of groupchat: the joined members who are online,
+        # and queue it for the joined members who are offline
+        activeParticipants, offlineParticipants = groups.audience(group, self.username)
        
         groupMessageLogManager(groupname, self.username, message)
+        serverMetrics.messageSent("group")
 
-        # Broadcast message to active participants in group
-        if activeParticipants:
-            for recipient in activeParticipants:
+        currentTime = datetime.now()
+        formattedTime = currentTime.strftime('%d %b %Y %H:%M:%S')
 
-                recipient_thread = active_clients.get(recipient)
+        groupMessage_frame = {
+            "header": "groupMessage",
+            "timeSent": formattedTime,
+            "groupName": groupname,
+            "from": self.username,
+            "message": message
+        }
 
-                if recipient_thread:
-                    try:
-                        currentTime = datetime.now()
-                        formattedTime = currentTime.strftime('%d %b %Y %H:%M:%S')
+        # Members logged in on other cluster nodes are sent the message through their node, one event per node
+        forwards = {}
+
+        try:
+            for participant in offlineParticipants:
+                _, participant_thread = self.routeMessage(participant, groupMessage_frame, forwards)
+
+                # Logged in since the snapshot was taken
+                if participant_thread:
+                    activeParticipants.append(participant_thread)
+
+            if forwards:
+                cluster.forwardAll(forwards, groupMessage_frame)
 
-                        # Relay the message
-                        recipient_thread.clientSocket.send(json.dumps({
-                            "header": "groupMessage",
-                            "timeSent": formattedTime,
-                            "groupName": groupname,
-                            "from": self.username,
-                            "message": message
-                        }).encode())
+            # Broadcast message to active participants in group; the frame is the same for everyone, so it is encoded once
+            if activeParticipants:
+                latency = broadcaster.broadcast(activeParticipants, groupMessage_frame)
 
-                    except Exception as e:
-                        print(f"Error sending message to group chat {groupname}: {e}")
+                logEvent(DEBUG, "groupBroadcast", sampled=True, group=groupname, members=len(activeParticipants),
+                         offline=len(offlineParticipants), latencyMs=round(latency * 1000, 3))
 
+        except Exception:
+            logException("messageGroupFailed", user=self.username, group=groupname)
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Read back message history ------>
+    @requestHandlers.handler("history", peer=Optional(str), groupName=Optional(str), since=Optional(Number),
+                             until=Optional(Number), limit=Optional(int, 50), cursor=Optional(int))
+    def getHistory(self, peer, groupname, since, until, limit, cursor):
+
+        source = self.historySource(peer, groupname)
+
+        if source is None:
+            return
 
-        # Display to server
-        print(f"Return message:\n{msgGroup_response['message']}")
+        try:
+            result = loadHistory(*source, since, until, limit, cursor)
+        except (OSError, ValueError) as e:
+            result = e
+
+        self.completeHistory(source[0], result)
+    #<----------------------------------------------->
+
+
+
+    # <---- METHOD: Pick the log and conversation a history request reads ------>
+    # Returns (logPath, conversation), or None once the request has been refused
+    def historySource(self, peer, groupname):
+
+        # A user can only read their own conversations and the groups they belong to
+        if groupname is not None:
+            group = groups.get(groupname)
+
+            if group is None or group.joinState(self.username) is None:
+                self.reply({
+                    "header": "history",
+                    "success": False,
+                    "message": f"\nYou are not in a group chat named {groupname}.\n"
+                })
+                return None
+
+            return f"{groupname}_messagelog.txt", None
+
+        if peer is not None:
+            return "messagelog.txt", conversationKey(self.username, peer)
+
+        self.reply({
+            "header": "history",
+            "success": False,
+            "message": "\nA history request needs a peer or a groupName.\n"
+        })
+        return None
+    #<----------------------------------------------->
+
+
+
+    # <---- METHOD: Reply with a page of history, or the error reading it raised ------>
+    def completeHistory(self, logPath, result):
+
+        history_response = {
+            "header": "history",
+            "success": False,
+            "message": ""
+        }
+
+        if isinstance(result, Exception):
+            logEvent(ERROR, "historyFailed", user=self.username, log=logPath, error=result)
+            history_response["message"] = "\nThe message history could not be read.\n"
+            self.reply(history_response)
+            return
+
+        history_response["success"] = True
+        history_response["messages"], history_response["nextCursor"] = result
+        self.reply(history_response)
     #<----------------------------------------------->
 
 
     # <---- METHOD: Confirm UDP ------>
+    @requestHandlers.handler("confirmUDP", message=str)
     def confirmUDP(self, message):
-        print("recv server")
+        logEvent(DEBUG, "confirmUDP", user=self.username)
         confirmUDP_response = {
             "header": "confirmUDP",
             "message": message
         }
 
-        self.clientSocket.send(json.dumps(confirmUDP_response).encode())
+        self.reply(confirmUDP_response)
     #<----------------------------------------------->
 
+
+
+class ClientThread(ClientSession, Thread):
+
+    # Init thread
+    def __init__(self, clientAddress, clientSocket):
+        Thread.__init__(self)
+        ClientSession.__init__(self, clientAddress)
+        self.clientSocket = clientSocket
+        self.frameReader = FrameReader(clientSocket)
+        self.outbound = OutboundQueue(clientSocket, **queueOptions)
+        serverMetrics.connectionOpened(self)
+
+
+    # <---- METHOD: Queue an encoded frame on this client's connection ------>
+    def queueEncoded(self, data):
+
+        # Other client threads relay messages to this client too; frames are queued and written by this client's writer thread
+        return self.outbound.put(data)
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Check whether the client has closed its end of the connection ------>
+    def peerClosed(self):
+
+        # Peeked without waiting, so it is safe while this client's thread is reading
+        try:
+            return self.clientSocket.recv(1, MSG_PEEK | MSG_DONTWAIT) == b""
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Listen to thread while alive ------>
+    def run(self):
+
+        dropped = False
+
+        try:
+            while self.clientAlive:
+ 
+                try:
+                    requests = self.frameReader.recvFrames()
+                except ConnectionResetError:
+                    requests = None
+
+                # if the request from client is empty, the client ended the connection to the server
+                if requests is None:
+                    break    
+
+                # A single read may hold several pipelined requests; handle them in order
+                for request in requests:
+                    self.handleRequest(request)
+
+                    if not self.clientAlive:
+                        break
+
+        # An oversized or malformed frame, or a handler that failed
+        except Exception as e:
+            self.dropConnection(e)
+            dropped = True
+
+        finally:
+            # The user is taken offline however the connection ended, so nothing more is routed to it
+            self.clientAlive = False
+            self.endSession()
+            logEvent(INFO, "connectionClosed", address=f"{self.clientAddress[0]}:{self.clientAddress[1]}", user=self.username)
+
+            # Let the writer send anything still queued (e.g. the logout response), then stop
+            self.outbound.close()
+
+            if dropped:
+                self.outbound.writer.join(self.outbound.backpressureTimeout)
+                self.clientSocket.close()
+
+            serverMetrics.connectionClosed(self)
+
+    #<----------------------------------------------->
+
+
+
+class AsyncClientSession(ClientSession):
+
+    # The shared handlers, with login replaced by one that awaits the credential check
+    requestHandlers = ClientSession.requestHandlers.copy()
+
+    # Init session for a connection accepted by the event loop
+    def __init__(self, reader, writer):
+        ClientSession.__init__(self, writer.get_extra_info("peername"))
+        self.reader = reader
+        self.writer = writer
+        self.frameReader = FrameReader()
+        self.outbound = AsyncOutboundQueue(writer, **queueOptions)
+        serverMetrics.connectionOpened(self)
+
+
+    # <---- METHOD: Queue an encoded frame on this client's connection ------>
+    def queueEncoded(self, data):
+
+        # Frames are queued and written by this client's writer task
+        return self.outbound.put(data)
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Check whether the client has closed its end of the connection ------>
+    def peerClosed(self):
+        return self.reader.at_eof() or self.writer.is_closing()
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Send the messages queued while this user was offline ------>
+    def deliverBacklog(self, backlog):
+
+        # Async queues may only be touched from the event loop, so wait for the backlog on it
+        async def send():
+            taken = None
+            try:
+                taken = await asyncio.wrap_future(backlog)
+            except Exception:
+                logException("offlineDeliveryFailed", user=self.username)
+            finally:
+                self.releaseHeldFrames(taken)
+
+        # Keep a reference so the task isn't collected before it finishes
+        self.backlogTask = asyncio.get_running_loop().create_task(send())
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Route a request to its handler ------>
+    async def handleRequestAsync(self, request):
+
+        self.requestId = request.get("requestId") if isinstance(request, dict) else None
+
+        try:
+            await self.requestHandlers.dispatchAsync(self, request)
+        except RequestError as e:
+            self.rejectRequest(e)
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Handle login ------>
+    @requestHandlers.handler("login", username=str, password=str, udp_port=int)
+    async def processLoginAsync(self, username, password, udp_port):
+
+        # Password hashing is awaited rather than blocking the loop, so other clients' messages
+        # keep being relayed during a burst of logins
+        validUser, validLogin = await asyncio.wrap_future(credentialStore.verify(username, password))
+        self.completeLogin(username, validUser, validLogin, udp_port)
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Read back message history ------>
+    @requestHandlers.handler("history", peer=Optional(str), groupName=Optional(str), since=Optional(Number),
+                             until=Optional(Number), limit=Optional(int, 50), cursor=Optional(int))
+    async def getHistoryAsync(self, peer, groupname, since, until, limit, cursor):
+
+        source = self.historySource(peer, groupname)
+
+        if source is None:
+            return
+
+        # Flushing the log writer and reading the log wait on the disk, so they run off the event loop
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(None, loadHistory, *source, since, until, limit, cursor)
+        except (OSError, ValueError) as e:
+            result = e
+
+        self.completeHistory(source[0], result)
+    #<----------------------------------------------->
+
+
+    # <---- METHOD: Listen to connection while alive ------>
+    async def run(self):
+
+        try:
+            while self.clientAlive:
+
+                try:
+                    data = await self.reader.read(RECV_SIZE)
+                except ConnectionError:
+                    data = b""
+
+                # if the request from client is empty, the client ended the connection to the server
+                if not data:
+                    break
+
+                # A single read may hold several pipelined requests; handle them in order
+                for request in self.frameReader.feed(data):
+                    await self.handleRequestAsync(request)
+
+                    # Backpressure: wait for any recipient queue this request overfilled
+                    congested = list(congestedQueues)
+                    congestedQueues.clear()
+                    for outbound in congested:
+                        await outbound.waitForSpace()
+
+                    if not self.clientAlive:
+                        break
+
+        except ConnectionError:
+            pass
+
+        # An oversized or malformed frame, or a handler that failed
+        except Exception as e:
+            self.dropConnection(e)
+
+        finally:
+            # The user is taken offline however the connection ended, so nothing more is routed to it
+            self.clientAlive = False
+            self.endSession()
+            logEvent(INFO, "connectionClosed", address=f"{self.clientAddress[0]}:{self.clientAddress[1]}", user=self.username)
+
+            # Let the writer send anything still queued (e.g. the logout response), then stop
+            try:
+                await asyncio.wait_for(self.outbound.close(), self.outbound.backpressureTimeout)
+            except asyncio.TimeoutError:
+                self.outbound.abort()
+
+            self.writer.close()
+            serverMetrics.connectionClosed(self)
+    #<----------------------------------------------->
+
+
 #-------------------------------- END CLASS DEFINITION -----------------------------------#
 
 
 
+# Reads a page of a log's history; blocks on the log writer and the disk
+# Returns (messages, nextCursor)
+def loadHistory(logPath, conversation, since, until, limit, cursor):
+
+    # Include messages that have been logged but are still waiting for the flusher
+    flushLogWriter(logPath)
+    return readHistory(logPath, conversation, since, until, limit, cursor)
+
+
+# Whether a user is logged in, on this node or another cluster node
+def isOnline(username):
+    return username in active_clients or (cluster is not None and cluster.locate(username) is not None)
+
+
+#-------------------------------- CLUSTER EVENTS -----------------------------------#
+# Handlers for events from other cluster nodes. In threaded mode they run on the bus's thread;
+# in async mode they run on the event loop, like request handlers.
+
+# A user logged in on another node
+@clusterEvents.handler("userOnline", user=str, address=str, udpPort=int, loginTime=str)
+def remoteUserOnline(fromNode, username, address, udpPort, loginTime):
+
+    # A login elsewhere replaces one here, as a second login on this node would
+    session = active_clients.pop(username, None)
+    if session is not None:
+        groups.userOffline(username, session)
+
+    presence.add(username, (address,), udpPort, loginTime)
+
+    # Messages queued here while they were offline follow them to their node; from the moment
+    # they are marked online under the store's lock, new messages are forwarded instead of queued
+    backlog = offlineStore.take(username, lambda: cluster.directory.userOnline(username, fromNode))
+
+    def forwardBacklog(future):
+        try:
+            taken = future.result()
+            for data in taken.frames:
+                cluster.forward(fromNode, [username], json.loads(data[frameHeader.size:]))
+            offlineStore.delivered(taken)
+        except Exception:
+            logException("offlineForwardFailed", user=username, node=fromNode)
+
+    backlog.add_done_callback(forwardBacklog)
+
+
+# A user on another node logged out or disconnected
+@clusterEvents.handler("userOffline", user=str)
+def remoteUserOffline(fromNode, username):
+
+    # Only if they haven't logged in somewhere else since
+    if cluster.directory.userOffline(username, fromNode):
+        presence.remove(username)
+
+
+# Relays a frame forwarded by another node to users logged in here
+@clusterEvents.handler("deliver", recipients=ListOf(str), frame=dict)
+def deliverForwarded(fromNode, recipients, frame):
+
+    sessions = []
+    forwards = {}
+
+    for recipient in recipients:
+
+        session = active_clients.get(recipient)
+        node = cluster.locate(recipient)
+
+        # Moved on to a third node since the sender's node routed the message
+        if session is None and node is not None and node != fromNode:
+            forwards.setdefault(node, []).append(recipient)
+
+        # Logged out since: the frame waits here until they next log in
+        elif session is None:
+            if offlineStore.add(recipient, frame, lambda: recipient in active_clients) == "online":
+                sessions.append(active_clients[recipient])
+
+        else:
+            sessions.append(session)
+
+    if sessions:
+        broadcaster.broadcast(sessions, frame)
+
+    if forwards:
+        cluster.forwardAll(forwards, frame)
+
+
+@clusterEvents.handler("groupCreated", groupName=str, creator=str, users=ListOf(str))
+def remoteGroupCreated(fromNode, groupname, creator, participants):
+
+    groups.merge(groupname, {creator: True, **{user: False for user in participants if user != creator}})
+
+
+@clusterEvents.handler("groupJoined", groupName=str, user=str)
+def remoteGroupJoined(fromNode, groupname, username):
+    groups.merge(groupname, {username: True})
+
+
+# A node that just joined the cluster asks every other node for its users and groups
+@clusterEvents.handler("syncRequest")
+def syncRequest(fromNode):
+
+    users = [presence.get(username) for username in list(active_clients)]
+
+    cluster.publish({
+        "header": "sync",
+        "users": [[user.username, user.address, user.udpPort, user.loginTime] for user in users if user],
+        "groups": groups.snapshot(),
+    }, fromNode)
+
+
+# Another node's answer to our syncRequest
+@clusterEvents.handler("sync", users=ListOf(list), groups=dict)
+def syncResponse(fromNode, users, groupMembers):
+
+    for username, address, udpPort, loginTime in users:
+        remoteUserOnline(fromNode, username, address, udpPort, loginTime)
+
+    for groupname, members in groupMembers.items():
+        groups.merge(groupname, members)
+
+    logEvent(INFO, "clusterSynced", node=fromNode, users=len(users), groups=len(groupMembers))
+
+
+# A node left the cluster; its users are offline until they log in again elsewhere
+@clusterEvents.handler("nodeDown", node=str)
+def nodeDown(fromNode, node):
+
+    removed = cluster.directory.nodeDown(node)
+    for username in removed:
+        presence.remove(username)
+
+    logEvent(INFO, "nodeDown", node=node, users=len(removed))
+
+
+# Lost the broker: this node carries on with its own users only
+@clusterEvents.handler("busClosed")
+def busClosed(fromNode):
+
+    removed = cluster.directory.nodeDown()
+    for username in removed:
+        presence.remove(username)
+
+    logEvent(ERROR, "clusterBusClosed", users=len(removed))
+
+#-------------------------------- END CLUSTER EVENTS -----------------------------------#
+
+
+
+# Per request latency since startup, busiest request type first
+def printCommandStats():
+
+    lines = commandStats.summary()
+
+    if lines:
+        print("\nRequest statistics:")
+        print("\n".join(lines))
+
+
+# The metrics listener's page, in the Prometheus text format
+def collectMetrics():
+
+    page = MetricsPage()
+    stats = serverMetrics.snapshot()
+
+    page.add("messenger_uptime_seconds", "gauge", "Seconds since the server started.", stats["uptimeSeconds"])
+    page.add("messenger_connections", "gauge", "Open client connections.", stats["connections"])
+    page.add("messenger_connections_total", "counter", "Client connections accepted.", stats["connectionsTotal"])
+    page.add("messenger_logged_in_users", "gauge", "Users logged in.", len(active_clients))
+
+    if cluster:
+        page.add("messenger_cluster_remote_users", "gauge", "Users logged in on other cluster nodes.", len(cluster.directory))
+    page.add("messenger_login_failures_total", "counter", "Failed logins, unknown users included.", stats["loginFailures"])
+    page.add("messenger_received_bytes_total", "counter", "Bytes received from clients.", stats["bytesIn"])
+    page.add("messenger_sent_bytes_total", "counter", "Bytes written to clients.", stats["bytesOut"])
+    page.add("messenger_messages_total", "counter", "Direct, batch and group messages sent.",
+             [({"kind": kind}, count) for kind, count in stats["messages"].items()])
+    page.add("messenger_messages_per_second", "gauge", "Messages sent per second, over the last 10 seconds.", stats["messagesPerSecond"])
+
+    queues = outboundQueueMetrics()
+    page.add("messenger_outbound_queue_depth", "gauge", "Frames waiting to be written to each logged in user.",
+             [({"user": username}, metrics["depth"]) for username, metrics in queues.items()])
+    page.add("messenger_outbound_queue_peak_depth", "gauge", "Deepest each logged in user's queue has been.",
+             [({"user": username}, metrics["peakDepth"]) for username, metrics in queues.items()])
+    page.add("messenger_outbound_dropped_frames_total", "counter", "Frames dropped from each logged in user's full queue.",
+             [({"user": username}, metrics["droppedFrames"]) for username, metrics in queues.items()])
+
+    page.add("messenger_offline_queue_depth", "gauge", "Messages waiting for each offline user.",
+             [({"user": username}, depth) for username, depth in offlineStore.depths().items()])
+    page.add("messenger_log_writer_lag", "gauge", "Log entries queued but not yet written, per log file.",
+             [({"log": path}, writer.lag()) for path, writer in list(logWriters.items())])
+
+    broadcasts = broadcaster.stats()
+    page.add("messenger_broadcasts_total", "counter", "Group message fan-outs.", broadcasts["broadcasts"])
+    page.add("messenger_broadcast_recipients_total", "counter", "Sessions group messages were fanned out to.", broadcasts["recipients"])
+    page.add("messenger_broadcast_latency_seconds_max", "gauge", "Slowest group message fan-out.", broadcasts["maxLatency"])
+
+    commands = commandStats.snapshot()
+    page.addHistogram("messenger_request_duration_seconds", "Time to handle each request, by request header.", "command",
+                      {header: (command["buckets"], command["totalSeconds"], command["count"]) for header, command in commands.items()})
+    page.add("messenger_request_errors_total", "counter", "Requests that were rejected or whose handler failed, by request header.",
+             [({"command": header}, command["errors"]) for header, command in commands.items()])
+
+    return page.text()
+
+
+# Outbound queue metrics for every online user: { username: metrics }
+def outboundQueueMetrics():
+    return {username: session.outbound.metrics() for username, session in list(active_clients.items())}
+
+
+# Runs the asyncio server: each connection is an AsyncClientSession coroutine on one event loop
+async def runAsyncServer(serverHost, serverPort):
+
+    async def acceptConnection(reader, writer):
+        await AsyncClientSession(reader, writer).run()
+
+    # Cluster events are handled on the event loop, like requests
+    if cluster:
+        cluster.start(asyncio.get_running_loop().call_soon_threadsafe)
+
+    # Nodes of a cluster on one host can share the port, and the kernel spreads connections across them
+    server = await asyncio.start_server(acceptConnection, serverHost, serverPort, backlog=4096, reuse_port=bool(cluster) or None)
+
+    async with server:
+        await server.serve_forever()
+
+
+# Idle connections in async mode are limited by open file descriptors rather than threads,
+# so raise the soft limit as far as the hard limit allows
+def raiseFileLimit():
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
 def main():
 
-    global allowedAttempts
+    global allowedAttempts, serverOptions, credentialStore, loginThrottle, presence, broadcaster, offlineStore, metricsServer, cluster
 
     # Get port and set attempt no's
     try:
         serverPort, allowedAttempts = serverArgHandler()
+        serverOptions = serverOptionHandler(serverOptions)
+
+        if serverOptions["mode"] not in ("threaded", "async"):
+            raise ValueError(f"Invalid server mode: {serverOptions['mode']}")
+
+        if serverOptions["fsync"] not in FSYNC_POLICIES:
+            raise ValueError(f"Invalid fsync policy: {serverOptions['fsync']}")
+
+        if serverOptions["overflowPolicy"] not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {serverOptions['overflowPolicy']}")
+
+        if serverOptions["queueDepth"] < 1:
+            raise ValueError(f"Invalid queue depth: {serverOptions['queueDepth']}")
+
+        if serverOptions["userlogInterval"] <= 0:
+            raise ValueError(f"Invalid userlog interval: {serverOptions['userlogInterval']}")
+
+        if serverOptions["broadcastWorkers"] < 0:
+            raise ValueError(f"Invalid broadcast worker count: {serverOptions['broadcastWorkers']}")
+
+        if serverOptions["offlineLimit"] < 0 or serverOptions["offlineMemory"] < 0:
+            raise ValueError("Offline message limits cannot be negative")
+
+        if min(serverOptions["logSegmentSize"], serverOptions["logSegmentAge"],
+               serverOptions["logRetainSegments"], serverOptions["logRetainDays"]) < 0:
+            raise ValueError("Log segment and retention limits cannot be negative")
+
+        checkCompression(serverOptions["logCompression"])
+
+        if serverOptions["logSample"] < 1:
+            raise ValueError(f"Invalid log sample rate: {serverOptions['logSample']}")
+
+        # Server events are written to the console by a background thread from here on
+        logListener = startLogging(serverOptions["logLevel"], serverOptions["logFormat"], serverOptions["logSample"])
+
     except ValueError as error:
         print(f"{error}", file=sys.stderr)
         sys.exit(1)
 
+    # Load credentials once; the store reloads itself if the file changes
+    credentialStore = CredentialStore("credentials.txt")
+    logWriterOptions.update({
+        "fsyncPolicy": serverOptions["fsync"],
+        "segmentBytes": serverOptions["logSegmentSize"],
+        "segmentAge": serverOptions["logSegmentAge"],
+        "compression": serverOptions["logCompression"],
+        "retainSegments": serverOptions["logRetainSegments"],
+        "retainAge": serverOptions["logRetainDays"] * 24 * 60 * 60,
+    })
+    queueOptions.update({
+        "maxDepth": serverOptions["queueDepth"],
+        "overflowPolicy": serverOptions["overflowPolicy"],
+        "backpressureTimeout": serverOptions["backpressureTimeout"],
+    })
+    # Async queues may only be touched from the event loop, so only the threaded server gets a writer pool
+    if serverOptions["mode"] == "threaded":
+        broadcaster = Broadcaster(serverOptions["broadcastWorkers"])
+
+    presence = PresenceRegistry("userlog.txt", serverOptions["userlogInterval"])
+    offlineStore = OfflineStore("offline_messages", serverOptions["offlineMemory"], serverOptions["offlineLimit"])
+    loginThrottle = LoginThrottle(allowedAttempts, recordsPath="attempt_records.txt" if serverOptions["persistAttempts"] else None)
+
+    # Join the cluster; events from other nodes are held until this node starts serving
+    if serverOptions["cluster"]:
+        try:
+            nodeId = serverOptions["clusterNode"] or f"{gethostname()}-{os.getpid()}"
+            cluster = ClusterNode(SocketBus(serverOptions["cluster"]), nodeId, clusterEvents)
+        except (OSError, ClusterError) as error:
+            print(f"Cannot join the cluster: {error}", file=sys.stderr)
+            sys.exit(1)
+
+        print(f"===== Node {cluster.nodeId} joined the cluster @ {serverOptions['cluster']} =====")
+
+    # Optional admin listener for live metrics, on localhost or a Unix socket only
+    if serverOptions["metricsPort"] or serverOptions["metricsSocket"]:
+        try:
+            metricsServer = MetricsServer(collectMetrics, serverOptions["metricsPort"], serverOptions["metricsSocket"])
+        except OSError as error:
+            print(f"Cannot start the metrics listener: {error}", file=sys.stderr)
+            sys.exit(1)
+
+        print(f"===== Metrics are served @ {metricsServer.address} =====")
 
     # Set host on localhost
     serverHost = "127.0.0.1"
     serverAddress = (serverHost, serverPort)
 
+    # Async mode: single event loop
+    if serverOptions["mode"] == "async":
+
+        raiseFileLimit()
+
+        print(f"\n===== Server is running @ {serverHost}, port:{serverPort} (async mode) =====")
+        print("===== Waiting for connection request from clients... =====")
+
+        try:
+            asyncio.run(runAsyncServer(serverHost, serverPort))
+        except KeyboardInterrupt:
+            print("\nExiting on keyboard interrupt...")
+        finally:
+            if cluster:
+                cluster.close()
+            if metricsServer:
+                metricsServer.close()
+            presence.close()
+            offlineStore.close()
+            closeLogWriters()
+            printCommandStats()
+            stopLogging(logListener)
+            print("Server socket is now closed.")
+            sys.exit(0)
+
     # define socket for the server side and bind address
     serverSocket = socket(AF_INET, SOCK_STREAM)
+
+    # Nodes of a cluster on one host can share the port, and the kernel spreads connections across them
+    if cluster:
+        serverSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        cluster.start()
+
     serverSocket.bind(serverAddress)
 
     print(f"\n===== Server is running @ {serverHost}, port:{serverPort} =====")
@@ -505,6 +1413,15 @@ def main():
         print("\nExiting on keyboard interrupt...")
     finally:
         serverSocket.close()
+        if cluster:
+            cluster.close()
+        if metricsServer:
+            metricsServer.close()
+        presence.close()
+        offlineStore.close()
+        closeLogWriters()
+        printCommandStats()
+        stopLogging(logListener)
         print("Server socket is now closed.")
         sys.exit(0)
 
@@ -0,0 +1,77 @@
+# Written by Vimukthi Herath
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fileHandlers import LogWriter
+from historyHandlers import readHistory, indexPath
+
+
+# Every entry must stay one line of the log, whatever its message holds
+class LogEntriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "messagelog.txt")
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def openWriter(self):
+        return LogWriter(self.path, fsyncPolicy="never")
+
+
+    def test_multiLineMessageSurvivesRestart(self):
+
+        messages = ["first", "two\nlines", "carriage\r\nreturn", "back\\slash \\n", "last"]
+
+        writer = self.openWriter()
+        seqNumbers = [writer.append("Yoda", message, conversations=["Chewy Yoda"]) for message in messages]
+        writer.close()
+
+        self.assertEqual(seqNumbers, [1, 2, 3, 4, 5])
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(len(f.readlines()), len(messages))
+
+        # Rebuilt from the log when the writer is reopened
+        os.remove(indexPath(self.path))
+
+        writer = self.openWriter()
+        self.assertEqual(writer.append("Yoda", "after restart"), 6)
+        writer.close()
+
+        entries, _ = readHistory(self.path, limit=500)
+        self.assertEqual([entry["seq"] for entry in entries], [6, 5, 4, 3, 2, 1])
+        self.assertEqual([entry["message"] for entry in reversed(entries)], messages + ["after restart"])
+
+        entries, _ = readHistory(self.path, "Chewy Yoda", limit=500)
+        self.assertEqual([entry["message"] for entry in reversed(entries)], messages)
+
+
+    # Logs written before line breaks were escaped can already hold an entry split over several lines
+    def test_unescapedMultiLineEntryInOlderLog(self):
+
+        with open(self.path, 'w') as f:
+            f.write("1; 18 Oct 2026 09:00:00; Yoda; one\n"
+                    "2; 18 Oct 2026 09:00:01; Yoda; two\n"
+                    "3 lines; later\n"
+                    "3; 18 Oct 2026 09:00:02; Yoda; three\n")
+
+        writer = self.openWriter()
+        self.assertEqual(writer.append("Yoda", "four"), 4)
+        writer.close()
+
+        entries, _ = readHistory(self.path, limit=500)
+        self.assertEqual([entry["seq"] for entry in entries], [4, 3, 2, 1])
+        self.assertEqual(entries[2]["message"], "two\n3 lines; later")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+# Written by Vimukthi Herath
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fileHandlers import LogWriter
+from historyHandlers import readHistory
+from segmentHandlers import closedSegments
+
+
+# Sequence numbers must keep counting up across restarts, even once retention has deleted old segments
+class LogRetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "messagelog.txt")
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def openWriter(self):
+        return LogWriter(self.path, fsyncPolicy="never", segmentBytes=200, retainAge=0.5)
+
+
+    def writeEntries(self, count):
+
+        writer = self.openWriter()
+        seqNumbers = []
+
+        # One batch per entry, so the active segment is rotated as soon as it is full
+        for i in range(count):
+            seqNumbers.append(writer.append("Yoda", f"message {i}"))
+            writer.flush()
+
+        writer.close()
+
+        return seqNumbers
+
+
+    def logSeqNumbers(self):
+        with open(self.path) as f:
+            return [int(line.split("; ", 1)[0]) for line in f]
+
+
+    def test_restartAfterRetentionDeletesClosedSegments(self):
+
+        first = self.writeEntries(12)
+        self.assertEqual(first, list(range(1, 13)))
+
+        # Every closed segment but the newest is past the retention age by the next start
+        time.sleep(0.6)
+        second = self.writeEntries(3)
+        time.sleep(0.6)
+        third = self.writeEntries(3)
+
+        self.assertEqual(second, [13, 14, 15])
+        self.assertEqual(third, [16, 17, 18])
+        self.assertTrue(closedSegments(self.path))
+
+        seqNumbers = self.logSeqNumbers()
+        self.assertEqual(seqNumbers, sorted(seqNumbers))
+
+        messages, _ = readHistory(self.path, limit=500)
+        seqs = [message["seq"] for message in messages]
+        self.assertEqual(seqs, sorted(seqs, reverse=True))
+        self.assertEqual(seqs[0], 18)
+
+
+if __name__ == "__main__":
+    unittest.main()
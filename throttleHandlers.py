@@ -0,0 +1,152 @@
+# Written by Vimukthi Herath
+
+import os
+import time
+from collections import deque
+from threading import Lock
+
+BLOCK_WINDOW = 10 # seconds
+
+
+# Failed login attempts for one user
+class AttemptRecord:
+
+    def __init__(self, allowedAttempts):
+        # Only the attempts inside the window matter, and never more than one past the limit
+        self.failures = deque(maxlen=allowedAttempts + 1)
+        self.blockedUntil = 0.0
+
+
+# Thread-safe table of failed logins keyed by username.
+# Failures are counted over a sliding window, and a user is blocked for the window once the
+# allowed number of attempts is reached. Entries are evicted once nothing in them is still live.
+# If recordsPath is given, every change is appended to it as a snapshot of that user's entry,
+# and the table is rebuilt from those snapshots on startup.
+class LoginThrottle:
+
+    def __init__(self, allowedAttempts, window=BLOCK_WINDOW, recordsPath=None):
+        self.allowedAttempts = allowedAttempts
+        self.window = window
+        self.records = {}
+        self.lock = Lock()
+        self.lastSweep = time.time()
+        self.recordsFile = None
+
+        if recordsPath:
+            self.loadRecords(recordsPath)
+            self.recordsFile = open(recordsPath, 'a', buffering=1)
+
+
+    # Rebuilds the table from the snapshot file, then compacts the file down to the live entries
+    def loadRecords(self, recordsPath):
+
+        currentTime = time.time()
+
+        try:
+            with open(recordsPath, 'r') as f:
+                for line in f:
+                    try:
+                        user, attempts, lastAttemptTime, blockedUntil = line.split()
+                        attempts, lastAttemptTime, blockedUntil = int(attempts), float(lastAttemptTime), float(blockedUntil)
+                    except ValueError:
+                        # Skip a line left partly written by a crash
+                        continue
+
+                    record = AttemptRecord(self.allowedAttempts)
+                    record.failures.extend([lastAttemptTime] * min(attempts, self.allowedAttempts + 1))
+                    record.blockedUntil = blockedUntil
+                    self.records[user] = record
+
+        except FileNotFoundError:
+            return
+
+        for user in list(self.records):
+            if self.expired(self.records[user], currentTime):
+                del self.records[user]
+
+        with open(recordsPath + ".tmp", 'w') as f:
+            for user, record in self.records.items():
+                f.write(self.snapshot(user, record))
+
+        os.replace(recordsPath + ".tmp", recordsPath)
+
+
+    # Returns the snapshot line for a user's entry
+    def snapshot(self, user, record):
+        return f"{user} {len(record.failures)} {record.failures[-1]} {record.blockedUntil}\n"
+
+
+    # An entry is dead once its block is over and all its failures are older than the window
+    def expired(self, record, currentTime):
+        return currentTime >= record.blockedUntil and (not record.failures or currentTime - record.failures[-1] > self.window)
+
+
+    # Drops dead entries; runs at most once per window so the cost stays amortised
+    def sweep(self, currentTime):
+
+        if currentTime - self.lastSweep < self.window:
+            return
+
+        for user in [user for user, record in self.records.items() if self.expired(record, currentTime)]:
+            del self.records[user]
+
+        self.lastSweep = currentTime
+
+
+    # Checks block status
+    def isBlocked(self, username):
+
+        currentTime = time.time()
+
+        with self.lock:
+            record = self.records.get(username)
+
+            if record is None:
+                return False
+
+            if self.expired(record, currentTime):
+                del self.records[username]
+                return False
+
+            return currentTime < record.blockedUntil
+
+
+    # Records a failed attempt
+    # Returns a tuple: (errorMessage, blockStatus)
+    def recordFailure(self, username):
+
+        currentTime = time.time()
+        message = "Invalid Password. Please try again" # default error message
+        blockStatus = False
+
+        with self.lock:
+
+            self.sweep(currentTime)
+
+            record = self.records.get(username)
+            if record is None:
+                record = self.records[username] = AttemptRecord(self.allowedAttempts)
+
+            # Forget failures that have slid out of the window
+            while record.failures and currentTime - record.failures[0] > self.window:
+                record.failures.popleft()
+
+            record.failures.append(currentTime)
+            currentAttempt = len(record.failures)
+
+            # Check no. of attempts
+            if currentAttempt == self.allowedAttempts:
+                message = "Invalid Password. Your account has been blocked. Please try again later\n"
+                blockStatus = True
+            # attempts exceeded within the window
+            elif currentAttempt > self.allowedAttempts:
+                message = "Your account is blocked due to multiple login failures. Please try again later\n"
+                blockStatus = True
+
+            if blockStatus:
+                record.blockedUntil = currentTime + self.window
+
+            if self.recordsFile:
+                self.recordsFile.write(self.snapshot(username, record))
+
+        return message, blockStatus
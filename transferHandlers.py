@@ -0,0 +1,814 @@
+# Written by Vimukthi Herath
+
+import os
+import glob
+import json
+import mmap
+import time
+import zlib
+import random
+import select
+import struct
+from collections import deque
+import socket as sockets
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF, MSG_DONTWAIT, IPPROTO_UDP
+from logHandlers import logEvent, WARNING
+
+# Reliable file transfer over UDP, used by /p2pvideo.
+#
+# Every datagram starts with a type and the sender's random transfer id.
+#   START     sender -> receiver   json manifest: presenter, filename, size, chunkSize, mtime
+#   START_ACK receiver -> sender   the chunks the receiver already holds, in the same form as an ACK
+#   DATA      sender -> receiver   sequence number + CRC-32 of the chunk + one chunk of the file
+#   ACK       receiver -> sender   cumulative ack (first missing chunk) + bitmap of the window of chunks after it
+#   FIN       sender -> receiver   every chunk has been acked
+#   FIN_ACK   receiver -> sender   the file is complete on disk
+# The sender keeps a sliding window of unacked chunks in flight and retransmits those that time out,
+# or that a selective ack shows as a hole. The receiver writes each chunk at its offset in a preallocated
+# <name>.part file, and drops any chunk whose checksum doesn't match so it is resent.
+#
+# Transfers are resumable. The receiver regularly records which chunks have arrived in <name>.part.state,
+# next to the manifest. When the same presenter sends the same file again (same size and modification time),
+# the receiver picks the partial file back up and its START_ACK tells the sender to send only what is missing.
+START, START_ACK, DATA, ACK, FIN, FIN_ACK = range(1, 7)
+
+packetHeader = struct.Struct("!BI") # type, transfer id
+dataHeader = struct.Struct("!BIII") # type, transfer id, sequence number, CRC-32 of the chunk
+ackHeader = struct.Struct("!BII") # type, transfer id, cumulative ack; followed by the selective ack bitmap
+ackField = struct.Struct("!I") # cumulative ack, for building ACK and START_ACK payloads
+
+MAX_DATAGRAM = 1472 # 1500 byte Ethernet MTU, less the IP and UDP headers
+CHUNK_SIZE = MAX_DATAGRAM - dataHeader.size
+WINDOW = 512 # Chunks in flight
+SACK_BYTES = WINDOW // 8 # The selective ack bitmap covers a whole window, so no chunk that arrived is ever resent on a timeout
+bitChars = bytes.maketrans(b"\x00\x01", b"01") # received flags -> binary digits, to build the bitmap in one step
+
+MAX_CHUNKS = 1 << 26 # Largest file a receiver takes; it keeps a byte per chunk (a 64 MB table at the limit)
+
+MIN_RTO = 0.02
+MAX_RTO = 2.0
+HANDSHAKE_RETRIES = 10
+ACK_EVERY = 16 # The receiver acks at least every ACK_EVERY new chunks
+ACK_INTERVAL = 0.02 # ...and whenever the sender goes quiet for this long
+IDLE_TIMEOUT = 30.0 # A transfer with no traffic for this long is abandoned
+STATE_INTERVAL = 1.0 # How often a receiver persists which chunks have arrived
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+# UDP generic segmentation offload (Linux 4.18+): one sendmsg carrying up to SEGMENT_BATCH chunks
+# is split by the kernel into MAX_DATAGRAM sized datagrams. Python only names the option on newer versions.
+UDP_SEGMENT = getattr(sockets, "UDP_SEGMENT", 103)
+SEGMENT_BATCH = 65000 // MAX_DATAGRAM
+
+# A partial transfer is only resumed if all of these match the new transfer's manifest
+MANIFEST_KEYS = ("presenter", "filename", "size", "chunkSize", "mtime")
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".part.state"
+
+
+class TransferError(Exception):
+    pass
+
+
+# Raises ValueError unless a START manifest describes a file a receiver can take
+def checkManifest(metadata):
+
+    if not isinstance(metadata, dict):
+        raise ValueError("The manifest is not a json object")
+
+    presenter, filename, size, chunkSize, mtime = (metadata.get(key) for key in MANIFEST_KEYS)
+
+    if not isinstance(presenter, str) or not isinstance(filename, str) or not os.path.basename(filename):
+        raise ValueError("The manifest has no presenter or file name")
+
+    if type(size) is not int or type(chunkSize) is not int or type(mtime) not in (int, float):
+        raise ValueError("The manifest's size, chunk size and modification time must be numbers")
+
+    # A chunk has to fit in one datagram, and there can't be more chunks than the receiver is willing to track
+    if not 0 < chunkSize <= CHUNK_SIZE or not 0 <= size <= chunkSize * MAX_CHUNKS:
+        raise ValueError(f"Invalid manifest: {size} bytes in chunks of {chunkSize}")
+
+
+# Sends one file to a receiver's UDP address
+class TransferSender:
+
+    def __init__(self, address, path, presenter, filename, window=WINDOW):
+        self.address = address
+        self.path = path
+        self.presenter = presenter
+        self.filename = filename
+        self.window = window
+
+        self.transferId = random.getrandbits(32)
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.chunks = -(-self.size // CHUNK_SIZE)
+
+        self.acked = bytearray(self.chunks)
+        self.retransmitted = bytearray(self.chunks)
+        self.ackedCount = 0
+        self.resumedChunks = 0 # Chunks the receiver already had from an interrupted attempt
+        self.base = 0 # Lowest unacked chunk
+        self.nextSeq = 0 # Next chunk never sent
+        self.sentAt = {} # Stores { seq: time last sent } for chunks in flight
+        self.sendOrder = deque() # (time sent, seq) in send order, for retransmit timeouts
+
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = 0.25
+        self.ackedAtLastExpiry = -1
+        self.segmented = False
+
+
+    # Runs the whole transfer; raises TransferError if the receiver stops responding
+    def send(self):
+
+        with socket(AF_INET, SOCK_DGRAM) as sock, open(self.path, 'rb') as f:
+
+            self.sock = sock
+            self.enableSegmentation()
+
+            # Chunks are sent straight out of the page cache as slices of the mapped file, never copied
+            fileMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+            self.view = memoryview(fileMap) if fileMap else memoryview(b"")
+
+            try:
+                self.transfer()
+            finally:
+                self.view.release()
+                if fileMap:
+                    fileMap.close()
+
+
+    # Handshake, data and FIN, once the socket and the mapped file are ready
+    def transfer(self):
+
+        metadata = json.dumps({
+            "presenter": self.presenter,
+            "filename": self.filename,
+            "size": self.size,
+            "chunkSize": CHUNK_SIZE,
+            "mtime": self.mtime,
+        }).encode()
+
+        reply = self.handshake(START, START_ACK, metadata)
+        if reply is None:
+            raise TransferError(f"{self.address[0]}:{self.address[1]} did not respond")
+
+        # Skip whatever the receiver kept from an earlier attempt
+        self.applyAck(reply)
+        self.resumedChunks = self.ackedCount
+        self.nextSeq = self.base
+
+        lastProgress = time.monotonic()
+
+        while self.ackedCount < self.chunks:
+
+            ackedBefore = self.ackedCount
+
+            self.fillWindow()
+            self.waitForAcks()
+            self.retransmitExpired()
+
+            if self.ackedCount != ackedBefore:
+                lastProgress = time.monotonic()
+            elif time.monotonic() - lastProgress > IDLE_TIMEOUT:
+                raise TransferError("Receiver stopped acknowledging data")
+
+        # Every chunk is acked, so the receiver has the whole file even if the FIN_ACK is lost
+        self.handshake(FIN, FIN_ACK)
+
+
+    # Sends a control packet until the matching reply arrives
+    # Returns the reply, or None if the receiver never answered
+    def handshake(self, packetType, replyType, payload=b""):
+
+        packet = packetHeader.pack(packetType, self.transferId) + payload
+        wait = self.rto
+
+        for _ in range(HANDSHAKE_RETRIES):
+
+            self.sock.sendto(packet, self.address)
+            deadline = time.monotonic() + wait
+
+            while (remaining := deadline - time.monotonic()) > 0:
+                readable, _, _ = select.select([self.sock], [], [], remaining)
+                if not readable:
+                    break
+
+                data, _ = self.sock.recvfrom(MAX_DATAGRAM)
+                if len(data) >= packetHeader.size and packetHeader.unpack_from(data) == (replyType, self.transferId):
+                    return data
+
+            wait = min(wait * 2, MAX_RTO)
+
+        return None
+
+
+    # Turns on UDP segmentation offload if the kernel supports it
+    def enableSegmentation(self):
+        try:
+            self.sock.setsockopt(IPPROTO_UDP, UDP_SEGMENT, MAX_DATAGRAM)
+            self.segmented = True
+        except OSError:
+            self.segmented = False
+
+
+    def disableSegmentation(self):
+        self.segmented = False
+        try:
+            self.sock.setsockopt(IPPROTO_UDP, UDP_SEGMENT, 0)
+        except OSError:
+            pass
+
+
+    # Sends new chunks until the window is full, in batches of consecutive chunks
+    def fillWindow(self):
+        while self.nextSeq < self.chunks and self.nextSeq - self.base < self.window:
+
+            # Already on the receiver's disk from an interrupted attempt
+            if self.acked[self.nextSeq]:
+                self.nextSeq += 1
+                continue
+
+            count = min(self.chunks - self.nextSeq, self.window - (self.nextSeq - self.base), SEGMENT_BATCH if self.segmented else 1)
+
+            held = self.acked.find(1, self.nextSeq, self.nextSeq + count)
+            if held != -1:
+                count = held - self.nextSeq
+
+            self.sendChunks(self.nextSeq, count)
+            self.nextSeq += count
+
+
+    # Sends chunks first .. first + count - 1.
+    # Each datagram is gathered from its header and a slice of the mapped file. With segmentation
+    # offload, the whole batch goes out in one system call; every chunk but the file's last is
+    # exactly CHUNK_SIZE, so the kernel splits it back into one datagram per chunk.
+    def sendChunks(self, first, count=1):
+
+        if count > 1:
+            buffers = []
+            for seq in range(first, first + count):
+                chunk = self.view[seq * CHUNK_SIZE:(seq + 1) * CHUNK_SIZE]
+                buffers.append(dataHeader.pack(DATA, self.transferId, seq, zlib.crc32(chunk)))
+                buffers.append(chunk)
+
+            try:
+                self.sock.sendmsg(buffers, (), 0, self.address)
+            except OSError:
+                # The route or device can't segment (EIO), so fall back to a datagram per chunk
+                self.disableSegmentation()
+                for seq in range(first, first + count):
+                    self.sendChunk(seq)
+
+        else:
+            self.sendChunk(first)
+
+        sentTime = time.monotonic()
+        for seq in range(first, first + count):
+            self.sentAt[seq] = sentTime
+            self.sendOrder.append((sentTime, seq))
+
+
+    def sendChunk(self, seq):
+        chunk = self.view[seq * CHUNK_SIZE:(seq + 1) * CHUNK_SIZE]
+        self.sock.sendmsg([dataHeader.pack(DATA, self.transferId, seq, zlib.crc32(chunk)), chunk], (), 0, self.address)
+
+
+    # Waits until an ack arrives or the oldest chunk in flight times out, then reads every queued ack
+    def waitForAcks(self):
+
+        if self.sendOrder:
+            timeout = max(0.0, self.sendOrder[0][0] + self.rto - time.monotonic())
+        else:
+            timeout = self.rto
+
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+
+        while readable:
+            try:
+                data, _ = self.sock.recvfrom(MAX_DATAGRAM, MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+
+            self.handleAck(data)
+
+
+    def handleAck(self, data):
+        if len(data) >= packetHeader.size and packetHeader.unpack_from(data) == (ACK, self.transferId):
+            self.applyAck(data)
+
+
+    # Marks the chunks an ACK or START_ACK reports as received, and fast retransmits the holes
+    def applyAck(self, data):
+
+        if len(data) != ackHeader.size + SACK_BYTES:
+            return
+
+        (_, _, cumulative) = ackHeader.unpack_from(data)
+        bitmap = int.from_bytes(data[ackHeader.size:], "little")
+
+        for seq in range(self.base, min(cumulative, self.chunks)):
+            self.markAcked(seq)
+
+        seq = cumulative + 1
+        highestSacked = cumulative
+        while bitmap:
+            if bitmap & 1:
+                self.markAcked(seq)
+                highestSacked = seq
+            bitmap >>= 1
+            seq += 1
+
+        while self.base < self.chunks and self.acked[self.base]:
+            self.base += 1
+
+        # Fast retransmit: every hole below the highest selectively acked chunk was lost or reordered.
+        # Each is resent at most once per round trip, so repeated acks for the same hole don't resend it every time.
+        currentTime = time.monotonic()
+        for seq in range(cumulative, min(highestSacked, self.chunks)):
+            sentTime = self.sentAt.get(seq)
+            if not self.acked[seq] and sentTime is not None and currentTime - sentTime > (self.srtt or self.rto):
+                self.retransmitted[seq] = 1
+                self.sendChunks(seq)
+
+
+    def markAcked(self, seq):
+
+        if seq >= self.chunks or self.acked[seq]:
+            return
+
+        self.acked[seq] = 1
+        self.ackedCount += 1
+        sentTime = self.sentAt.pop(seq, None)
+
+        # Karn's rule: only chunks sent once give a usable round trip sample
+        if sentTime is not None and not self.retransmitted[seq]:
+            self.updateRto(time.monotonic() - sentTime)
+
+
+    def updateRto(self, sample):
+
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+
+    # Resends every chunk in flight whose timeout has passed.
+    # The timeout only backs off if nothing has been acked since the last expiry, so isolated
+    # losses on a working path don't slow the whole transfer down.
+    def retransmitExpired(self):
+
+        currentTime = time.monotonic()
+        expired = False
+
+        while self.sendOrder and self.sendOrder[0][0] + self.rto <= currentTime:
+            sentTime, seq = self.sendOrder.popleft()
+
+            # Already acked, or resent since this entry was queued
+            if self.acked[seq] or self.sentAt.get(seq) != sentTime:
+                continue
+
+            self.retransmitted[seq] = 1
+            self.sendChunks(seq)
+            expired = True
+
+        if expired:
+            if self.ackedCount == self.ackedAtLastExpiry:
+                self.rto = min(self.rto * 2, MAX_RTO)
+            self.ackedAtLastExpiry = self.ackedCount
+
+
+
+# Receives one file announced by a START packet
+class TransferReceiver:
+
+    def __init__(self, sock, address, transferId, metadata, outputName):
+        self.sock = sock
+        self.address = address
+        self.transferId = transferId
+        self.outputName = outputName
+
+        self.manifest = {key: metadata[key] for key in MANIFEST_KEYS}
+        self.presenter = metadata["presenter"]
+        self.size = metadata["size"]
+        self.chunkSize = metadata["chunkSize"]
+        self.chunks = -(-self.size // self.chunkSize)
+        self.partPath = outputName + PART_SUFFIX
+        self.statePath = outputName + STATE_SUFFIX
+
+        self.received = bytearray(self.chunks)
+        self.receivedCount = 0
+        self.cumulative = 0 # First chunk not yet received
+        self.unacked = 0 # New chunks since the last ack
+        self.closed = False
+        self.lastActivity = time.monotonic()
+        self.lastSaved = self.lastActivity
+        self.unsaved = False # Chunks have arrived since the state was last persisted
+
+        self.resumed = self.loadState()
+
+        if self.resumed:
+            self.fd = os.open(self.partPath, os.O_RDWR)
+        else:
+            # Preallocate the output file so chunks can be written at their offsets in any order
+            self.fd = os.open(self.partPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.posix_fallocate(self.fd, 0, self.size)
+            except (AttributeError, OSError):
+                try:
+                    os.ftruncate(self.fd, self.size)
+                except OSError:
+                    os.close(self.fd)
+                    raise
+
+
+    # Picks up the chunks saved by an interrupted transfer of the same file
+    # Returns False if there is nothing to resume, in which case the transfer starts from scratch
+    def loadState(self):
+
+        try:
+            with open(self.statePath, 'rb') as f:
+                manifestLine, _, ackState = f.read().partition(b"\n")
+
+            if json.loads(manifestLine) != self.manifest or os.path.getsize(self.partPath) != self.size:
+                return False
+
+            (cumulative,) = ackField.unpack_from(ackState)
+            bitmap = int.from_bytes(ackState[ackField.size:ackField.size + SACK_BYTES], "little")
+
+        except (OSError, ValueError, struct.error):
+            return False
+
+        cumulative = min(cumulative, self.chunks)
+        self.received[:cumulative] = b"\x01" * cumulative
+
+        seq = cumulative + 1
+        while bitmap and seq < self.chunks:
+            if bitmap & 1:
+                self.received[seq] = 1
+            bitmap >>= 1
+            seq += 1
+
+        self.receivedCount = self.received.count(1)
+        self.cumulative = cumulative
+        return True
+
+
+    # Records which chunks have arrived, once the chunks themselves are on disk.
+    # Only the range an ACK can describe is saved; anything beyond it is simply resent on resume.
+    def saveState(self):
+
+        if not self.unsaved or self.closed:
+            return
+
+        getattr(os, "fdatasync", os.fsync)(self.fd)
+
+        tempPath = self.statePath + ".tmp"
+        with open(tempPath, 'wb') as f:
+            f.write(json.dumps(self.manifest).encode() + b"\n" + self.ackPayload())
+        os.replace(tempPath, self.statePath)
+
+        self.unsaved = False
+        self.lastSaved = time.monotonic()
+
+
+    # Handles one datagram for this transfer
+    # Returns True once the transfer is complete
+    def handle(self, packetType, data):
+
+        self.lastActivity = time.monotonic()
+
+        if packetType == START:
+            self.sock.sendto(packetHeader.pack(START_ACK, self.transferId) + self.ackPayload(), self.address)
+
+        elif packetType == DATA:
+            self.handleData(data)
+
+        elif packetType == FIN:
+            if self.receivedCount == self.chunks:
+                self.finish()
+                self.reply(FIN_ACK)
+                return True
+
+            self.sendAck()
+
+        return False
+
+
+    def handleData(self, data):
+
+        (_, _, seq, checksum) = dataHeader.unpack_from(data)
+
+        if seq >= self.chunks:
+            return
+
+        # Corrupted or truncated chunks are dropped; the sender resends them like lost ones
+        payload = memoryview(data)[dataHeader.size:]
+        if len(payload) != min(self.chunkSize, self.size - seq * self.chunkSize) or zlib.crc32(payload) != checksum:
+            return
+
+        # Duplicate: the sender missed an ack
+        if self.received[seq]:
+            self.sendAck()
+            return
+
+        os.pwrite(self.fd, payload, seq * self.chunkSize)
+        self.received[seq] = 1
+        self.receivedCount += 1
+        self.unacked += 1
+        self.unsaved = True
+
+        outOfOrder = seq != self.cumulative
+
+        while self.cumulative < self.chunks and self.received[self.cumulative]:
+            self.cumulative += 1
+
+        # Ack straight away on a gap so the sender can fast retransmit, otherwise every ACK_EVERY chunks
+        if outOfOrder or self.unacked >= ACK_EVERY or self.cumulative == self.chunks:
+            self.sendAck()
+
+
+    def sendAck(self):
+        self.sock.sendto(packetHeader.pack(ACK, self.transferId) + self.ackPayload(), self.address)
+        self.unacked = 0
+
+
+    # Cumulative ack followed by the selective ack bitmap; bit i is set if chunk cumulative + 1 + i has arrived
+    def ackPayload(self):
+
+        window = self.received[self.cumulative + 1:self.cumulative + 1 + SACK_BYTES * 8]
+        bitmap = int(window[::-1].translate(bitChars) or b"0", 2)
+
+        return ackField.pack(self.cumulative) + bitmap.to_bytes(SACK_BYTES, "little")
+
+
+    def reply(self, packetType):
+        self.sock.sendto(packetHeader.pack(packetType, self.transferId), self.address)
+
+
+    # Moves the completed file into place and forgets its saved state
+    def finish(self):
+
+        if self.closed:
+            return
+
+        os.close(self.fd)
+        self.closed = True
+
+        os.replace(self.partPath, self.outputName)
+        try:
+            os.remove(self.statePath)
+        except FileNotFoundError:
+            pass
+
+
+    # Closes the file of an abandoned transfer, keeping the partial file and its state for a resume
+    def abort(self):
+
+        if self.closed:
+            return
+
+        try:
+            self.saveState()
+        except OSError:
+            pass
+
+        os.close(self.fd)
+        self.closed = True
+
+
+    # Progress snapshot for the service's progress()
+    def progress(self):
+        return {
+            "presenter": self.presenter,
+            "outputName": self.outputName,
+            "size": self.size,
+            "receivedChunks": self.receivedCount,
+            "chunks": self.chunks,
+            "resumed": self.resumed,
+        }
+
+
+
+# Long-lived receive service on a client's bound UDP socket.
+# Datagrams are demultiplexed by (sender address, transfer id), so any number of presenters can send
+# at once, each into its own file. The service keeps running after every transfer finishes.
+#   onComplete(presenter, outputName) is called when a file has fully arrived
+#   onError(presenter, error) is called when a transfer is abandoned
+class TransferService:
+
+    def __init__(self, sock, onComplete=None, onError=None):
+        self.sock = sock
+        self.onComplete = onComplete
+        self.onError = onError
+
+        self.transfers = {} # Stores { (address, transferId): TransferReceiver }
+        self.finished = {} # Stores { (address, transferId): time finished }, to re-answer a FIN whose FIN_ACK was lost
+        self.lastTick = time.monotonic()
+        self.running = True
+
+        sock.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_BUFFER)
+
+
+    # Receives datagrams until close() is called
+    def serveForever(self):
+
+        while self.running:
+
+            readable, _, _ = select.select([self.sock], [], [], self.timeout())
+
+            if readable and not self.receive():
+                return
+
+            self.tickIfDue()
+
+
+    # Seconds until the service next needs to tick, or None while there is nothing to re-ack or expire.
+    # Lets an event loop wait on the socket alongside other sources instead of calling serveForever.
+    def timeout(self):
+
+        if not self.transfers and not self.finished:
+            return None
+
+        return max(0.0, self.lastTick + ACK_INTERVAL - time.monotonic())
+
+
+    # Handles every datagram waiting on the socket
+    # Returns False once the socket has been closed
+    def receive(self):
+
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM, MSG_DONTWAIT)
+            except BlockingIOError:
+                return True
+            except OSError:
+                # Socket closed by close()
+                return False
+
+            self.handleDatagram(data, address)
+
+
+    def tickIfDue(self):
+        if time.monotonic() - self.lastTick >= ACK_INTERVAL:
+            self.tick()
+
+
+    # Routes one datagram to its transfer.
+    # Nothing a datagram holds is allowed to stop the service: malformed ones are ignored, and a transfer
+    # whose file can't be written is dropped and reported to onError.
+    def handleDatagram(self, data, address):
+
+        if len(data) < packetHeader.size:
+            return
+
+        packetType, transferId = packetHeader.unpack_from(data)
+        key = (address, transferId)
+        receiver = self.transfers.get(key)
+        presenter = receiver.presenter if receiver else None
+
+        try:
+            if receiver is None:
+
+                if key in self.finished:
+                    if packetType == FIN:
+                        self.sock.sendto(packetHeader.pack(FIN_ACK, transferId), address)
+                    return
+
+                if packetType != START:
+                    return
+
+                metadata = json.loads(data[packetHeader.size:])
+                checkManifest(metadata)
+                presenter = metadata["presenter"]
+
+                outputName = self.partialFor(metadata) or self.outputNameFor(metadata)
+                receiver = TransferReceiver(self.sock, address, transferId, metadata, outputName)
+                self.transfers[key] = receiver
+
+            if receiver.handle(packetType, data):
+                del self.transfers[key]
+                self.finished[key] = time.monotonic()
+
+                if self.onComplete:
+                    self.onComplete(receiver.presenter, receiver.outputName)
+
+        # Malformed datagram
+        except (ValueError, KeyError, TypeError, struct.error):
+            return
+
+        except (OSError, ArithmeticError) as e:
+            self.dropTransfer(key, presenter, e)
+
+
+    # Abandons a transfer that failed, keeping what it has written so far for a resume
+    def dropTransfer(self, key, presenter, error):
+
+        receiver = self.transfers.pop(key, None)
+
+        if receiver:
+            try:
+                receiver.abort()
+            except OSError:
+                pass
+
+        address, _ = key
+        logEvent(WARNING, "transferFailed", address=f"{address[0]}:{address[1]}", presenter=presenter, error=error)
+
+        if self.onError:
+            self.onError(presenter, TransferError(f"Transfer from {presenter} failed: {error}"))
+
+
+    # Finds the output name of a partial transfer of this file from the same presenter, if one was left behind.
+    # The receiver resumes it if the manifest still matches, and otherwise starts the file again under that name.
+    def partialFor(self, metadata):
+
+        name, extension = os.path.splitext(os.path.basename(metadata["filename"]))
+        inUse = {receiver.outputName for receiver in self.transfers.values()}
+
+        for statePath in glob.glob(glob.escape(name + '_received') + '*' + glob.escape(extension + STATE_SUFFIX)):
+
+            outputName = statePath[:-len(STATE_SUFFIX)]
+            if outputName in inUse:
+                continue
+
+            try:
+                with open(statePath, 'rb') as f:
+                    saved = json.loads(f.readline())
+            except (OSError, ValueError):
+                continue
+
+            if isinstance(saved, dict) and (saved.get("presenter"), saved.get("filename")) == (metadata["presenter"], metadata["filename"]):
+                return outputName
+
+        return None
+
+
+    # Picks the output file name, making sure two transfers never share a file,
+    # including partial ones waiting to be resumed.
+    # Only the file's own name is used; never trust a path from the network.
+    def outputNameFor(self, metadata):
+
+        name, extension = os.path.splitext(os.path.basename(metadata["filename"]))
+        inUse = {receiver.outputName for receiver in self.transfers.values()}
+        taken = lambda candidate: candidate in inUse or os.path.exists(candidate + STATE_SUFFIX)
+
+        outputName = name + '_received' + extension
+        if taken(outputName):
+            outputName = f"{name}_received_{os.path.basename(metadata['presenter'])}{extension}"
+
+        copy = 1
+        candidate = outputName
+        while taken(candidate):
+            copy += 1
+            root, extension = os.path.splitext(outputName)
+            candidate = f"{root}_{copy}{extension}"
+
+        return candidate
+
+
+    # Re-acks transfers whose sender has gone quiet, persists their progress,
+    # abandons dead ones and forgets old finished ones
+    def tick(self):
+
+        currentTime = time.monotonic()
+        self.lastTick = currentTime
+
+        for key, receiver in list(self.transfers.items()):
+            idle = currentTime - receiver.lastActivity
+
+            if idle > IDLE_TIMEOUT:
+                receiver.abort()
+                del self.transfers[key]
+
+                if self.onError:
+                    self.onError(receiver.presenter, TransferError(f"Transfer of {receiver.outputName} from {receiver.presenter} timed out"))
+
+            else:
+                if idle >= ACK_INTERVAL:
+                    receiver.sendAck()
+
+                if currentTime - receiver.lastSaved >= STATE_INTERVAL:
+                    receiver.saveState()
+
+        for key, finishedTime in list(self.finished.items()):
+            if currentTime - finishedTime > IDLE_TIMEOUT:
+                del self.finished[key]
+
+
+    # Progress of every transfer still in flight
+    def progress(self):
+        return [receiver.progress() for receiver in list(self.transfers.values())]
+
+
+    def close(self):
+        self.running = False
+        for receiver in self.transfers.values():
+            receiver.abort()